@@ -4,8 +4,9 @@ import numpy as np
 import os
 from datetime import datetime
 
-from src.data_loader import load_all_data
-from src.analysis import get_top_deals, calculate_price_statistics
+from src.data_loader import (filters_cover_all, get_filter_bounds, load_price_statistics, load_top_deals,
+                             load_underpriced, query_cars, refresh_data)
+from src.analysis import below_corridor, get_top_deals, calculate_price_statistics, quantile_corridors
 from src.plotting import create_price_mileage_scatter_plot, create_price_distribution_box_plot
 from src.econometrics import create_quantile_lowess_plot, run_hedonic_model
 
@@ -18,10 +19,12 @@ st.set_page_config(
 
 # --- Data Loading ---
 st.sidebar.title("Управление данными")
-force_reload = st.sidebar.button("Обновить данные из файлов")
-df = load_all_data(force_reload=force_reload)
+force_reload = st.sidebar.button("Загрузить новые данные из файлов")
+# Версия данных меняется только при загрузке новых файлов — она же ключ кэша запросов
+data_version = refresh_data(force=force_reload)
+bounds = get_filter_bounds(data_version)
 
-if df is None:
+if bounds is None:
     st.error("Не найдено ни одного файла с данными в папке `data/raw/`.")
     st.info("Пожалуйста, сначала запустите скрипты сбора данных, например: `python3 src/scrape_polovni_botasaurus.py`")
     st.stop()
@@ -29,29 +32,45 @@ if df is None:
 # --- Sidebar Filters ---
 st.sidebar.title("Фильтры")
 
-all_sources = sorted(df['source'].unique())
+all_sources = bounds['sources']
 selected_sources = st.sidebar.multiselect("Источники данных", all_sources, default=all_sources)
 
-all_groups = sorted(df['search_group'].unique())
+all_groups = bounds['search_groups']
 selected_groups = st.sidebar.multiselect("Модели для сравнения", all_groups, default=all_groups)
 
-min_year, max_year = int(df['year'].min()), int(df['year'].max())
+min_year, max_year = bounds['year']
 selected_year_range = st.sidebar.slider("Год выпуска", min_year, max_year, (min_year, max_year))
 
-min_km, max_km = int(df['mileage_km'].min()), int(df['mileage_km'].max())
+min_km, max_km = bounds['mileage_km']
 selected_km_range = st.sidebar.slider("Пробег, км", min_km, max_km, (min_km, max_km))
 
-# --- Filtering ---
-filtered_df = df[
-    (df['source'].isin(selected_sources)) &
-    (df['search_group'].isin(selected_groups)) &
-    (df['year'].between(selected_year_range[0], selected_year_range[1])) &
-    (df['mileage_km'].between(selected_km_range[0], selected_km_range[1]))
-].copy()
+# --- Filtering (в DuckDB, в память попадают только подходящие строки) ---
+filtered_df = query_cars(
+    data_version,
+    sources=tuple(selected_sources),
+    search_groups=tuple(selected_groups),
+    year_range=tuple(selected_year_range),
+    km_range=tuple(selected_km_range),
+)
+if filtered_df is None:
+    st.stop()
 
 # --- Main Page Calculations ---
 fig = create_price_mileage_scatter_plot(filtered_df)
-top_deals_df = get_top_deals(filtered_df)
+# Сводки берутся из материализованных агрегатов, если фильтры совпадают с их ячейками
+top_deals_df = load_top_deals(data_version, tuple(selected_sources), tuple(selected_groups),
+                              tuple(selected_year_range), tuple(selected_km_range), bounds['mileage_km'])
+if top_deals_df is None:
+    top_deals_df = get_top_deals(filtered_df)
+# Флаг "ниже P10 для своего пробега" по коридорам каждой группы (модель + источник)
+if not top_deals_df.empty:
+    top_deals_df['below_p10'] = below_corridor(top_deals_df, quantile_corridors(filtered_df))
+
+def model_price_statistics(model_df, search_group):
+    stats = None
+    if filters_cover_all(bounds, selected_year_range, selected_km_range):
+        stats = load_price_statistics(data_version, search_group, tuple(selected_sources))
+    return stats if stats is not None else calculate_price_statistics(model_df)
 
 # --- Render Main Page ---
 st.title("📊 Сравнительный анализ рынков автомобилей")
@@ -67,7 +86,7 @@ else:
     st.components.v1.html(graph_html, height=700, scrolling=True)
 
     if not filtered_df.empty:
-        source_counts = filtered_df['source'].value_counts().to_dict()
+        source_counts = filtered_df['source'].value_counts().loc[lambda c: c > 0].to_dict()
         summary_parts = [f"**{source}**: {count}" for source, count in source_counts.items()]
         st.write("Количество объявлений по источникам: " + ", ".join(summary_parts))
 
@@ -77,7 +96,8 @@ else:
         "url": st.column_config.LinkColumn("Ссылка", display_text="Перейти ↗"),
         "comparison_group": st.column_config.Column("Группа"),
         "mileage_bin": st.column_config.Column("Категория пробега"),
-        "source": st.column_config.Column("Источник")
+        "source": st.column_config.Column("Источник"),
+        "below_p10": st.column_config.CheckboxColumn("Ниже P10 для пробега")
     })
 
     st.header("📊 Детальное сравнение цен между сайтами")
@@ -97,13 +117,15 @@ else:
         if not model_comparison_df.empty:
             st.subheader(f"Статистика цен для {selected_model_for_comparison}")
 
-            price_stats = calculate_price_statistics(model_comparison_df)
+            price_stats = model_price_statistics(model_comparison_df, selected_model_for_comparison)
             st.dataframe(price_stats.style.format({
                 'mean': "€{:,.0f}",
                 'median': "€{:,.0f}",
                 'std': "€{:,.0f}",
+                '10th_percentile': "€{:,.0f}",
                 '25th_percentile': "€{:,.0f}",
-                '75th_percentile': "€{:,.0f}"
+                '75th_percentile': "€{:,.0f}",
+                '90th_percentile': "€{:,.0f}"
             }))
 
             if len(price_stats) > 1:
@@ -130,6 +152,24 @@ else:
             else:
                 st.warning("Выберите данные как минимум с двух источников для сравнения.")
 
+            st.subheader(f"Самые недооцененные {selected_model_for_comparison}")
+            st.write("Цена сравнивается со справедливой по гедонической модели группы (пробег, возраст, рынок). "
+                     "Недооценка — на сколько процентов цена ниже модельной.")
+            underpriced_df = load_underpriced(data_version, selected_model_for_comparison, tuple(selected_sources),
+                                              tuple(selected_year_range), tuple(selected_km_range))
+            if underpriced_df is not None and not underpriced_df.empty:
+                underpriced_df = underpriced_df.assign(
+                    undervaluation=(1 - np.exp(-underpriced_df['undervaluation'])) * 100
+                )[['url', 'title', 'price_eur', 'fair_price_eur', 'undervaluation', 'mileage_km', 'year', 'source']]
+                st.dataframe(underpriced_df, use_container_width=True, column_config={
+                    "url": st.column_config.LinkColumn("Ссылка", display_text="Перейти ↗"),
+                    "fair_price_eur": st.column_config.NumberColumn("Справедливая цена", format="€%.0f"),
+                    "undervaluation": st.column_config.NumberColumn("Недооценка", format="%.1f%%"),
+                    "source": st.column_config.Column("Источник")
+                })
+            else:
+                st.info("Недостаточно данных для модели справедливой цены.")
+
             st.subheader(f"Распределение цен для {selected_model_for_comparison}")
             fig_box = create_price_distribution_box_plot(model_comparison_df)
             st.plotly_chart(fig_box, use_container_width=True)
@@ -160,15 +200,13 @@ else:
                         st.metric(label=f"Премия рынка {market_name}", value=f"{premium:.2f}%" )
                 
                 st.write("Полная таблица с коэффициентами модели:")
-                # Parse and display summary tables using st.dataframe for robustness
-                summary = hedonic_model.summary()
+                # Tables come straight from the compact results object, no summary() text parsing
+                fit_stats = [(k, f"{v:.4g}" if isinstance(v, float) else str(v))
+                             for k, v in hedonic_model.fit_statistics().items()]
 
                 st.subheader("Таблица 1: Общая информация о модели")
-                table1_data = summary.tables[0].data
-                df1_left_data = {row[0].strip(): row[1].strip() for row in table1_data}
-                df1_right_data = {row[2].strip(): row[3].strip() for row in table1_data if len(row) > 2 and row[2].strip()}
-                df1_left = pd.DataFrame(df1_left_data.items(), columns=['Statistic', 'Value']).set_index('Statistic')
-                df1_right = pd.DataFrame(df1_right_data.items(), columns=['Statistic', 'Value']).set_index('Statistic')
+                df1_left = pd.DataFrame(fit_stats[:6], columns=['Statistic', 'Value']).set_index('Statistic')
+                df1_right = pd.DataFrame(fit_stats[6:], columns=['Statistic', 'Value']).set_index('Statistic')
 
                 col1, col2 = st.columns(2)
                 with col1:
@@ -177,17 +215,13 @@ else:
                     st.dataframe(df1_right, use_container_width=True)
 
                 st.subheader("Таблица 2: Коэффициенты модели")
-                table2 = summary.tables[1]
-                coeffs_df = pd.DataFrame(table2.data[1:], columns=table2.data[0])
-                coeffs_df = coeffs_df.set_index(coeffs_df.columns[0])
-                st.dataframe(coeffs_df, use_container_width=True)
+                coeffs_df = hedonic_model.coefficient_table()
+                st.dataframe(coeffs_df.style.format("{:.4g}"), use_container_width=True)
 
                 st.subheader("Таблица 3: Дополнительные диагностические тесты")
-                table3_data = summary.tables[2].data
-                df3_left_data = {row[0].strip(): row[1].strip() for row in table3_data}
-                df3_right_data = {row[2].strip(): row[3].strip() for row in table3_data if len(row) > 2 and row[2].strip()}
-                df3_left = pd.DataFrame(df3_left_data.items(), columns=['Statistic', 'Value']).set_index('Statistic')
-                df3_right = pd.DataFrame(df3_right_data.items(), columns=['Statistic', 'Value']).set_index('Statistic')
+                diagnostics = [(k, f"{v:.4g}") for k, v in hedonic_model.diagnostics.items()]
+                df3_left = pd.DataFrame(diagnostics[:4], columns=['Statistic', 'Value']).set_index('Statistic')
+                df3_right = pd.DataFrame(diagnostics[4:], columns=['Statistic', 'Value']).set_index('Statistic')
 
                 col3, col4 = st.columns(2)
                 with col3:
@@ -195,11 +229,9 @@ else:
                 with col4:
                     st.dataframe(df3_right, use_container_width=True)
 
-                # Display notes, if any
-                if len(summary.tables) > 3:
-                    st.subheader("Примечания")
-                    notes = summary.tables[3].data
-                    st.text('\n'.join([row[0] for row in notes]))
+                # Full statsmodels summary (with notes) only on request — it refits the model
+                if st.checkbox("Показать полный отчет statsmodels"):
+                    st.text(str(hedonic_model.summary()))
 
                 st.subheader("Пояснения к результатам модели")
 
@@ -252,14 +284,14 @@ else:
 
                     - **Цветные линии (Тренды)**: Это "сглаженные" средние линии цен для каждого рынка. Они показывают общую тенденцию: как в среднем падает цена с увеличением пробега на каждой площадке.
 
-                    - **Пунктирные линии (Ценовые коридоры)**: Они делят все автомобили на ценовые слои:
-                        - **Коридор "25% / 75%" (внутренний)**: Здесь находится "ядро" рынка — 50% автомобилей со средними, самыми типичными ценами.
-                        - **Коридор "10% / 90%" (внешний)**:
-                            - Ниже нижней линии находятся **10% самых дешевых** автомобилей (зона выгодных сделок).
-                            - Выше верхней линии находятся **10% самых дорогих** автомобилей.
+                    - **Пунктирные линии (Ценовые коридоры)**: Они делят автомобили каждого рынка на ценовые слои **с учетом пробега** — коридоры опускаются вместе с ценами по мере роста пробега:
+                        - **Коридор "25% / 75%" (внутренний, штрихи)**: Здесь находится "ядро" рынка — 50% автомобилей с таким же пробегом со средними, самыми типичными ценами.
+                        - **Коридор "10% / 90%" (внешний, точки)**:
+                            - Ниже нижней линии находятся **10% самых дешевых** автомобилей для своего пробега (зона выгодных сделок).
+                            - Выше верхней линии находятся **10% самых дорогих** автомобилей для своего пробега.
 
                     **Как это использовать?**
-                    Оцените, в какой коридор попадает интересующий вас автомобиль. Если он ниже линии 10%, это очень дешевое предложение. Если он внутри коридора 25-75%, его цена считается "нормальной".
+                    Оцените, в какой коридор попадает интересующий вас автомобиль при его пробеге. Если он ниже линии 10%, это очень дешевое предложение (в таблице топ-предложений такие отмечены флажком). Если он внутри коридора 25-75%, его цена считается "нормальной".
                     """)
             else:
                 st.warning("Недостаточно данных для построения гедонистической модели.")
@@ -281,7 +313,7 @@ if st.sidebar.button("Сохранить отчет в HTML"):
 
         # --- Listings Summary for HTML ---
         if not filtered_df.empty:
-            source_counts = filtered_df['source'].value_counts().to_dict()
+            source_counts = filtered_df['source'].value_counts().loc[lambda c: c > 0].to_dict()
             summary_parts_html = [f"<strong>{source}</strong>: {count}" for source, count in source_counts.items()]
             listings_summary_html = f'<p><strong>Количество объявлений по источникам:</strong> {", ".join(summary_parts_html)}</p>'
         else:
@@ -304,11 +336,12 @@ if st.sidebar.button("Сохранить отчет в HTML"):
                 comparison_html_parts.append(f"<h2>📊 Детальное сравнение цен для {selected_model_for_comparison}</h2>")
 
                 # Stats Table
-                price_stats_report = calculate_price_statistics(model_comparison_df_report)
+                price_stats_report = model_price_statistics(model_comparison_df_report, selected_model_for_comparison)
                 if not price_stats_report.empty:
                     stats_table_html = price_stats_report.style.format({
                         'mean': "€{:,.0f}", 'median': "€{:,.0f}", 'std': "€{:,.0f}",
-                        '25th_percentile': "€{:,.0f}", '75th_percentile': "€{:,.0f}"
+                        '10th_percentile': "€{:,.0f}", '25th_percentile': "€{:,.0f}",
+                        '75th_percentile': "€{:,.0f}", '90th_percentile': "€{:,.0f}"
                     }).to_html(index=True, justify='left', border=0, classes='deals_table', table_uuid='stats-table')
                     comparison_html_parts.append("<h3>Статистика цен</h3>")
                     comparison_html_parts.append(stats_table_html)
@@ -351,15 +384,17 @@ if st.sidebar.button("Сохранить отчет в HTML"):
                 hedonic_model_report = run_hedonic_model(model_comparison_df_report)
                 if hedonic_model_report:
                     comparison_html_parts.append("<h3>Результаты гедонистической модели</h3>")
-                    market_coeffs_report = {k: v for k, v in hedonic_model_report.params.items() if 'C(market' in k}
+                    market_coeffs_report = {k: v for k, v in hedonic_model_report.params.items() if k.startswith('market_')}
                     if market_coeffs_report:
                         for market, coeff in market_coeffs_report.items():
-                            market_name = market.split('.')[-1].split(']')[0]
+                            market_name = market.replace('market_', '')
                             premium = (np.exp(coeff) - 1) * 100
                             comparison_html_parts.append(f"<p><strong>Премия рынка {market_name}:</strong> {premium:.2f}%</p>")
                     
                     comparison_html_parts.append("<h4>Полная таблица с коэффициентами:</h4>")
-                    comparison_html_parts.append(f"<pre>{hedonic_model_report.summary()}</pre>")
+                    comparison_html_parts.append(
+                        f"<p>R² = {hedonic_model_report.rsquared:.3f}, наблюдений: {hedonic_model_report.nobs}</p>")
+                    comparison_html_parts.append(hedonic_model_report.coefficient_table().to_html(float_format="{:.4g}".format))
 
                 comparison_html_parts.append('</div>')
 
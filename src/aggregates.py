@@ -0,0 +1,139 @@
+# aggregates.py
+# Материализованные агрегаты по (search_group, source, year, корзина пробега):
+# статистика цен и k самых дешевых объявлений каждой ячейки. Пересчитываются при загрузке
+# только для затронутых пар (search_group, source), поэтому сводки в приложении читаются
+# за постоянное время, сколько бы объявлений ни было в базе.
+# Там же пересчитываются скетчи цен по дням (sketches) для квантилей по любому набору фильтров.
+from src.analysis import MILEAGE_BIN_KM, TOP_DEALS_ORDER
+from src.sketches import SKETCH_TABLE, ensure_sketch_schema, merged_sketch, refresh_sketches
+
+CHEAPEST_K = 5                 # хранится на ячейку; k самых дешевых сливаются точно по любым ячейкам
+STATS_TABLE = "agg_price_stats"
+CHEAPEST_TABLE = "agg_cheapest"
+
+# year / mileage_bin = NULL — итог по всей паре (search_group, source)
+STATS_COLUMNS_SQL = """
+    count(*) AS n,
+    avg(price_eur) AS mean,
+    stddev_samp(price_eur) AS std,
+    min(price_eur) AS price_min,
+    max(price_eur) AS price_max,
+    quantile_cont(price_eur, 0.25) AS p25,
+    quantile_cont(price_eur, 0.5) AS median,
+    quantile_cont(price_eur, 0.75) AS p75
+"""
+
+
+def ensure_aggregate_schema(con):
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {STATS_TABLE} (
+            search_group VARCHAR, source VARCHAR, year BIGINT, mileage_bin BIGINT,
+            n BIGINT, mean DOUBLE, std DOUBLE, price_min BIGINT, price_max BIGINT,
+            p25 DOUBLE, median DOUBLE, p75 DOUBLE
+        )
+    """)
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {CHEAPEST_TABLE} (
+            search_group VARCHAR, source VARCHAR, year BIGINT, mileage_bin BIGINT, rank BIGINT,
+            url VARCHAR, title VARCHAR, price_eur BIGINT, mileage_km BIGINT, num_owners BIGINT,
+            scrape_date DATE, scraped_at TIMESTAMPTZ
+        )
+    """)
+    ensure_sketch_schema(con)
+
+
+def refresh_aggregates(con, cars_table, valid_rows_sql, touched_sql=None):
+    """
+    Recomputes the aggregates and price sketches of the (search_group, source) pairs returned by
+    `touched_sql` (all pairs if None) from `cars_table`. Run it inside the ingest transaction.
+    """
+    ensure_aggregate_schema(con)
+    if touched_sql is None:
+        touched_sql = f"SELECT DISTINCT search_group, source FROM {cars_table}"
+    con.execute(f"CREATE OR REPLACE TEMP TABLE agg_touched AS {touched_sql}")
+    for table in (STATS_TABLE, CHEAPEST_TABLE, SKETCH_TABLE):
+        con.execute(f"""
+            DELETE FROM {table} WHERE EXISTS (
+                SELECT 1 FROM agg_touched t
+                WHERE t.search_group IS NOT DISTINCT FROM {table}.search_group
+                  AND t.source IS NOT DISTINCT FROM {table}.source
+            )
+        """)
+    rows_sql = f"""
+        SELECT c.*, floor(c.mileage_km / {MILEAGE_BIN_KM})::BIGINT * {MILEAGE_BIN_KM} AS mileage_bin
+        FROM {cars_table} c
+        SEMI JOIN agg_touched t
+          ON t.search_group IS NOT DISTINCT FROM c.search_group AND t.source IS NOT DISTINCT FROM c.source
+        WHERE {valid_rows_sql}
+    """
+    con.execute(f"""
+        INSERT INTO {STATS_TABLE}
+        SELECT search_group, source, year, mileage_bin, {STATS_COLUMNS_SQL}
+        FROM ({rows_sql})
+        GROUP BY GROUPING SETS ((search_group, source, year, mileage_bin), (search_group, source))
+    """)
+    con.execute(f"""
+        INSERT INTO {CHEAPEST_TABLE}
+        SELECT search_group, source, year, mileage_bin,
+               row_number() OVER (PARTITION BY search_group, source, year, mileage_bin
+                                  ORDER BY {', '.join(TOP_DEALS_ORDER)}) AS rank,
+               url, title, price_eur, mileage_km, num_owners, scrape_date, scraped_at
+        FROM ({rows_sql})
+        QUALIFY rank <= {CHEAPEST_K}
+    """)
+    refresh_sketches(con, rows_sql)
+    con.execute("DROP TABLE agg_touched")
+
+
+def km_range_aligned(km_range, km_bounds):
+    """True if the mileage filter only cuts at bin edges (or not at all)."""
+    lo, hi = km_range
+    lo_ok = lo <= km_bounds[0] or lo % MILEAGE_BIN_KM == 0
+    hi_ok = hi >= km_bounds[1] or hi % MILEAGE_BIN_KM == MILEAGE_BIN_KM - 1
+    return lo_ok and hi_ok
+
+
+def _in(column, values, params):
+    params += list(values)
+    return f"{column} IN ({', '.join('?' * len(values))})" if values else "false"
+
+
+def cheapest_listings(con, sources, search_groups, year_range, km_range, k=2):
+    """
+    The k cheapest listings per (search_group, source, mileage bin) within the filters,
+    merged from the per-cell lists, as an Arrow table. The mileage filter must be aligned to the bins.
+    """
+    if k > CHEAPEST_K:
+        raise ValueError(f"only {CHEAPEST_K} cheapest listings are kept per cell")
+    params = []
+    where = [_in("source", sources, params), _in("search_group", search_groups, params),
+             "year BETWEEN ? AND ?", "mileage_bin + ? > ? AND mileage_bin <= ?"]
+    params += [year_range[0], year_range[1], MILEAGE_BIN_KM, km_range[0], km_range[1]]
+    return con.execute(f"""
+        SELECT url, title, price_eur, mileage_km, year, num_owners, source, search_group,
+               scrape_date, scraped_at, mileage_bin
+        FROM {CHEAPEST_TABLE}
+        WHERE {' AND '.join(where)}
+        QUALIFY row_number() OVER (PARTITION BY search_group, source, mileage_bin
+                                   ORDER BY {', '.join(TOP_DEALS_ORDER)}) <= ?
+        ORDER BY mileage_bin, search_group, source, {', '.join(TOP_DEALS_ORDER)}
+    """, params + [k]).to_arrow_table()
+
+
+def price_statistics(con, search_group, sources):
+    """
+    Per-source price statistics of a whole search group (no year/mileage filter): exact moments
+    and quartiles from the aggregates, the 10% / 90% tails merged from the daily price sketches.
+    """
+    params = [search_group]
+    source_filter = _in("source", sources, params)
+    stats = con.execute(f"""
+        SELECT source, mean, median, std, p25 AS "25th_percentile", p75 AS "75th_percentile"
+        FROM {STATS_TABLE}
+        WHERE search_group = ? AND {source_filter} AND year IS NULL AND mileage_bin IS NULL
+        ORDER BY source
+    """, params).fetchdf().set_index("source")
+    tails = [merged_sketch(con, sources=[s], search_groups=[search_group]).quantile([0.1, 0.9]) for s in stats.index]
+    stats.insert(3, "10th_percentile", [t[0] for t in tails])
+    stats["90th_percentile"] = [t[1] for t in tails]
+    return stats
@@ -1,29 +1,252 @@
 
+import time
+
+import numpy as np
 import pandas as pd
 
-def get_top_deals(df):
+MILEAGE_BIN_KM = 50000
+TOP_DEALS_ORDER = ("price_eur", "mileage_km", "url")  # порядок в корзине: при равной цене — пробег, затем URL (как в агрегатах)
+CORRIDOR_QUANTILES = (0.1, 0.25, 0.75, 0.9)
+CORRIDOR_MIN_BIN_ROWS = 30   # минимум объявлений в корзине пробега коридора
+CORRIDOR_MAX_BINS = 40       # больше корзин на группу не нужно даже для 100k+ объявлений
+
+def mileage_bin_label(start, width=MILEAGE_BIN_KM):
+    return f'{start/1000:,.0f} - {(start+width)/1000:,.0f} тыс. км'
+
+def mileage_bins(mileage_km, bin_width=MILEAGE_BIN_KM, edges=None):
+    """
+    Bin start and width of every mileage: fixed-width bins from 0, or explicit ascending `edges`
+    (bins [edges[i], edges[i+1])). Values outside the edges get a start of -1.
+    """
+    km = np.asarray(mileage_km, dtype=np.float64)
+    if edges is None:
+        starts = np.floor(km / bin_width) * bin_width
+        return np.where(np.isnan(km), -1, starts).astype(np.int64), np.full(len(km), bin_width, dtype=np.int64)
+    edges = np.asarray(edges, dtype=np.int64)
+    idx = np.searchsorted(edges, km, side="right") - 1
+    inside = (idx >= 0) & (idx < len(edges) - 1) & ~np.isnan(km)
+    idx = np.clip(idx, 0, len(edges) - 2)
+    starts = np.where(inside, edges[idx], -1)
+    return starts, np.where(inside, edges[idx + 1] - edges[idx], 0)
+
+
+def _group_codes(values):
+    """Integer codes of a grouping column (-1 for missing): category codes or sorted factorize."""
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.cat.codes.to_numpy().astype(np.int64)
+    return pd.factorize(values, sort=True)[0]
+
+
+def _first_in_group(sorted_keys):
+    """Position of every row within its group of equal sorted keys."""
+    n = len(sorted_keys[0])
+    new_group = np.ones(n, dtype=bool)
+    new_group[1:] = np.logical_or.reduce([key[1:] != key[:-1] for key in sorted_keys])
+    return np.arange(n) - np.maximum.accumulate(np.where(new_group, np.arange(n), 0)), new_group
+
+
+def get_top_deals(df, k=2, bin_width=MILEAGE_BIN_KM, edges=None, by=("comparison_group",)):
+    """
+    The k cheapest listings per mileage bin and `by` group, sorted by bin, group and TOP_DEALS_ORDER
+    (equal prices are ordered by the other columns of it that `df` has, as in the aggregates).
+    One stable sort and a rank within each group, no Python call per group; the tie-break columns
+    are only sorted for rows priced up to the k-th price of their group. `df` is not modified.
+    mileage_bin is an ordered categorical in bin order. Rows without price or mileage, or outside `edges`, are skipped.
+    """
     if df.empty:
         return pd.DataFrame()
-    max_km_limit = int(df['mileage_km'].max() + 50000)
-    bins = list(range(0, max_km_limit, 50000))
-    if not bins:
-        return pd.DataFrame()
-    labels = [f'{i/1000:,.0f} - {(i+50000)/1000:,.0f} тыс. км' for i in bins[:-1]]
-    df['mileage_bin'] = pd.cut(df['mileage_km'], bins=bins, labels=labels, right=False)
-    
-    # Group by the new comparison group
-    top_deals = df.groupby(['mileage_bin', 'comparison_group'], observed=False).apply(
-        lambda x: x.nsmallest(2, 'price_eur')
-    ).reset_index(drop=True)
+    by = list(by)
+    starts, widths = mileage_bins(df['mileage_km'], bin_width, edges)
+    price = df['price_eur'].to_numpy(dtype=np.float64, na_value=np.nan)
+    keys = [starts]
+    valid = (starts >= 0) & ~np.isnan(price)
+    for column in by:
+        codes = _group_codes(df[column])
+        keys.append(codes)
+        valid &= codes >= 0
+
+    rows = np.flatnonzero(valid)
+    keys = [key[rows] for key in keys]
+    order = np.lexsort([price[rows]] + keys[::-1])
+    rows = rows[order]
+    sorted_keys = [key[order] for key in keys]
+    rank, new_group = _first_in_group(sorted_keys)
+
+    ties = [column for column in TOP_DEALS_ORDER[1:] if column in df.columns]
+    if ties and len(rows):
+        # кандидаты — объявления не дороже k-го в своей группе: равные цены на границе решают остальные столбцы
+        group_id = np.cumsum(new_group) - 1
+        kth_price = np.full(group_id[-1] + 1, np.inf)
+        at_k = rank == k - 1
+        kth_price[group_id[at_k]] = price[rows][at_k]
+        candidates = price[rows] <= kth_price[group_id]
+        rows, sorted_keys = rows[candidates], [key[candidates] for key in sorted_keys]
+        tie_keys = [pd.factorize(df[column].to_numpy()[rows], sort=True)[0] for column in ties]
+        order = np.lexsort(tie_keys[::-1] + [price[rows]] + sorted_keys[::-1])
+        rows, sorted_keys = rows[order], [key[order] for key in sorted_keys]
+        rank, _ = _first_in_group(sorted_keys)
+    rows = rows[rank < k]
+
+    top_deals = df.iloc[rows].reset_index(drop=True)
+    bin_starts, bin_widths = starts[rows], widths[rows]
+    labels = {(b, w): mileage_bin_label(b, w) for b, w in sorted(set(zip(bin_starts.tolist(), bin_widths.tolist())))}
+    top_deals['mileage_bin'] = pd.Categorical(
+        [labels[bw] for bw in zip(bin_starts.tolist(), bin_widths.tolist())],
+        categories=list(dict.fromkeys(labels.values())), ordered=True,
+    )
     return top_deals
 
+
+def quantile_corridors(df, by="comparison_group", qs=CORRIDOR_QUANTILES):
+    """
+    Price quantiles conditional on mileage for every `by` group, in one pass over all groups:
+    rows are split into equal-count mileage bins per group (at least CORRIDOR_MIN_BIN_ROWS rows,
+    at most CORRIDOR_MAX_BINS bins), all quantiles of all bins are read from one sort by
+    (bin, price), and each curve is smoothed with the neighbouring bins (1-2-1).
+    Returns one row per bin: `by`, mileage_km (median of the bin) and p10, p25, ... columns.
+    """
+    columns = [f"p{round(q * 100)}" for q in qs]
+    if df.empty:
+        return pd.DataFrame(columns=[by, "mileage_km", *columns])
+    group = _group_codes(df[by])
+    km = df['mileage_km'].to_numpy(dtype=np.float64, na_value=np.nan)
+    price = df['price_eur'].to_numpy(dtype=np.float64, na_value=np.nan)
+    rows = np.flatnonzero((group >= 0) & ~np.isnan(km) & ~np.isnan(price))
+    if not len(rows):
+        return pd.DataFrame(columns=[by, "mileage_km", *columns])
+    group, km, price = group[rows], km[rows], price[rows]
+
+    # Равные по числу объявлений корзины пробега внутри каждой группы; в порядке (группа, пробег)
+    # корзины идут подряд по возрастанию номера. Сортировки — по одному ключу float64
+    # (группа * ширина диапазона + значение, точен до 2**53), это в разы быстрее lexsort
+    order = np.argsort(group * (np.ptp(km) + 1) + (km - km.min()))
+    sizes = np.bincount(group)
+    n_bins = np.clip(sizes // CORRIDOR_MIN_BIN_ROWS, 1, CORRIDOR_MAX_BINS)
+    bin_offset = np.concatenate(([0], np.cumsum(n_bins)[:-1]))
+    g = group[order]
+    rank = np.arange(len(order)) - (np.cumsum(sizes) - sizes)[g]
+    bin_id = np.empty(len(order), dtype=np.int64)
+    bin_id[order] = bin_offset[g] + rank * n_bins[g] // np.maximum(sizes[g], 1)
+    counts = np.bincount(bin_id, minlength=n_bins.sum())
+    used = counts > 0
+    counts = counts[used]
+    starts = np.cumsum(counts) - counts
+    sorted_km = km[order]
+    centers = (sorted_km[starts + (counts - 1) // 2] + sorted_km[starts + counts // 2]) / 2
+
+    # Все квантили всех корзин из одной сортировки по (корзина, цена), интерполяция как в pandas
+    sorted_price = price[np.argsort(bin_id * (np.ptp(price) + 1) + (price - price.min()))]
+    pos = starts[:, None] + np.asarray(qs)[None, :] * (counts[:, None] - 1)
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.minimum(lo + 1, (starts + counts - 1)[:, None])
+    values = sorted_price[lo] + (pos - lo) * (sorted_price[hi] - sorted_price[lo])
+
+    # Сглаживание 1-2-1 по соседним корзинам той же группы (порядок квантилей сохраняется)
+    bin_group = np.repeat(np.arange(len(n_bins)), n_bins)[used]
+    same_prev = np.r_[False, bin_group[1:] == bin_group[:-1]][:, None]
+    same_next = np.r_[bin_group[1:] == bin_group[:-1], False][:, None]
+    prev = np.where(same_prev, np.roll(values, 1, axis=0), values)
+    nxt = np.where(same_next, np.roll(values, -1, axis=0), values)
+    values = (prev + 2 * values + nxt) / 4
+
+    labels = df[by].cat.categories if isinstance(df[by].dtype, pd.CategoricalDtype) \
+        else pd.factorize(df[by], sort=True)[1]
+    corridors = pd.DataFrame(values, columns=columns)
+    corridors.insert(0, "mileage_km", centers)
+    corridors.insert(0, by, np.asarray(labels)[bin_group])
+    return corridors
+
+
+def below_corridor(df, corridors, by="comparison_group", q=0.1):
+    """
+    True where a listing is priced below the `q` corridor of its `by` group at its mileage
+    (linear between bins, flat beyond them). `corridors` as returned by quantile_corridors;
+    one searchsorted over a (group, mileage) key for all rows. False for groups without a corridor.
+    """
+    flags = np.zeros(len(df), dtype=bool)
+    if df.empty or corridors.empty:
+        return flags
+    names = pd.unique(corridors[by])
+    corridor_code = pd.Categorical(corridors[by], categories=names).codes.astype(np.float64)
+    row_code = pd.Categorical(df[by], categories=names).codes
+    knots = corridors['mileage_km'].to_numpy(dtype=np.float64)
+    limits = corridors[f"p{round(q * 100)}"].to_numpy(dtype=np.float64)
+    km = df['mileage_km'].to_numpy(dtype=np.float64, na_value=np.nan)
+    price = df['price_eur'].to_numpy(dtype=np.float64, na_value=np.nan)
+    valid = (row_code >= 0) & ~np.isnan(km) & ~np.isnan(price)
+    if not valid.any():
+        return flags
+
+    # Группа и пробег в одном ключе: корзины коридора отсортированы по нему
+    lo = min(knots.min(), km[valid].min())
+    width = max(knots.max(), km[valid].max()) - lo + 1
+    # Границы корзин каждой группы — по одному поиску на группу, а не на строку
+    code = np.maximum(row_code, 0)
+    first = np.searchsorted(corridor_code, np.arange(len(names)), side="left")[code]
+    last = np.searchsorted(corridor_code, np.arange(len(names)), side="right")[code] - 1
+    pos = np.searchsorted(corridor_code * width + (knots - lo), code * width + (np.nan_to_num(km) - lo))
+    left = np.clip(pos - 1, first, last)
+    right = np.clip(pos, first, last)
+    left, right = np.where(valid, left, 0), np.where(valid, right, 0)
+    span = knots[right] - knots[left]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t = np.where(span > 0, (km - knots[left]) / span, 0.0)
+    limit = limits[left] + t * (limits[right] - limits[left])
+    flags[valid] = price[valid] < limit[valid]
+    return flags
+
+
 def calculate_price_statistics(df):
     """Calculates price statistics for a given dataframe."""
     if df.empty:
         return None
 
-    price_stats = df.groupby('source')['price_eur'].agg(
-        ['mean', 'median', 'std', lambda x: x.quantile(0.25), lambda x: x.quantile(0.75)]
-    ).rename(columns={'<lambda_0>': '25th_percentile', '<lambda_1>': '75th_percentile'})
-    
+    grouped = df.groupby('source', observed=True)['price_eur']
+    price_stats = grouped.agg(['mean', 'median', 'std'])
+    # Все квантили одним проходом вместо отдельной лямбды на каждый
+    quantiles = grouped.quantile([0.1, 0.25, 0.75, 0.9]).unstack()
+    for q in quantiles.columns:
+        price_stats[f'{round(q * 100)}th_percentile'] = quantiles[q]
+
     return price_stats
+
+
+if __name__ == "__main__":
+    # Бенчмарк: векторный get_top_deals против groupby().apply с сортировкой по TOP_DEALS_ORDER
+    # (цены кратны 100 евро, так что на границе k-го места много равных цен) и коридоры квантилей по пробегу одним проходом против прохода groupby на каждый квантиль
+    def apply_top_deals(df, k=2, by=("comparison_group",)):
+        df = df.assign(mileage_bin=df['mileage_km'] // MILEAGE_BIN_KM)
+        return df.groupby(['mileage_bin', *by], observed=True).apply(
+            lambda x: x.sort_values(list(TOP_DEALS_ORDER)).head(k), include_groups=False
+        ).reset_index(drop=True)
+
+    rng = np.random.default_rng(0)
+    groups = [f"Model {i} ({s})" for i in range(40) for s in ("mobile.de", "polovni_automobili")]
+    for n in (10_000, 100_000, 1_000_000):
+        df = pd.DataFrame({
+            'price_eur': (rng.integers(50, 800, n) * 100).astype(np.int32),
+            'mileage_km': (rng.integers(0, 350, n) * 1_000).astype(np.int32),
+            'year': rng.integers(2010, 2025, n).astype(np.int16),
+            'comparison_group': pd.Categorical(rng.choice(groups, n)),
+            'url': [f"https://example.com/{i}" for i in rng.permutation(n)],
+        })
+        for by in (("comparison_group",), ("comparison_group", "year")):
+            t0 = time.perf_counter()
+            fast = get_top_deals(df, k=2, by=by)
+            t1 = time.perf_counter()
+            slow = apply_top_deals(df, k=2, by=by)
+            t2 = time.perf_counter()
+            for column in TOP_DEALS_ORDER:
+                assert fast[column].tolist() == slow[column].tolist(), column
+            print(f"{n:>9,} rows by {'+'.join(by)}: vectorized {t1 - t0:7.3f} s, groupby.apply {t2 - t1:7.3f} s")
+
+        t0 = time.perf_counter()
+        corridors = quantile_corridors(df)
+        flags = below_corridor(df, corridors)
+        t1 = time.perf_counter()
+        binned = df.assign(mileage_bin=pd.qcut(df['mileage_km'], CORRIDOR_MAX_BINS, labels=False))
+        per_quantile = [binned.groupby(['comparison_group', 'mileage_bin'], observed=True)['price_eur']
+                        .quantile(q) for q in CORRIDOR_QUANTILES]
+        t2 = time.perf_counter()
+        print(f"{n:>9,} rows corridors + below P10 flag: one pass {t1 - t0:7.3f} s "
+              f"({flags.mean():.1%} flagged), groupby per quantile {t2 - t1:7.3f} s")
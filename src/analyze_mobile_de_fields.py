@@ -1,48 +1,30 @@
 # src/analyze_mobile_de_fields.py
-import json
-import re
 import pandas as pd
 from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
 import pprint
 
 from botasaurus.browser import browser
-from bs4 import BeautifulSoup
 
-# Используем существующую функцию рендеринга страницы
-from scrape_mobile_de import render_page_mobile_de, find_and_clean_json
+# Используем существующую функцию рендеринга страницы и общий извлекатель __INITIAL_STATE__
+from initial_state import extract_search_results, find_initial_state, page_title
+from scrape_mobile_de import render_page_mobile_de
 
 def analyze_first_ad(html):
     """
     Парсит HTML, находит первое объявление в данных __INITIAL_STATE__
     и выводит всю информацию о нем в читаемом формате.
     """
-    soup = BeautifulSoup(html, "lxml")
-    print(f"Анализ страницы с заголовком: \"{soup.title.string}\"")
+    print(f"Анализ страницы с заголовком: \"{page_title(html)}\"")
 
-    script_tag = soup.find("script", string=re.compile(r"window\.__INITIAL_STATE__"))
-    if not script_tag:
-        print("ОШИБКА: Не удалось найти тег <script> с __INITIAL_STATE__.")
+    if find_initial_state(html) == -1:
+        print("ОШИБКА: Не удалось найти присваивание window.__INITIAL_STATE__.")
         return
 
-    match = re.search(r"window\.__INITIAL_STATE__\s*=\s*(.*)", script_tag.string, re.DOTALL)
-    if not match:
-        print("ОШИБКА: Не удалось извлечь содержимое из тега <script>.")
-        return
-    
-    raw_js_string = match.group(1)
-    json_str = find_and_clean_json(raw_js_string)
-
-    if not json_str:
-        print("ОШИБКА: Не удалось найти полный JSON объект.")
-        return
-
-    data = json.loads(json_str)
-
-    try:
-        results = data['search']['srp']['data']['searchResults']['items']
-    except KeyError as e:
-        print(f"ОШИБКА: Не удалось найти объявления в JSON. Отсутствует ключ: {e}")
+    search_results = extract_search_results(html)
+    if not search_results or 'items' not in search_results:
+        print("ОШИБКА: Не удалось найти объявления в JSON __INITIAL_STATE__.")
         return
+    results = search_results['items']
 
     # Находим первое настоящее объявление
     first_ad = None
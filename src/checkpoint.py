@@ -0,0 +1,74 @@
+# checkpoint.py
+# Журнал прогресса одного поискового запроса: каждая обработанная страница
+# дописывается строкой JSON сразу после парсинга, поэтому упавший запуск
+# можно продолжить с первой недокачанной страницы.
+import hashlib
+import json
+import os
+import time
+
+CHECKPOINT_DIR = "data/state/checkpoints"
+MAX_AGE = 24 * 3600  # секунд: журнал старше суток — уже не те объявления, начинаем заново
+
+
+class PageJournal:
+    """
+    Append-only JSONL journal of completed result pages of one search URL.
+    Only pages loaded from a previous run are kept in memory (`pages`); pages recorded
+    in this run are just remembered as done, so the journal does not grow with the search.
+    A journal whose first page is older than `max_age` seconds is discarded on load.
+    """
+
+    def __init__(self, source, url, directory=CHECKPOINT_DIR, max_age=MAX_AGE):
+        key = hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]
+        self.path = os.path.join(directory, source, f"{key}.jsonl")
+        self.url = url
+        self.pages = {}
+        self._recorded = set()
+        self.total_pages = None
+        if os.path.exists(self.path):
+            self._load(max_age)
+
+    def _load(self, max_age):
+        started = None
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    break  # последняя строка могла не дописаться при падении
+                # в журналах без отметок времени возраст берется по времени изменения файла
+                recorded_at = entry.get("recorded_at", os.path.getmtime(self.path))
+                started = recorded_at if started is None else min(started, recorded_at)
+                self.pages[entry["page"]] = entry["cards"]
+                if entry.get("total_pages") is not None:
+                    self.total_pages = entry["total_pages"]
+        if started is not None and time.time() - started > max_age:
+            print(f"  - Discarding checkpoint older than {max_age / 3600:.0f} h ({self.path}).")
+            self.pages, self.total_pages = {}, None
+            os.remove(self.path)
+            return
+        if self.pages:
+            print(f"  - Resuming from checkpoint: {len(self.pages)} pages already done ({self.path}).")
+
+    def done(self, page):
+        return page in self.pages or page in self._recorded
+
+    def record(self, page, cards, total_pages=None):
+        """Appends a parsed page. Pages without cards are skipped: a blocked or empty page is fetched again on resume."""
+        if not cards:
+            return
+        self._recorded.add(page)
+        if total_pages is not None:
+            self.total_pages = total_pages
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"page": page, "total_pages": total_pages, "recorded_at": time.time(), "cards": cards},
+                               ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def finish(self):
+        """Removes the journal once the query has been saved."""
+        if os.path.exists(self.path):
+            os.remove(self.path)
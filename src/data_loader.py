@@ -1,82 +1,549 @@
+import glob
+import hashlib
 import os
+import threading
+import time
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 import streamlit as st
-import duckdb
 
-DB_FILE = "data/cars.duckdb"
+from src.aggregates import (CHEAPEST_TABLE, STATS_TABLE, cheapest_listings, ensure_aggregate_schema,
+                            km_range_aligned, price_statistics, refresh_aggregates)
+from src.analysis import get_top_deals, mileage_bin_label
+from src.dataset import partition_value
+from src.db import DB_FILE, bump_data_version, get_database
+from src.dedup import VEHICLES_TABLE, assign_vehicle_ids, drop_outdated_vehicles, ensure_vehicle_schema
+from src.fair_price import FAIR_PRICE_TABLE, most_underpriced, refresh_fair_prices
+from src.listing_ids import LISTING_ID_SQL, SOURCE_CODE_SQL, URLS_TABLE, ensure_url_schema, packed_key_sql
+from src.price_history import (HISTORY_TABLE, LISTED, absence_observations_sql, ensure_history_schema,
+                               record_history, touch_observations_sql)
+from src.sketches import SKETCH_TABLE
+
 TABLE_NAME = "cars"
+DATASET_DIR = "data/dataset"  # source=<источник>/search_group=<группа>/scrape_date=<дата>/*.parquet
+TOUCHES_DIR = "data/touches"  # то же разбиение: URL и время объявлений, увиденных без изменений (только для истории)
+CRAWLS_DIR = "data/crawls"    # source=<источник>/search_group=<группа>/*.parquet: начало полных обходов групп
+LEGACY_PARQUET_FILES = [      # файлы старого формата (один parquet на источник), читаются вместе с датасетом
+    "data/raw/polovni_automobili.parquet",
+    "data/raw/mobile_de.parquet",
+]
+MANIFEST_TABLE = "ingest_manifest"
+UNIQUE_VIEW = "cars_unique"  # по одному объявлению на машину (vehicle_id) в каждой паре группа/источник
+# Пустое отношение с полной схемой: столбцы, которых нет в части файлов, заполняются NULL
+SCHEMA_SQL = (
+    "SELECT NULL::VARCHAR AS url, NULL::VARCHAR AS title, NULL::BIGINT AS price_eur, "
+    "NULL::BIGINT AS mileage_km, NULL::BIGINT AS year, NULL::BIGINT AS num_owners, "
+    "NULL::VARCHAR AS source, NULL::VARCHAR AS search_group, NULL::DATE AS scrape_date, "
+    "NULL::TIMESTAMPTZ AS scraped_at WHERE false"
+)
+CAR_COLUMNS = ["url", "title", "price_eur", "mileage_km", "year", "num_owners",
+               "source", "search_group", "scrape_date", "scraped_at"]
+# В cars объявление — (source_code, listing_id) из URL (listing_ids); сам URL — в словаре listing_urls
+STORED_COLUMNS = [c for c in CAR_COLUMNS if c != "url"]
+INGEST_ROWS = "ingest_rows"  # временная таблица: строки новых файлов с уже извлеченными ID
+
+
+def _partition_dirs(directory, key, values=None):
+    """Подкаталоги key=<значение> каталога: только указанные значения или все."""
+    if values is not None:
+        return [os.path.join(directory, f"{key}={partition_value(v)}") for v in values]
+    return sorted(glob.glob(os.path.join(glob.escape(directory), f"{key}=*")))
+
+
+def partition_files(directory, sources=None, search_groups=None, since=None):
+    """
+    Parquet-файлы разбиения source=/search_group=[/scrape_date=] с отсечением разделов по пути:
+    каталоги других источников, групп и дат раньше `since` (date) даже не просматриваются.
+    """
+    files = []
+    for source_dir in _partition_dirs(directory, "source", sources):
+        for group_dir in _partition_dirs(source_dir, "search_group", search_groups):
+            date_dirs = _partition_dirs(group_dir, "scrape_date")
+            if not date_dirs:
+                date_dirs = [group_dir]  # crawls: без разбиения по дате
+            elif since is not None:
+                date_dirs = [d for d in date_dirs if d.rsplit("=", 1)[1] >= since.isoformat()]
+            for date_dir in date_dirs:
+                files += sorted(glob.glob(os.path.join(glob.escape(date_dir), "*.parquet")))
+    return files
+
+
+def source_files(dataset_dir=DATASET_DIR, legacy_files=LEGACY_PARQUET_FILES, **partitions):
+    """Parquet-файлы с данными: (файлы датасета в разделах `partitions`, см. partition_files; старые файлы)."""
+    return partition_files(dataset_dir, **partitions), [f for f in legacy_files if os.path.exists(f)]
+
+
+def side_files_sql(files, columns, empty_sql):
+    """SQL для столбцов `columns` служебных файлов (touches, crawls) с hive-разбиением; без файлов — empty_sql."""
+    if not files:
+        return empty_sql
+    return (f"SELECT {columns} FROM read_parquet({list(files)}, hive_partitioning = true, "
+            "hive_types = {'source': VARCHAR, 'search_group': VARCHAR})")
+
+
+def files_sql(dataset_files, legacy_files):
+    """SQL для строк из указанных файлов; столбцы source / search_group / scrape_date датасета берутся из путей."""
+    parts = [SCHEMA_SQL]
+    if dataset_files:
+        parts.append(
+            f"SELECT * FROM read_parquet({list(dataset_files)}, hive_partitioning = true, "
+            "hive_types = {'source': VARCHAR, 'search_group': VARCHAR, 'scrape_date': DATE})"
+        )
+    if legacy_files:
+        parts.append(f"SELECT * FROM read_parquet({list(legacy_files)}, union_by_name = true)")
+    return " UNION ALL BY NAME ".join(parts)
 
-@st.cache_data(ttl=3600) # Кешируем результат на 1 час
-def load_all_data(force_reload: bool = False):
+
+def file_hash(path, chunk_size=1 << 20):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def ensure_schema(con):
+    """Создает таблицу объявлений и манифест загруженных файлов; старую схему cars пересобирает."""
+    columns = {row[0] for row in con.execute(
+        "SELECT column_name FROM information_schema.columns WHERE table_name = ?", [TABLE_NAME]
+    ).fetchall()}
+    kind = con.execute(
+        "SELECT table_type FROM information_schema.tables WHERE table_name = ?", [TABLE_NAME]
+    ).fetchone()
+    if kind and (kind[0] != "BASE TABLE" or "listing_id" not in columns):
+        # cars из прежних версий (таблица без ключа или представление) — загружаем всё заново
+        con.execute(f"DROP {'VIEW' if kind[0] == 'VIEW' else 'TABLE'} {TABLE_NAME}")
+        con.execute(f"DROP TABLE IF EXISTS {MANIFEST_TABLE}")
+        con.execute(f"DROP TABLE IF EXISTS {HISTORY_TABLE}")
+        con.execute(f"DROP TABLE IF EXISTS {STATS_TABLE}")
+        con.execute(f"DROP TABLE IF EXISTS {CHEAPEST_TABLE}")
+        con.execute(f"DROP TABLE IF EXISTS {SKETCH_TABLE}")
+        con.execute(f"DROP TABLE IF EXISTS {FAIR_PRICE_TABLE}")
+        con.execute(f"DROP TABLE IF EXISTS {VEHICLES_TABLE}")
+        con.execute(f"DROP TABLE IF EXISTS {URLS_TABLE}")
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {TABLE_NAME} (
+            source_code UTINYINT NOT NULL,
+            listing_id BIGINT NOT NULL,
+            title VARCHAR,
+            price_eur BIGINT, mileage_km BIGINT, year BIGINT, num_owners BIGINT,
+            source VARCHAR, search_group VARCHAR NOT NULL,
+            scrape_date DATE, scraped_at TIMESTAMPTZ,
+            PRIMARY KEY (search_group, source_code, listing_id)
+        )
+    """)
+    ensure_url_schema(con)
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {MANIFEST_TABLE} (
+            path VARCHAR PRIMARY KEY,
+            size BIGINT, mtime DOUBLE, hash VARCHAR,
+            ingested_at TIMESTAMPTZ
+        )
+    """)
+    ensure_history_schema(con)
+    # склейка по прежним правилам dedup пересобирается вместе с агрегатами, как в старой базе
+    drop_outdated_vehicles(con)
+    existing = {row[0] for row in con.execute(
+        "SELECT table_name FROM information_schema.tables WHERE table_name IN (?, ?, ?, ?)",
+        [STATS_TABLE, VEHICLES_TABLE, SKETCH_TABLE, FAIR_PRICE_TABLE],
+    ).fetchall()}
+    ensure_vehicle_schema(con)
+    if VEHICLES_TABLE not in existing:
+        # база из прежней версии: дубликаты ищутся один раз по всем объявлениям
+        assign_vehicle_ids(con, TABLE_NAME, VALID_ROWS_SQL, f"SELECT source_code, listing_id FROM {TABLE_NAME}")
+    # Из повторов одной машины остается последняя увиденная версия; URL подставляется
+    # из словаря уже после отбора строк
+    con.execute(f"""
+        CREATE OR REPLACE VIEW {UNIQUE_VIEW} AS
+        SELECT c.*, u.url
+        FROM (
+            SELECT c.*, coalesce(v.vehicle_id, {packed_key_sql("c")}) AS vehicle_id
+            FROM {TABLE_NAME} c LEFT JOIN {VEHICLES_TABLE} v USING (source_code, listing_id)
+            QUALIFY row_number() OVER (
+                PARTITION BY c.search_group, c.source, coalesce(v.vehicle_id, {packed_key_sql("c")})
+                ORDER BY c.scraped_at DESC NULLS LAST, c.source_code, c.listing_id
+            ) = 1
+        ) c
+        LEFT JOIN {URLS_TABLE} u USING (source_code, listing_id)
+    """)
+    ensure_aggregate_schema(con)
+    if not existing >= {STATS_TABLE, VEHICLES_TABLE, SKETCH_TABLE}:
+        # агрегаты считаются один раз по всей таблице
+        refresh_aggregates(con, UNIQUE_VIEW, VALID_ROWS_SQL)
+    if not existing >= {VEHICLES_TABLE, FAIR_PRICE_TABLE}:
+        refresh_fair_prices(con, UNIQUE_VIEW, VALID_ROWS_SQL)
+
+
+def ingest_new_files(con, sources=None, search_groups=None, since=None):
     """
-    Загружает данные из Parquet в постоянную базу данных DuckDB.
-    Если таблица в БД уже существует, читает из нее, если не указана принудительная перезагрузка.
+    Загружает в cars только новые и измененные parquet-файлы (по манифесту: путь, размер, mtime, хэш).
+    Строки сливаются upsert'ом по (search_group, код сайта, ID объявления); более старая версия
+    объявления (по scraped_at) не затирает более новую. Изменения цены/пробега дописываются
+    в историю (price_history); туда же идут объявления, увиденные без изменений (touches),
+    и снятия с продажи по полным обходам групп (crawls), cars они не меняют. Новые объявления сверяются с похожими на повторы (dedup),
+    агрегаты и справедливые цены затронутых групп пересчитываются (aggregates, fair_price). Возвращает (число файлов, число строк).
+    Фильтры (None — все) ограничивают просмотр разделами датасета: источники, группы и даты скрапинга не раньше since.
     """
-    os.makedirs(os.path.dirname(DB_FILE), exist_ok=True)
-    con = duckdb.connect(database=DB_FILE, read_only=False)
+    ensure_schema(con)
+    manifest = {row[0]: row[1:] for row in con.execute(
+        f"SELECT path, size, mtime, hash FROM {MANIFEST_TABLE}").fetchall()}
+
+    partitions = {"sources": sources, "search_groups": search_groups}
+    dataset_files, legacy_files = source_files(since=since, **partitions)
+    touch_files = partition_files(TOUCHES_DIR, since=since, **partitions)
+    crawl_files = partition_files(CRAWLS_DIR, **partitions)
+    changed = []
+    for path in dataset_files + legacy_files + touch_files + crawl_files:
+        st_ = os.stat(path)
+        known = manifest.get(path)
+        if known and known[0] == st_.st_size and known[1] == st_.st_mtime:
+            continue
+        digest = file_hash(path)
+        if known and known[2] == digest:
+            # файл только "потрогали" — данные те же
+            con.execute(f"UPDATE {MANIFEST_TABLE} SET mtime = ? WHERE path = ?", [st_.st_mtime, path])
+            continue
+        changed.append((path, st_.st_size, st_.st_mtime, digest))
+    if not changed:
+        return 0, 0
 
+    paths = {c[0] for c in changed}
+    rows_sql = files_sql([f for f in dataset_files if f in paths], [f for f in legacy_files if f in paths])
+    touches_sql = side_files_sql(
+        [f for f in touch_files if f in paths], "url, search_group, scraped_at",
+        "SELECT NULL::VARCHAR AS url, NULL::VARCHAR AS search_group, NULL::TIMESTAMPTZ AS scraped_at WHERE false")
+    crawls_sql = side_files_sql(
+        [f for f in crawl_files if f in paths], "source, search_group, started_at",
+        "SELECT NULL::VARCHAR AS source, NULL::VARCHAR AS search_group, NULL::TIMESTAMPTZ AS started_at WHERE false")
+    touch_rows_sql = f"""
+        SELECT search_group, {SOURCE_CODE_SQL} AS source_code, {LISTING_ID_SQL} AS listing_id, scraped_at AS seen_at
+        FROM ({touches_sql}) WHERE url IS NOT NULL
+    """
+    columns = ", ".join(STORED_COLUMNS)
+    updates = ", ".join(f"{c} = excluded.{c}" for c in STORED_COLUMNS if c != "search_group")
+    con.execute("BEGIN TRANSACTION")
     try:
-        if force_reload:
-            con.execute(f"DROP TABLE IF EXISTS {TABLE_NAME}")
-            st.info(f"Принудительное обновление: таблица '{TABLE_NAME}' будет создана заново.")
-
-        # Проверяем, существует ли таблица
-        tables = con.execute(f"SELECT table_name FROM information_schema.tables WHERE table_name = '{TABLE_NAME}'").fetchall()
-        
-        if not tables:
-            st.info(f"Таблица '{TABLE_NAME}' не найдена. Загрузка данных из Parquet файлов...")
-            
-            parquet_files = [
-                "data/raw/polovni_automobili.parquet",
-                "data/raw/mobile_de.parquet"
-            ]
-            
-            existing_files = [f for f in parquet_files if os.path.exists(f)]
-
-            for f in parquet_files:
-                if not os.path.exists(f):
-                    source_name = os.path.basename(f).replace('.parquet', '')
-                    st.warning(f"Файл с данными для источника '{source_name}' не найден: {f}")
-
-            if not existing_files:
-                st.error("Не найдены Parquet файлы для загрузки.")
-                return None
-
-            # Важно: в SQL запросе SELECT должен быть в скобках при использовании CREATE TABLE AS
-            read_parquet_query = f"SELECT *, regexp_replace(filename, '.*[\\/]([^\\/]+)\.parquet', '\\1') AS source FROM read_parquet({existing_files})"
-            
-            try:
-                con.execute(f"CREATE TABLE {TABLE_NAME} AS ({read_parquet_query})")
-                st.success(f"Данные успешно загружены в таблицу '{TABLE_NAME}' в файле '{DB_FILE}'.")
-            except Exception as e:
-                st.error(f"Ошибка при создании таблицы из Parquet файлов: {e}")
-                return None
-
-        # Читаем данные из постоянной таблицы
-        combined_df = con.execute(f"SELECT * FROM {TABLE_NAME}").fetchdf()
+        # Нормализация: ID из URL извлекаются один раз, дальше все ключи — целые числа
+        con.execute(f"""
+            CREATE OR REPLACE TEMP TABLE {INGEST_ROWS} AS
+            SELECT {SOURCE_CODE_SQL} AS source_code, {LISTING_ID_SQL} AS listing_id, *
+            FROM ({rows_sql})
+            WHERE url IS NOT NULL AND search_group IS NOT NULL
+        """)
+        inserted = con.execute(f"""
+            INSERT INTO {TABLE_NAME} (source_code, listing_id, {columns})
+            SELECT source_code, listing_id, {columns}
+            FROM {INGEST_ROWS}
+            QUALIFY row_number() OVER (
+                PARTITION BY search_group, source_code, listing_id ORDER BY scraped_at DESC NULLS LAST
+            ) = 1
+            ON CONFLICT (search_group, source_code, listing_id) DO UPDATE SET {updates}
+            WHERE {TABLE_NAME}.scraped_at IS NULL
+               OR (excluded.scraped_at IS NOT NULL AND excluded.scraped_at >= {TABLE_NAME}.scraped_at)
+        """).fetchone()[0]
+        con.execute(f"""
+            INSERT INTO {URLS_TABLE}
+            SELECT source_code, listing_id, first(url ORDER BY scraped_at DESC NULLS LAST)
+            FROM {INGEST_ROWS} GROUP BY source_code, listing_id
+            ON CONFLICT (source_code, listing_id) DO UPDATE SET url = excluded.url
+        """)
+        # Строки старых файлов без времени скрапинга считаем увиденными в момент загрузки;
+        # объявления без изменений (touches) только продлевают last_seen_at текущей версии
+        record_history(con, f"""
+            SELECT search_group, source_code, listing_id, price_eur, mileage_km,
+                   coalesce(scraped_at, CAST(scrape_date AS TIMESTAMPTZ), now()) AS seen_at, '{LISTED}' AS status
+            FROM {INGEST_ROWS}
+            WHERE price_eur IS NOT NULL
+            UNION ALL
+            {touch_observations_sql(touch_rows_sql)}
+        """)
+        # После полного обхода группы объявления, которых в нем не было, сняты с продажи
+        record_history(con, absence_observations_sql(crawls_sql))
+        changed_keys = assign_vehicle_ids(con, TABLE_NAME, VALID_ROWS_SQL,
+                                          f"SELECT source_code, listing_id FROM {INGEST_ROWS}")
+        # Склейка дубликатов меняет и группы, в которые не пришло новых файлов
+        con.register("dedup_changed", pd.DataFrame({"listing_key": changed_keys}, dtype="int64"))
+        touched_sql = f"""
+            SELECT DISTINCT search_group, source FROM {INGEST_ROWS}
+            UNION
+            SELECT DISTINCT search_group, source FROM {TABLE_NAME}
+            WHERE {packed_key_sql()} IN (SELECT listing_key FROM dedup_changed)
+        """
+        refresh_aggregates(con, UNIQUE_VIEW, VALID_ROWS_SQL, touched_sql=touched_sql)
+        # Модель справедливой цены общая для всех источников группы — переобучается вся группа
+        refresh_fair_prices(con, UNIQUE_VIEW, VALID_ROWS_SQL, touched_groups_sql=touched_sql)
+        con.unregister("dedup_changed")
+        con.execute(f"DROP TABLE {INGEST_ROWS}")
+        bump_data_version(con)
+        con.executemany(
+            f"INSERT OR REPLACE INTO {MANIFEST_TABLE} VALUES (?, ?, ?, ?, now())", changed,
+        )
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+    return len(changed), inserted
+
+
+# Столбцы, которые отдаются приложению; строки без цены/пробега/года/названия отсекаются в SQL
+CARS_SELECT_SQL = f"""
+    SELECT url, title, price_eur, mileage_km, year,
+           num_owners, source, search_group, scrape_date, scraped_at, vehicle_id
+    FROM {UNIQUE_VIEW}
+"""
+VALID_ROWS_SQL = "price_eur IS NOT NULL AND mileage_km IS NOT NULL AND year IS NOT NULL AND title IS NOT NULL"
+# Компактный кадр: повторяющиеся строки — категории, целые — узкие типы
+CATEGORY_COLUMNS = ["source", "search_group"]
+NARROW_INT_TYPES = {"price_eur": pa.int32(), "mileage_km": pa.int32(), "year": pa.int16(), "num_owners": pa.int16()}
+
+
+def _pandas_type(arrow_type):
+    """url/title stay Arrow strings (no Python objects per row); nullable ints keep their width."""
+    if arrow_type == pa.string():
+        return pd.StringDtype("pyarrow")
+    if arrow_type == pa.int16():
+        return pd.Int16Dtype()
+    return None
+
+
+def to_compact_frame(table):
+    """
+    Arrow table -> pandas with dictionary-encoded (categorical) source / search_group,
+    int32/int16 numbers and a categorical comparison_group built from the category codes.
+    """
+    for name, arrow_type in NARROW_INT_TYPES.items():
+        table = table.set_column(table.schema.get_field_index(name), name, table[name].cast(arrow_type))
+    for name in CATEGORY_COLUMNS:
+        table = table.set_column(table.schema.get_field_index(name), name, pc.dictionary_encode(table[name]))
+    df = table.to_pandas(types_mapper=_pandas_type, date_as_object=False)
+    for name in CATEGORY_COLUMNS:
+        df[name] = df[name].cat.set_categories(sorted(df[name].cat.categories))
+    # price/mileage/year не бывают NULL (VALID_ROWS_SQL) — обычные numpy-типы, а не nullable
+    for name in ("price_eur", "mileage_km", "year"):
+        df[name] = df[name].astype(NARROW_INT_TYPES[name].to_pandas_dtype())
+
+    groups, sources = df["search_group"].cat, df["source"].cat
+    n_sources = len(sources.categories)
+    codes = np.where((groups.codes < 0) | (sources.codes < 0), -1,
+                     groups.codes.astype(np.int32) * n_sources + sources.codes)
+    categories = [f"{g} ({s})" for g in groups.categories for s in sources.categories]
+    df["comparison_group"] = pd.Categorical.from_codes(codes, categories).remove_unused_categories()
+    return df
+
+
+def _in_clause(column, values, where, params):
+    """Adds `column IN (?, ...)`; an empty selection matches nothing, None means no filter."""
+    if values is None:
+        return
+    values = list(values)
+    if not values:
+        where.append("false")
+        return
+    where.append(f"{column} IN ({', '.join('?' * len(values))})")
+    params += values
+
+
+def _range_clause(column, value_range, where, params):
+    if value_range is None:
+        return
+    where.append(f"{column} BETWEEN ? AND ?")
+    params += [value_range[0], value_range[1]]
+
+
+def build_cars_query(sources=None, search_groups=None, year_range=None, km_range=None, since=None):
+    """Parameterized SQL for the listings matching the sidebar selections. Returns (sql, params)."""
+    where, params = [VALID_ROWS_SQL], []
+    _in_clause("source", sources, where, params)
+    _in_clause("search_group", search_groups, where, params)
+    _range_clause("year", year_range, where, params)
+    _range_clause("mileage_km", km_range, where, params)
+    if since is not None:
+        where.append("scrape_date >= ?")
+        params.append(since)
+    return f"{CARS_SELECT_SQL} WHERE {' AND '.join(where)}", params
+
+
+INGEST_INTERVAL = 60  # секунд: как часто фоновый поток проверяет, не появились ли новые файлы
+_ingest_state = {"thread": None, "error": None}
+_ingest_lock = threading.Lock()
+_first_ingest = threading.Event()
+_schema_ready = set()
+
+
+def get_db():
+    """The process-wide connection manager, with the cars schema in place."""
+    db = get_database(DB_FILE)
+    if db.path not in _schema_ready:
+        with db.writer() as con:
+            ensure_schema(con)
+        _schema_ready.add(db.path)
+    return db
 
+
+def _ingest(db, **partitions):
+    """One ingest pass through the single writer (limited to `partitions`, see ingest_new_files); (files, rows) or None on error."""
+    try:
+        with db.writer() as con:
+            # Дочитываем только новые/измененные файлы — обычно это миллисекунды
+            result = ingest_new_files(con, **partitions)
     except Exception as e:
-        st.error(f"Ошибка при работе с DuckDB: {e}")
+        _ingest_state["error"] = e
         return None
-    finally:
-        con.close()
+    _ingest_state["error"] = None
+    return result
+
+
+def _ingest_loop(db):
+    while True:
+        _ingest(db)
+        _first_ingest.set()
+        time.sleep(INGEST_INTERVAL)
+
+
+def _start_ingest_thread(db):
+    """Starts the process-wide background ingest once; every INGEST_INTERVAL it loads new files."""
+    with _ingest_lock:
+        if _ingest_state["thread"] is None:
+            thread = threading.Thread(target=_ingest_loop, args=(db,), name="ingest", daemon=True)
+            thread.start()
+            _ingest_state["thread"] = thread
 
 
-    if combined_df.empty:
+def refresh_data(force: bool = False, **partitions):
+    """
+    Возвращает текущую версию данных — ключ кэша для get_filter_bounds / query_cars.
+    Новые parquet-файлы дочитывает один фоновый поток на процесс (раз в INGEST_INTERVAL):
+    сессии дашборда только читают data_version() и никогда не ждут загрузку, кроме первого
+    прохода после старта процесса. force (кнопка в боковой панели) загружает сразу в этой сессии;
+    partitions (sources, search_groups, since) ограничивают такую загрузку разделами датасета.
+    """
+    db = get_db()
+    _start_ingest_thread(db)
+    if force:
+        for f in LEGACY_PARQUET_FILES + [DATASET_DIR]:
+            if not os.path.exists(f):
+                st.warning(f"Данные не найдены: {f}")
+        result = _ingest(db, **partitions)
+        if result is not None:
+            files, rows = result
+            st.info(f"Загружено новых файлов: {files}, обновлено объявлений: {rows}." if files else "Новых данных нет.")
+    else:
+        _first_ingest.wait()
+    if _ingest_state["error"] is not None:
+        st.error(f"Ошибка при загрузке данных в DuckDB: {_ingest_state['error']}")
+    return db.data_version()
+
+
+@st.cache_data(max_entries=8)
+def get_filter_bounds(data_version: int):
+    """
+    Значения для фильтров боковой панели: списки источников и групп,
+    диапазоны годов и пробега. Считается одним агрегирующим запросом, без выгрузки строк.
+    Кэш действует, пока не изменится data_version (см. refresh_data).
+    Возвращает None, если данных нет.
+    """
+    try:
+        with get_db().reader() as con:
+            row = con.execute(f"""
+                SELECT list(DISTINCT source ORDER BY source), list(DISTINCT search_group ORDER BY search_group),
+                       min(year), max(year), min(mileage_km), max(mileage_km), count(*)
+                FROM {UNIQUE_VIEW} WHERE {VALID_ROWS_SQL}
+            """).fetchone()
+    except Exception as e:
+        st.error(f"Ошибка при работе с DuckDB: {e}")
+        return None
+
+    sources, groups, min_year, max_year, min_km, max_km, count = row
+    if not count:
         st.warning("База данных пуста.")
         return None
+    return {
+        "sources": sources,
+        "search_groups": groups,
+        "year": (int(min_year), int(max_year)),
+        "mileage_km": (int(min_km), int(max_km)),
+        "count": count,
+    }
+
+
+@st.cache_data(max_entries=64)
+def query_cars(data_version: int, sources=None, search_groups=None, year_range=None, km_range=None, since=None):
+    """
+    Возвращает только объявления, подходящие под фильтры (None — без фильтра).
+    Фильтры передаются в DuckDB параметрами запроса; кэш привязан к data_version.
+    """
+    sql, params = build_cars_query(sources, search_groups, year_range, km_range, since)
+    try:
+        with get_db().reader() as con:
+            return to_compact_frame(con.execute(sql, params).to_arrow_table())
+    except Exception as e:
+        st.error(f"Ошибка при работе с DuckDB: {e}")
+        return None
+
+
+def filters_cover_all(bounds, year_range, km_range):
+    return tuple(year_range) == tuple(bounds["year"]) and tuple(km_range) == tuple(bounds["mileage_km"])
+
+
+@st.cache_data(max_entries=64)
+def load_top_deals(data_version: int, sources, search_groups, year_range, km_range, km_bounds, k=2):
+    """
+    Самые дешевые k объявлений по группам пробега из материализованных агрегатов,
+    в том же виде, что analysis.get_top_deals. None, если фильтр пробега не совпадает
+    с границами корзин — тогда нужно считать по строкам.
+    """
+    if not km_range_aligned(km_range, km_bounds):
+        return None
+    try:
+        with get_db().reader() as con:
+            table = cheapest_listings(con, sources, search_groups, year_range, km_range, k=k)
+    except Exception as e:
+        st.error(f"Ошибка при работе с DuckDB: {e}")
+        return None
+    bins = table["mileage_bin"].to_pylist()
+    df = to_compact_frame(table.drop_columns(["mileage_bin"]))
+    # категории по началу корзины, а не по алфавиту подписей ("100 - 150" раньше "50 - 100")
+    labels = {b: mileage_bin_label(b) for b in sorted(set(bins))}
+    df["mileage_bin"] = pd.Categorical([labels[b] for b in bins], categories=list(labels.values()), ordered=True)
+    return df
+
+
+@st.cache_data(max_entries=64)
+def load_price_statistics(data_version: int, search_group, sources):
+    """Статистика цен группы по источникам из агрегатов (как analysis.calculate_price_statistics без фильтров)."""
+    try:
+        with get_db().reader() as con:
+            stats = price_statistics(con, search_group, sources)
+    except Exception as e:
+        st.error(f"Ошибка при работе с DuckDB: {e}")
+        return None
+    return stats if not stats.empty else None
 
-    # Обработка данных
-    combined_df = combined_df.dropna(subset=["price_eur", "mileage_km", "year", "title"]).copy()
-    for col, dtype in {"price_eur": int, "mileage_km": int, "year": int}.items():
-        combined_df[col] = combined_df[col].astype(dtype)
-    
-    if 'search_group' not in combined_df.columns:
-        combined_df['search_group'] = 'Default'
 
-    combined_df['comparison_group'] = combined_df['search_group'] + " (" + combined_df['source'] + ")"
-    
-    return combined_df
+@st.cache_data(max_entries=64)
+def load_underpriced(data_version: int, search_group, sources, year_range, km_range, limit=50):
+    """Самые недооцененные объявления группы (цена ниже справедливой по модели) в пределах фильтров."""
+    try:
+        with get_db().reader() as con:
+            table = most_underpriced(con, TABLE_NAME, search_group, list(sources), year_range, km_range, limit)
+    except Exception as e:
+        st.error(f"Ошибка при работе с DuckDB: {e}")
+        return None
+    return to_compact_frame(table)
+
+
+def load_all_data(force_reload: bool = False, sources=None, search_groups=None, since=None):
+    """
+    Загружает последние версии всех объявлений (для скриптов и отчетов); since (date) — скрапленные не раньше.
+    С force_reload дочитываются только разделы датасета этих источников, групп и дат.
+    Приложение использует get_filter_bounds и query_cars, чтобы не держать весь датасет в памяти.
+    """
+    version = refresh_data(force=force_reload, sources=sources, search_groups=search_groups, since=since)
+    if get_filter_bounds(version) is None:
+        return None
+    return query_cars(version, sources=sources, search_groups=search_groups, since=since)
 
 
 def get_car_search_config():
@@ -90,4 +557,103 @@ def get_car_search_config():
             "Volvo XC60": "https://suchen.mobile.de/fahrzeuge/search.html?dam=0&isSearchRequest=true&ms=25100%3B31%3B%3B&pageNumber=1&ref=dsp&s=Car&sb=rel&vc=Car",
             "Audi A4": "https://suchen.mobile.de/fahrzeuge/search.html?dam=0&isSearchRequest=true&ms=1900%3B9%3B%3B&pageNumber=1&ref=dsp&s=Car&sb=rel&vc=Car"
         }
-    }
\ No newline at end of file
+    }
+
+
+if __name__ == "__main__":
+    # Самопроверка на временной базе: страница, повторенная из кэша (CACHE_MODE = "replay")
+    # после более свежей загрузки, не затирает новую цену и не добавляет версию в историю;
+    # touches продлевают last_seen_at, полный обход без объявления снимает его, новое появление — возвращает;
+    # загрузка с фильтрами не просматривает чужие разделы, DatasetWriter удаляет брошенные .inprogress.
+    import tempfile
+    from datetime import datetime, timedelta, timezone
+
+    from src.dataset import TOUCH_SCHEMA, DatasetWriter, record_crawl, stamp_fetched_at
+
+    os.chdir(tempfile.mkdtemp())
+    url = "https://www.polovniautomobili.com/auto-oglasi/123456/volvo-xc60"
+    card = {"url": url, "title": "Volvo XC60 D4", "mileage_km": 150_000, "year": 2017, "num_owners": 1}
+    newer = datetime.now(timezone.utc)
+    older = newer - timedelta(days=3)
+
+    writer = DatasetWriter("polovni_automobili")
+    writer.write("Volvo XC60", [dict(card, price_eur=18_000, scraped_at=newer)])
+    writer.close()
+    assert _ingest(get_db()) == (1, 1), _ingest_state["error"]
+
+    writer = DatasetWriter("polovni_automobili")
+    writer.write("Volvo XC60", stamp_fetched_at([dict(card, price_eur=21_000)], older.timestamp()))
+    writer.close()
+    files, _ = _ingest(get_db())
+
+    with get_db().reader() as con:
+        price, scrape_date = con.execute(f"SELECT price_eur, scrape_date FROM {TABLE_NAME}").fetchone()
+        versions = con.execute(f"SELECT price_eur FROM {HISTORY_TABLE}").fetchall()
+    assert files == 1 and price == 18_000 and scrape_date == newer.date(), (files, price, scrape_date)
+    assert versions == [(18_000,)], versions
+    print("replayed snapshot kept its fetch time: cars and price_history keep the newer price")
+
+    touched_at = newer + timedelta(hours=1)
+    writer = DatasetWriter("polovni_automobili", directory=TOUCHES_DIR, schema=TOUCH_SCHEMA)
+    writer.write("Volvo XC60", [{"url": url, "scraped_at": touched_at}])
+    writer.close()
+    _ingest(get_db())
+    record_crawl("polovni_automobili", "Volvo XC60", newer + timedelta(hours=2))
+    _ingest(get_db())
+    writer = DatasetWriter("polovni_automobili")
+    writer.write("Volvo XC60", [dict(card, price_eur=18_000, scraped_at=newer + timedelta(hours=3))])
+    writer.close()
+    _ingest(get_db())
+
+    with get_db().reader() as con:
+        versions = con.execute(f"SELECT status, valid_from, last_seen_at FROM {HISTORY_TABLE} ORDER BY valid_from").fetchall()
+        scraped_at = con.execute(f"SELECT scraped_at FROM {TABLE_NAME}").fetchone()[0]
+    assert [v[0] for v in versions] == ["listed", "delisted", "listed"], versions
+    assert versions[0][2] == touched_at and versions[1][1] == newer + timedelta(hours=2), versions
+    assert scraped_at == newer + timedelta(hours=3), scraped_at
+    print("touch extended last_seen_at, the full crawl delisted the listing, the next scrape relisted it")
+
+    writer = DatasetWriter("mobile.de")
+    writer.write("Audi A4", [dict(card, url="https://suchen.mobile.de/fahrzeuge/details.html?id=987654",
+                                  title="Audi A4 Avant", price_eur=20_000, scraped_at=newer)])
+    writer.close()
+    mobile_files = partition_files(DATASET_DIR, sources=["mobile.de"])
+    assert len(mobile_files) == 1 and os.sep + "source=mobile.de" + os.sep in mobile_files[0], mobile_files
+    assert not partition_files(DATASET_DIR, search_groups=["Volvo XC60"], sources=["mobile.de"])
+    recent = partition_files(DATASET_DIR, since=newer.date())
+    assert recent and not any(f"scrape_date={older.date()}" in f for f in recent), recent
+    assert _ingest(get_db(), search_groups=["Volvo XC60"]) == (0, 0)  # файл Audi A4 не просматривается
+    assert _ingest(get_db(), sources=["mobile.de"], search_groups=["Audi A4"]) == (1, 1)
+    print("partition filters pruned the scan to the requested source, group and dates")
+
+    partition_dir = os.path.dirname(mobile_files[0])
+    stale, fresh = (os.path.join(partition_dir, f"part-{run}.parquet.inprogress") for run in ("crashed", "running"))
+    for path in (stale, fresh):
+        open(path, "wb").close()
+    os.utime(stale, (time.time() - 2 * 86400,) * 2)
+    assert DatasetWriter("mobile.de").removed_stale == [stale] and os.path.exists(fresh)
+    print("stale .inprogress files were removed on DatasetWriter startup, a fresh one was kept")
+
+    # Равные цены: агрегаты и get_top_deals выбирают и упорядочивают одни и те же объявления
+    # (пробег, затем URL), корзины пробега идут по числу, а не по алфавиту подписи
+    writer = DatasetWriter("polovni_automobili")
+    writer.write("Volvo XC90", [
+        dict(card, url=f"https://www.polovniautomobili.com/auto-oglasi/{700 + i}/volvo-xc90",
+             title=f"Volvo XC90 D5 #{i}", year=2015 + i, price_eur=price, mileage_km=km, scraped_at=newer)
+        for i, (price, km) in enumerate([(15_000, 40_000), (15_000, 30_000), (15_000, 30_000), (14_000, 60_000),
+                                         (12_000, 120_000), (12_000, 110_000), (12_000, 110_000)])
+    ])
+    writer.close()
+    _ingest(get_db())
+    version = get_db().data_version()
+    filters = (("polovni_automobili",), ("Volvo XC90",))
+    bounds = get_filter_bounds(version)
+    from_aggregates = load_top_deals(version, *filters, bounds["year"], bounds["mileage_km"], bounds["mileage_km"])
+    from_rows = get_top_deals(query_cars(version, *filters, bounds["year"], bounds["mileage_km"]))
+    for column in ("url", "price_eur", "mileage_km"):
+        assert from_aggregates[column].tolist() == from_rows[column].tolist(), (from_aggregates, from_rows)
+    assert from_aggregates["url"].str.split("/").str[-2].tolist() == ["701", "702", "703", "705", "706"], from_aggregates["url"]
+    for df in (from_aggregates, from_rows):
+        assert df["mileage_bin"].cat.ordered and df["mileage_bin"].cat.categories.tolist() == [
+            mileage_bin_label(0), mileage_bin_label(50_000), mileage_bin_label(100_000)], df["mileage_bin"]
+    print("top deals with tied prices match between aggregates and rows, mileage bins in numeric order")
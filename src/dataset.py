@@ -0,0 +1,151 @@
+# dataset.py
+# Потоковая запись объявлений в Parquet-датасет с hive-разбиением:
+#   data/dataset/source=<источник>/search_group=<группа>/scrape_date=<YYYY-MM-DD>/part-<run>.parquet
+# Строки каждой страницы сразу уходят в буфер, буфер сбрасывается в файл группами строк
+# (row group), поэтому память не растет с размером поиска, а прошлые запуски не перезаписываются.
+# Рядом пишутся служебные файлы для истории объявлений (price_history):
+#   data/touches/... — URL и время объявлений, увиденных без изменений в инкрементальном режиме;
+#   data/crawls/source=.../search_group=.../crawl-<run>.parquet — начало каждого полного обхода группы.
+import glob
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+DATASET_DIR = "data/dataset"
+TOUCHES_DIR = "data/touches"
+CRAWLS_DIR = "data/crawls"
+ROW_GROUP_ROWS = 5000
+STALE_INPROGRESS_AGE = 6 * 3600  # секунд: .inprogress, который столько не дописывался, — остаток упавшего запуска
+
+SCHEMA = pa.schema([
+    ("url", pa.string()),
+    ("title", pa.string()),
+    ("price_eur", pa.int64()),
+    ("mileage_km", pa.int64()),
+    ("year", pa.int64()),
+    ("num_owners", pa.int64()),
+    ("scraped_at", pa.timestamp("us", tz="UTC")),
+])
+TOUCH_SCHEMA = pa.schema([("url", pa.string()), ("scraped_at", pa.timestamp("us", tz="UTC"))])
+CRAWL_SCHEMA = pa.schema([("started_at", pa.timestamp("us", tz="UTC"))])
+
+
+def partition_value(value):
+    """Directory-safe value for a hive partition key."""
+    return str(value).replace("/", "-").replace(os.sep, "-")
+
+
+def stamp_fetched_at(cards, fetched_at):
+    """Marks cards parsed from a cached page with the time the page was fetched (unix time)."""
+    scraped_at = datetime.fromtimestamp(fetched_at, timezone.utc)
+    for card in cards:
+        card["scraped_at"] = scraped_at
+    return cards
+
+
+def record_crawl(source, search_group, started_at, directory=CRAWLS_DIR):
+    """
+    Marks a complete crawl of a search group: every result page was read, so listings of the
+    group not seen since `started_at` are no longer listed. Call after the rows are published.
+    """
+    path = os.path.join(directory, f"source={partition_value(source)}",
+                        f"search_group={partition_value(search_group)}", f"crawl-{uuid.uuid4().hex[:12]}.parquet")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pq.write_table(pa.Table.from_pylist([{"started_at": started_at}], schema=CRAWL_SCHEMA), path + ".inprogress")
+    os.replace(path + ".inprogress", path)
+
+
+def remove_stale_inprogress(directory, max_age=STALE_INPROGRESS_AGE):
+    """Deletes `.inprogress` files under `directory` not modified for `max_age` seconds; returns their paths."""
+    cutoff = time.time() - max_age
+    removed = []
+    for path in glob.glob(os.path.join(glob.escape(directory), "**", "*.inprogress"), recursive=True):
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed.append(path)
+        except FileNotFoundError:
+            pass  # файл опубликовал или удалил другой процесс
+    if removed:
+        print(f"Removed {len(removed)} stale .inprogress files left by crashed runs under {directory}")
+    return removed
+
+
+class DatasetWriter:
+    """
+    Appends rows of one scraper run to the partitioned dataset, one file per
+    (search_group, scrape_date) partition. Rows are stamped with the time they were written,
+    unless a card already carries `scraped_at` (pages replayed from the HTML cache keep their
+    fetch time, see stamp_fetched_at). Files are written under a temporary name and renamed
+    on close(), so readers never see a file without its Parquet footer. Thread-safe.
+    With directory=TOUCHES_DIR and schema=TOUCH_SCHEMA it writes the seen-touches instead.
+    On startup it deletes the source's `.inprogress` files not written to for STALE_INPROGRESS_AGE:
+    a crashed run never publishes them, and without a footer they cannot be read.
+    """
+
+    def __init__(self, source, directory=DATASET_DIR, row_group_rows=ROW_GROUP_ROWS, schema=SCHEMA):
+        self.source = source
+        self.directory = directory
+        self.schema = schema
+        self.row_group_rows = row_group_rows
+        self.run_id = uuid.uuid4().hex[:12]
+        self.rows_written = 0
+        self._buffers = {}
+        self._writers = {}
+        self._lock = threading.Lock()
+        self.removed_stale = remove_stale_inprogress(os.path.join(directory, f"source={partition_value(source)}"))
+
+    def _path(self, partition):
+        search_group, scrape_date = partition
+        return os.path.join(
+            self.directory,
+            f"source={partition_value(self.source)}",
+            f"search_group={partition_value(search_group)}",
+            f"scrape_date={scrape_date}",
+            f"part-{self.run_id}.parquet",
+        )
+
+    def write(self, search_group, cards):
+        """Buffers the cards of one page; a row group is written once enough rows are buffered."""
+        if not cards:
+            return
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            for card in cards:
+                row = {name: card.get(name) for name in self.schema.names}
+                row["scraped_at"] = row["scraped_at"] or now
+                partition = (search_group, row["scraped_at"].date().isoformat())
+                buffer = self._buffers.setdefault(partition, [])
+                buffer.append(row)
+                if len(buffer) >= self.row_group_rows:
+                    self._flush(partition)
+
+    def _flush(self, partition):
+        buffer = self._buffers.pop(partition, [])
+        if not buffer:
+            return
+        writer = self._writers.get(partition)
+        if writer is None:
+            path = self._path(partition)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            writer = pq.ParquetWriter(path + ".inprogress", self.schema)
+            self._writers[partition] = writer
+        writer.write_table(pa.Table.from_pylist(buffer, schema=self.schema), row_group_size=self.row_group_rows)
+        self.rows_written += len(buffer)
+
+    def close(self):
+        """Flushes the remaining rows and publishes the finished files."""
+        with self._lock:
+            for partition in list(self._buffers):
+                self._flush(partition)
+            for partition, writer in self._writers.items():
+                writer.close()
+                path = self._path(partition)
+                os.replace(path + ".inprogress", path)
+            self._writers.clear()
+        return self.rows_written
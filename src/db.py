@@ -0,0 +1,80 @@
+# db.py
+# Доступ к data/cars.duckdb: одно долгоживущее соединение-писатель (загрузка файлов)
+# и пул читающих соединений для сессий дашборда. Читатели — курсоры той же базы:
+# каждый запрос видит согласованный снимок (MVCC) и не ждет, пока идет запись.
+import os
+import queue
+import threading
+from contextlib import contextmanager
+
+import duckdb
+
+DB_FILE = "data/cars.duckdb"
+READER_POOL_SIZE = 4
+VERSION_TABLE = "data_version"
+
+
+class Database:
+    """
+    One DuckDB database per process: a single writer serialized by a lock and a
+    pool of reader connections. data_version() is bumped by every write that
+    changes data, so callers can use it as a cache key.
+    """
+
+    def __init__(self, path=DB_FILE, pool_size=READER_POOL_SIZE):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self._writer = duckdb.connect(database=path, read_only=False)
+        self._write_lock = threading.Lock()
+        self._readers = queue.LifoQueue(maxsize=pool_size)
+        self._writer.execute(f"CREATE TABLE IF NOT EXISTS {VERSION_TABLE} (version BIGINT NOT NULL)")
+        if self._writer.execute(f"SELECT count(*) FROM {VERSION_TABLE}").fetchone()[0] == 0:
+            self._writer.execute(f"INSERT INTO {VERSION_TABLE} VALUES (0)")
+
+    @contextmanager
+    def writer(self):
+        """The only read-write connection; one writer at a time."""
+        with self._write_lock:
+            yield self._writer
+
+    @contextmanager
+    def reader(self):
+        """A pooled connection for queries; never waits for the writer."""
+        try:
+            con = self._readers.get_nowait()
+        except queue.Empty:
+            con = self._writer.cursor()
+        try:
+            yield con
+        finally:
+            try:
+                self._readers.put_nowait(con)
+            except queue.Full:
+                con.close()
+
+    def data_version(self):
+        with self.reader() as con:
+            return con.execute(f"SELECT version FROM {VERSION_TABLE}").fetchone()[0]
+
+    def close(self):
+        while not self._readers.empty():
+            self._readers.get_nowait().close()
+        with self._write_lock:
+            self._writer.close()
+
+
+def bump_data_version(con):
+    """Increments the data version; call inside the write transaction that changed data."""
+    con.execute(f"UPDATE {VERSION_TABLE} SET version = version + 1")
+
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+
+def get_database(path=DB_FILE):
+    """The process-wide Database for `path` (DuckDB allows one read-write opener per file)."""
+    with _databases_lock:
+        if path not in _databases:
+            _databases[path] = Database(path)
+        return _databases[path]
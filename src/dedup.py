@@ -0,0 +1,328 @@
+# dedup.py
+# Поиск повторно выложенных и кросс-листинговых объявлений (одна машина под разными URL
+# или на обоих сайтах). Кандидаты ищутся только внутри блоков (год + логарифмическая корзина
+# пробега в двух сдвинутых сетках + ценовой диапазон) и только среди ближайших соседей по цене —
+# без сравнения всех со всеми.
+# Пары с похожими названиями склеиваются union-find'ом в кластеры со стабильным vehicle_id.
+import math
+import re
+import time
+
+import numpy as np
+import pandas as pd
+
+from src.listing_ids import ID_BITS, packed_key_sql
+
+VEHICLES_TABLE = "vehicles"  # (source_code, listing_id) -> vehicle_id
+DEDUP_RULES = 3               # версия правил склейки (в комментарии таблицы); при изменении — пересборка
+
+KM_OFFSET = 2000                  # пробег сравнивается в ln(km + KM_OFFSET)
+KM_TOLERANCE = 0.002              # макс. разница в этой шкале: ~200 км на 100 тыс. км, ~45 км на 20 тыс.
+PRICE_TOLERANCE = math.log(1.15)  # цены отличаются не больше чем на 15%
+PRICE_WINDOW = 8                  # сколько соседей по цене внутри блока сравниваем
+TITLE_THRESHOLD = 0.6             # мин. сходство названий (Жаккар по токенам; между сайтами — вложенность)
+MIN_CONTAINMENT_TOKENS = 3        # вложенность между сайтами — только при стольких общих токенах, иначе Жаккар
+MIN_MILEAGE_KM = 1000             # новые/демо машины одного дилера неотличимы — не склеиваем
+BUCKET_WIDTH = 2 * KM_TOLERANCE   # пары в пределах допуска всегда попадают в общий блок одной из сеток
+
+_TOKEN_RE = re.compile(r"[a-z]+|\d+")
+# Коды мотора/версии: B5, T8, D5, B5D, "B5 (D)" (Volvo), 220d, 300 e (Mercedes), 40 TDI, 45 TFSI (Audi)
+_VARIANT_RE = re.compile(r"\b([a-z]\d{1,2})(?:\s?d)?\b|\b(\d{2,3})\s?(d|e|i|tdi|tfsi|tsi|cdi)\b")
+# Комплектации: Plus/Ultra Bright/Dark, Inscription, R-Design (Volvo), S line, Advanced (Audi), Avantgarde (Mercedes);
+# без общих слов вроде sport/design — они встречаются и в списках оснащения
+_TRIM_SPELLINGS = re.compile(r"\b(r|s)[\s-]?(design|line)\b")
+TRIM_WORDS = frozenset({
+    "core", "plus", "ultra", "ultimate", "bright", "dark", "kinetic", "momentum", "summum", "inscription",
+    "rdesign", "sline", "advanced", "avantgarde", "elegance", "progressive",
+})
+
+
+def ensure_vehicle_schema(con):
+    created = not con.execute(
+        "SELECT count(*) FROM duckdb_tables() WHERE table_name = ?", [VEHICLES_TABLE]
+    ).fetchone()[0]
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {VEHICLES_TABLE} (
+            source_code UTINYINT NOT NULL,
+            listing_id BIGINT NOT NULL,
+            vehicle_id BIGINT NOT NULL,
+            PRIMARY KEY (source_code, listing_id)
+        )
+    """)
+    if created:
+        con.execute(f"COMMENT ON TABLE {VEHICLES_TABLE} IS 'rules {DEDUP_RULES}'")
+
+
+def drop_outdated_vehicles(con):
+    """Drops the vehicles table if it was clustered with older DEDUP_RULES (the caller rebuilds it)."""
+    comment = con.execute(
+        "SELECT comment FROM duckdb_tables() WHERE table_name = ?", [VEHICLES_TABLE]
+    ).fetchone()
+    if comment is not None and comment[0] != f"rules {DEDUP_RULES}":
+        con.execute(f"DROP TABLE {VEHICLES_TABLE}")
+
+
+def block_sql(grid):
+    """SQL for the mileage bucket of `grid` (0 or 1, shifted by half a bucket)."""
+    shift = 0.5 * grid
+    return f"floor(ln(mileage_km + {KM_OFFSET}) / {BUCKET_WIDTH} + {shift})::BIGINT"
+
+
+def price_band_sql():
+    """SQL for the price band: PRICE_TOLERANCE wide, so candidates are in the same or a neighbouring band."""
+    return f"floor(ln(greatest(price_eur, 1)) / {PRICE_TOLERANCE})::BIGINT"
+
+
+def title_tokens(title):
+    return frozenset(_TOKEN_RE.findall(str(title).lower()))
+
+
+def variant_tokens(title):
+    """Engine/variant codes of a title, normalized ("B5 (D)" and "b5d" -> "b5", "40 TDI" -> "40tdi")."""
+    return frozenset(m.group(1) or m.group(2) + m.group(3) for m in _VARIANT_RE.finditer(str(title).lower()))
+
+
+def trim_tokens(title):
+    """Trim words of a title, normalized ("R-Design" and "r design" -> "rdesign", "S line" -> "sline")."""
+    return frozenset(_TOKEN_RE.findall(_TRIM_SPELLINGS.sub(r"\1\2", str(title).lower()))) & TRIM_WORDS
+
+
+def candidate_pairs(df, grid):
+    """
+    Sorted-neighbourhood candidates in one blocking grid: rows sorted by (year, bucket, price)
+    are compared with the next PRICE_WINDOW rows of the same block. Returns index arrays (i, j).
+    """
+    km = np.log(df["mileage_km"].to_numpy(dtype=float) + KM_OFFSET)
+    price = np.log(df["price_eur"].to_numpy(dtype=float))
+    bucket = np.floor(km / BUCKET_WIDTH + 0.5 * grid).astype(np.int64)
+    year = df["year"].to_numpy(dtype=np.int64)
+    order = np.lexsort((price, bucket, year))
+    km, price, bucket, year = km[order], price[order], bucket[order], year[order]
+    eligible = df["mileage_km"].to_numpy()[order] >= MIN_MILEAGE_KM
+
+    left, right = [], []
+    for offset in range(1, PRICE_WINDOW + 1):
+        if offset >= len(order):
+            break
+        a, b = slice(0, -offset), slice(offset, None)
+        ok = ((year[a] == year[b]) & (bucket[a] == bucket[b])
+              & (np.abs(km[a] - km[b]) <= KM_TOLERANCE)
+              & (price[b] - price[a] <= PRICE_TOLERANCE)
+              & eligible[a] & eligible[b])
+        idx = np.nonzero(ok)[0]
+        left.append(order[idx])
+        right.append(order[idx + offset])
+    if not left:
+        return np.empty(0, np.int64), np.empty(0, np.int64)
+    return np.concatenate(left), np.concatenate(right)
+
+
+def similar_titles(a, b, same_source=True):
+    """
+    Jaccard similarity of two token sets. Across sites titles are written differently
+    (short on one, with equipment lists on the other), so there the overlap with the shorter title
+    counts, but only once the titles share MIN_CONTAINMENT_TOKENS tokens: a short title is not
+    contained in every long one that repeats its one or two words.
+    """
+    if not a or not b:
+        return 1.0 if a == b else 0.0
+    common = len(a & b)
+    if same_source or common < MIN_CONTAINMENT_TOKENS:
+        return common / (len(a) + len(b) - common)
+    return common / min(len(a), len(b))
+
+
+def find_duplicate_pairs(df, only=None):
+    """
+    Pairs of row positions in `df` (title, search_group, source, price_eur, mileage_km, year) that look
+    like the same vehicle. Title tokens of the search group name (brand, model) are ignored;
+    when both titles name an engine/variant code (B5, T8, 220d, ...) or a trim (Plus, Ultra,
+    Inscription, S line, ...), those must agree.
+    With a boolean mask `only`, pairs between two rows outside it are skipped.
+    """
+    group_tokens = {g: title_tokens(g) for g in df["search_group"].unique()}
+    tokens = [title_tokens(t) - group_tokens[g] for t, g in zip(df["title"], df["search_group"])]
+    group_variants = {g: variant_tokens(g) for g in group_tokens}
+    variants = [variant_tokens(t) - group_variants[g] for t, g in zip(df["title"], df["search_group"])]
+    trims = [trim_tokens(t) for t in df["title"]]
+    sources = df["source"].tolist()
+
+    left, right = [], []
+    for grid in (0, 1):
+        i, j = candidate_pairs(df, grid)
+        left.append(np.minimum(i, j))
+        right.append(np.maximum(i, j))
+    # пара, попавшая в общий блок обеих сеток, проверяется один раз
+    codes = np.unique(np.concatenate(left) * len(df) + np.concatenate(right))
+    left, right = codes // len(df), codes % len(df)
+    if only is not None:
+        keep = only[left] | only[right]
+        left, right = left[keep], right[keep]
+    # разные коды мотора (B5 и T8) или комплектации (Plus и Ultra) — разные машины,
+    # как бы ни совпадали остальные слова
+    return [(i, j) for i, j in zip(left.tolist(), right.tolist())
+            if not (variants[i] and variants[j] and variants[i] != variants[j])
+            and not (trims[i] and trims[j] and trims[i] != trims[j])
+            and similar_titles(tokens[i], tokens[j], sources[i] == sources[j]) >= TITLE_THRESHOLD]
+
+
+class UnionFind:
+    def __init__(self, n):
+        self.parent = list(range(n))
+
+    def find(self, x):
+        root = x
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[x] != root:
+            self.parent[x], x = root, self.parent[x]
+        return root
+
+    def union(self, a, b):
+        ra, rb = self.find(a), self.find(b)
+        if ra != rb:
+            self.parent[max(ra, rb)] = min(ra, rb)
+
+
+def assign_vehicle_ids(con, cars_table, valid_rows_sql, touched_keys_sql):
+    """
+    Clusters the listings (source_code, listing_id) from `touched_keys_sql` with every listing
+    in their blocks and stores vehicle_id per listing. Clusters only grow: a cluster keeps the
+    smallest vehicle_id among its members, a new cluster gets the smallest listing_key of its members.
+    Returns the listing_keys (see listing_ids) whose vehicle_id changed. Run it inside the ingest transaction.
+    """
+    ensure_vehicle_schema(con)
+    df = con.execute(f"""
+        WITH touched AS (
+            SELECT DISTINCT source_code, listing_id FROM ({touched_keys_sql})
+        ),
+        listings AS (
+            SELECT source_code, listing_id, any_value(title) AS title, any_value(price_eur) AS price_eur,
+                   any_value(mileage_km) AS mileage_km, any_value(year) AS year,
+                   any_value(search_group) AS search_group, any_value(source) AS source
+            FROM {cars_table} WHERE {valid_rows_sql}
+            GROUP BY source_code, listing_id
+        ),
+        blocked AS (
+            SELECT l.*, t.listing_id IS NOT NULL AS touched,
+                   {block_sql(0)} AS b0, {block_sql(1)} AS b1, {price_band_sql()} AS band
+            FROM listings l
+            LEFT JOIN touched t ON t.source_code = l.source_code AND t.listing_id = l.listing_id
+        ),
+        touched_blocks AS (
+            SELECT DISTINCT year, b0, b1, band + d AS band
+            FROM blocked, unnest([-1, 0, 1]) AS shift(d) WHERE touched
+        ),
+        nearby AS (
+            SELECT b.* FROM blocked b
+            WHERE (year, b0, band) IN (SELECT (year, b0, band) FROM touched_blocks)
+               OR (year, b1, band) IN (SELECT (year, b1, band) FROM touched_blocks)
+        )
+        SELECT {packed_key_sql("n")} AS listing_key, n.title, n.search_group, n.source,
+               n.price_eur, n.mileage_km, n.year, n.touched, coalesce(v.vehicle_id, -1) AS vehicle_id
+        FROM nearby n LEFT JOIN {VEHICLES_TABLE} v USING (source_code, listing_id)
+    """).fetchdf()
+    if df.empty:
+        return []
+
+    uf = UnionFind(len(df))
+    first_with_id = {}
+    for pos, vehicle_id in enumerate(df["vehicle_id"].tolist()):
+        if vehicle_id >= 0:
+            uf.union(first_with_id.setdefault(vehicle_id, pos), pos)
+    for i, j in find_duplicate_pairs(df, only=df["touched"].to_numpy()):
+        uf.union(i, j)
+
+    members = {}
+    for pos in range(len(df)):
+        members.setdefault(uf.find(pos), []).append(pos)
+
+    keys, ids = df["listing_key"].tolist(), df["vehicle_id"].tolist()
+    changed, merged = {}, {}
+    for positions in members.values():
+        existing = sorted({ids[p] for p in positions if ids[p] >= 0})
+        winner = existing[0] if existing else min(keys[p] for p in positions)
+        for loser in existing[1:]:
+            merged[loser] = winner
+        for p in positions:
+            if ids[p] != winner:
+                changed[keys[p]] = winner
+
+    # Листинги вне загруженных блоков, чьи кластеры слились с другими
+    if merged:
+        outside = con.execute(
+            f"SELECT {packed_key_sql()}, vehicle_id FROM {VEHICLES_TABLE} "
+            f"WHERE vehicle_id IN ({', '.join('?' * len(merged))})",
+            list(merged),
+        ).fetchall()
+        for key, vehicle_id in outside:
+            changed.setdefault(key, merged[vehicle_id])
+
+    if changed:
+        updates = pd.DataFrame({"listing_key": list(changed), "vehicle_id": list(changed.values())}, dtype="int64")
+        con.register("vehicle_updates", updates)
+        con.execute(f"""
+            INSERT INTO {VEHICLES_TABLE}
+            SELECT (listing_key >> {ID_BITS})::UTINYINT, listing_key & {(1 << ID_BITS) - 1}, vehicle_id
+            FROM vehicle_updates
+            ON CONFLICT (source_code, listing_id) DO UPDATE SET vehicle_id = excluded.vehicle_id
+        """)
+        con.unregister("vehicle_updates")
+    return list(changed)
+
+
+if __name__ == "__main__":
+    # Самопроверка правил склейки на парах названий и бенчмарк поиска пар + union-find на 1M объявлений
+    def pairs(title_a, title_b, source_b="mobile.de"):
+        df = pd.DataFrame({
+            "title": [title_a, title_b], "search_group": "Volvo XC60", "source": ["polovni_automobili", source_b],
+            "price_eur": [30_000, 30_500], "mileage_km": [90_000, 90_050], "year": 2021,
+        })
+        return find_duplicate_pairs(df)
+
+    same = [("Volvo XC60 T8 Ultra Bright", "Volvo XC60 T8 Recharge AWD Ultra Bright 455 PS Pano Leder"),
+            ("Volvo XC60 B5 (D) Inscription", "Volvo XC60 B5D AWD Inscription Geartronic"),
+            ("Volvo XC60 D4 R-Design", "Volvo XC60 D4 R Design AWD Automatik")]
+    different = [("Volvo XC60 T8 Ultra Bright", "Volvo XC60 T8 Plus Bright"),
+                 ("Volvo XC60 B5 Plus Dark", "Volvo XC60 B5 Plus Bright"),
+                 ("Volvo XC60 D4 Momentum", "Volvo XC60 D4 Inscription"),
+                 ("Volvo XC60 D4 R-Design", "Volvo XC60 D4 Inscription Pro AWD Navi")]
+    for title_a, title_b in same:
+        assert pairs(title_a, title_b) == [(0, 1)], (title_a, title_b)
+    for title_a, title_b in different:
+        assert pairs(title_a, title_b) == [] and pairs(title_a, title_b, "polovni_automobili") == [], (title_a, title_b)
+    # короткое название не "вложено" в любое длинное с теми же одним-двумя словами
+    assert similar_titles(title_tokens("T8"), title_tokens("T8 AWD Pano Leder Navi ACC"), same_source=False) < TITLE_THRESHOLD
+    print(f"{len(same)} cross-site duplicates matched, {len(different)} trim/variant pairs kept apart")
+
+    rng = np.random.default_rng(0)
+    n, copies = 1_000_000, 100_000
+    trims = ["Momentum", "Inscription", "R-Design", "Core", "Plus Bright", "Plus Dark", "Ultra Bright", "Ultimate"]
+    engines = ["B4", "B5", "D4", "D5", "T5", "T6", "T8"]
+    cars = pd.DataFrame({
+        "title": [f"Volvo XC60 {e} {t} AWD" for e, t in zip(rng.choice(engines, n), rng.choice(trims, n))],
+        "search_group": "Volvo XC60",
+        "source": rng.choice(["polovni_automobili", "mobile.de"], n),
+        "price_eur": rng.integers(10_000, 80_000, n),
+        "mileage_km": rng.integers(1_000, 300_000, n),
+        "year": rng.integers(2012, 2025, n),
+    })
+    # перевыложенные копии: то же название, пробег +0..50 км, цена до -5%; при 56 названиях часть
+    # случайных объявлений тоже неотличима (год, пробег и цена в допусках) и склеивается
+    original = rng.choice(n, copies, replace=False)
+    reposts = cars.iloc[original].assign(
+        mileage_km=lambda d: d["mileage_km"] + rng.integers(0, 50, copies),
+        price_eur=lambda d: (d["price_eur"] * rng.uniform(0.95, 1.0, copies)).astype(np.int64))
+    cars = pd.concat([cars, reposts], ignore_index=True)
+
+    t0 = time.perf_counter()
+    found = find_duplicate_pairs(cars)
+    t1 = time.perf_counter()
+    uf = UnionFind(len(cars))
+    for i, j in found:
+        uf.union(i, j)
+    roots = [uf.find(pos) for pos in range(len(cars))]
+    t2 = time.perf_counter()
+    recalled = sum(roots[i] == roots[n + k] for k, i in enumerate(original.tolist())) / copies
+    print(f"{len(cars):,} listings: {len(found):,} duplicate pairs in {t1 - t0:.2f} s, "
+          f"union-find into {len(set(roots)):,} vehicles in {t2 - t1:.2f} s; {recalled:.1%} of reposts merged")
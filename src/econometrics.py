@@ -1,14 +1,24 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
 import plotly.graph_objects as go
 import plotly.express as px
 import numpy as np
 import statsmodels.api as sm
 import pandas as pd
-from datetime import datetime
-import statsmodels.formula.api as smf
+from scipy import stats
+
+from src.analysis import quantile_corridors
+from src.fair_price import fit_ols, hedonic_design
+from src.trends import price_trend
 
-def create_quantile_lowess_plot(df):
+def create_quantile_lowess_plot(df, corridors=None, trend_method="binned"):
     """
-    Creates a scatter plot with quantile corridors and a LOWESS trend line for each market.
+    Creates a scatter plot with mileage-conditional quantile corridors and a LOWESS trend line
+    for each market. corridors (analysis.quantile_corridors by source) are computed from df if not given;
+    trend_method is one of trends.TREND_METHODS.
     """
     fig = go.Figure()
 
@@ -20,31 +30,34 @@ def create_quantile_lowess_plot(df):
     colors = px.colors.qualitative.Plotly
     color_map = {market: colors[i % len(colors)] for i, market in enumerate(markets)}
 
-    # Quantile corridors (calculated on the whole dataset)
-    quantiles = [0.1, 0.25, 0.75, 0.9]
-    quantile_labels = {0.1: "10% / 90%", 0.9: "10% / 90%", 0.25: "25% / 75%", 0.75: "25% / 75%"}
-    added_quantile_legends = set()
-
-    for q in quantiles:
-        price_quantile = df['price_eur'].quantile(q)
-        fig.add_shape(
-            type="line",
-            x0=df['mileage_km'].min(),
-            y0=price_quantile,
-            x1=df['mileage_km'].max(),
-            y1=price_quantile,
-            line=dict(color="rgba(255, 255, 255, 0.2)", width=1, dash="dash"),
-        )
-        # Add a dummy trace for the legend, only once per pair
-        label = quantile_labels[q]
-        if label not in added_quantile_legends:
+    # Quantile corridors: 10/25/75/90% of the price at each mileage, per market, in one pass
+    if corridors is None:
+        corridors = quantile_corridors(df, by='source')
+    corridor_styles = {"p10": "dot", "p90": "dot", "p25": "dash", "p75": "dash"}
+    for label, dash in (("10% / 90%", "dot"), ("25% / 75%", "dash")):
+        # Dummy traces for the legend, one per pair
+        fig.add_trace(go.Scatter(
+            x=[None], y=[None],
+            mode='lines',
+            line=dict(color="rgba(255, 255, 255, 0.4)", width=1, dash=dash),
+            name=label
+        ))
+    mileage_range = df.groupby('source', observed=True)['mileage_km'].agg(['min', 'max'])
+    for market, curve in corridors.groupby('source', observed=True):
+        if market not in color_map:
+            continue
+        # Flat beyond the first and last bin, up to the market's mileage range
+        x = np.r_[mileage_range.loc[market, 'min'], curve['mileage_km'], mileage_range.loc[market, 'max']]
+        for column, dash in corridor_styles.items():
+            y = curve[column].to_numpy()
             fig.add_trace(go.Scatter(
-                x=[None], y=[None],
+                x=x, y=np.r_[y[0], y, y[-1]],
                 mode='lines',
-                line=dict(color="rgba(255, 255, 255, 0.4)", width=1, dash="dash"),
-                name=label
+                line=dict(color=color_map[market], width=1, dash=dash),
+                opacity=0.6,
+                showlegend=False,
+                hoverinfo='skip'
             ))
-            added_quantile_legends.add(label)
 
     # Plot LOWESS and scatter for each market
     for market in markets:
@@ -52,16 +65,16 @@ def create_quantile_lowess_plot(df):
         if market_df.empty or market_df.shape[0] < 2: # Need at least 2 points for a line
             continue
 
-        # LOWESS trend
+        # LOWESS trend on a fixed grid (binned by default: fast on tens of thousands of points)
         try:
-            lowess = sm.nonparametric.lowess
-            trend = lowess(market_df['price_eur'], market_df['mileage_km'], frac=0.5)
+            trend_x, trend_y = price_trend(market_df['mileage_km'], market_df['price_eur'],
+                                           method=trend_method, frac=0.5)
         except Exception:
             continue # Skip if LOWESS fails for any reason
 
         fig.add_trace(go.Scatter(
-            x=trend[:, 0],
-            y=trend[:, 1],
+            x=trend_x,
+            y=trend_y,
             mode='lines',
             name=f'Тренд {market}',
             line=dict(color=color_map[market], width=4) # Made line thicker
@@ -91,45 +104,135 @@ def create_quantile_lowess_plot(df):
 
     return fig
 
+# Гедонистическая модель: МНК прямо на numpy-массивах, результаты кэшируются по отпечатку
+# строк и спецификации — повторные запуски Streamlit и экспорт отчета модель не переобучают.
+# statsmodels нужен только для полного текстового отчета (HedonicResults.summary).
+HEDONIC_FORMULA = "log_price ~ mileage_km + I(mileage_km**2) + age + market dummies"
+HEDONIC_CACHE_SIZE = 8  # LRU: результаты хранят матрицу плана для summary(), поэтому немного
+_hedonic_cache = OrderedDict()
+_hedonic_cache_lock = threading.Lock()  # кэш общий для потоков всех сессий Streamlit
+
+
+@dataclass(frozen=True, eq=False)
+class HedonicResults:
+    """Compact OLS results of the hedonic model; `params` etc. are indexed like the statsmodels fit."""
+    params: pd.Series
+    bse: pd.Series
+    tvalues: pd.Series
+    pvalues: pd.Series
+    nobs: int
+    df_model: int
+    df_resid: int
+    rsquared: float
+    rsquared_adj: float
+    fvalue: float
+    f_pvalue: float
+    llf: float
+    aic: float
+    bic: float
+    diagnostics: dict
+    reference_market: str
+    exog: np.ndarray
+    endog: np.ndarray
+
+    def conf_int(self, alpha=0.05):
+        q = stats.t.ppf(1 - alpha / 2, self.df_resid)
+        return pd.DataFrame({"[0.025": self.params - q * self.bse, "0.975]": self.params + q * self.bse})
+
+    def coefficient_table(self):
+        """Coefficients in the layout of the statsmodels summary table."""
+        table = pd.DataFrame({"coef": self.params, "std err": self.bse, "t": self.tvalues, "P>|t|": self.pvalues})
+        return table.join(self.conf_int())
+
+    def fit_statistics(self):
+        return {
+            "Dep. Variable": "log_price", "Model": "OLS", "Method": "Least Squares",
+            "No. Observations": self.nobs, "Df Residuals": self.df_resid, "Df Model": self.df_model,
+            "R-squared": self.rsquared, "Adj. R-squared": self.rsquared_adj,
+            "F-statistic": self.fvalue, "Prob (F-statistic)": self.f_pvalue,
+            "Log-Likelihood": self.llf, "AIC": self.aic, "BIC": self.bic,
+        }
+
+    def summary(self):
+        """The full statsmodels summary (refits with statsmodels; use only for the detailed view)."""
+        exog = pd.DataFrame(self.exog, columns=self.params.index)
+        return sm.OLS(pd.Series(self.endog, name="log_price"), exog).fit().summary()
+
+
+def fit_hedonic(X, y, names, reference_market):
+    """OLS with standard errors and the diagnostics of the statsmodels summary, on numpy arrays."""
+    n, k = X.shape
+    beta = fit_ols(X, y)
+    resid = y - X @ beta
+    ssr = float(resid @ resid)
+    centered = y - y.mean()
+    tss = float(centered @ centered)
+    df_model, df_resid = k - 1, n - k
+    scale = np.abs(X).max(axis=0)
+    scale[scale == 0] = 1.0
+    Xs = X / scale
+    cov = np.linalg.pinv(Xs.T @ Xs) / np.outer(scale, scale) * (ssr / df_resid)
+    bse = np.sqrt(np.diag(cov))
+    tvalues = beta / bse
+    rsquared = 1 - ssr / tss
+    fvalue = (tss - ssr) / df_model / (ssr / df_resid)
+    llf = -n / 2 * (np.log(2 * np.pi * ssr / n) + 1)
+    omnibus = stats.normaltest(resid)
+    jarque_bera = stats.jarque_bera(resid)
+    index = pd.Index(names)
+    return HedonicResults(
+        params=pd.Series(beta, index=index), bse=pd.Series(bse, index=index),
+        tvalues=pd.Series(tvalues, index=index),
+        pvalues=pd.Series(2 * stats.t.sf(np.abs(tvalues), df_resid), index=index),
+        nobs=n, df_model=df_model, df_resid=df_resid,
+        rsquared=rsquared, rsquared_adj=1 - (1 - rsquared) * (n - 1) / df_resid,
+        fvalue=fvalue, f_pvalue=stats.f.sf(fvalue, df_model, df_resid),
+        llf=llf, aic=2 * k - 2 * llf, bic=k * np.log(n) - 2 * llf,
+        diagnostics={
+            "Omnibus": omnibus.statistic, "Prob(Omnibus)": omnibus.pvalue,
+            "Durbin-Watson": float(np.sum(np.diff(resid) ** 2) / ssr),
+            "Jarque-Bera (JB)": jarque_bera.statistic, "Prob(JB)": jarque_bera.pvalue,
+            "Skew": stats.skew(resid), "Kurtosis": stats.kurtosis(resid, fisher=False),
+            "Cond. No.": np.linalg.cond(X),
+        },
+        reference_market=reference_market, exog=X, endog=y,
+    )
+
+
 def run_hedonic_model(df):
     """
     Runs a hedonic regression model to estimate the market premium.
+    Results are memoized (LRU) by a fingerprint of the design matrix, the prices and the spec.
     """
     if df.empty or df.shape[0] < 10:  # Need enough data to run regression
         return None
 
-    df_model = df.copy()
-    df_model['log_price'] = np.log(df_model['price_eur'])
-    df_model['age'] = datetime.now().year - df_model['year']
-    df_model['market'] = pd.Categorical(df_model['source'])
-
+    X, names, reference_market = hedonic_design(df['mileage_km'], df['year'], df['source'].astype(str))
     # Ensure there are at least two markets to compare
-    if len(df_model['market'].cat.categories) < 2:
+    if len(names) <= 4:
         return None
+    y = np.log(df['price_eur'].to_numpy(dtype=np.float64))
+
+    fingerprint = hashlib.sha1(HEDONIC_FORMULA.encode())
+    for part in (X, y, np.asarray(names)):
+        fingerprint.update(np.ascontiguousarray(part).tobytes())
+    key = fingerprint.hexdigest()
+    with _hedonic_cache_lock:
+        if key in _hedonic_cache:
+            _hedonic_cache.move_to_end(key)
+            return _hedonic_cache[key]
 
-    # Create dummy variables manually for more control over names
-    reference_market = df_model['market'].cat.categories[0]
-    dummy_names = []
-    for market_name in df_model['market'].cat.categories[1:]:
-        # Create a clean name for the variable, e.g., "market_polovni_automobili"
-        clean_name = f"market_{market_name}"
-        df_model[clean_name] = (df_model['market'] == market_name).astype(int)
-        dummy_names.append(clean_name)
-
-    # Build the formula string with the new dummy variables
-    if not dummy_names:
-        return None # No markets to compare
-        
-    dummy_vars_str = ' + '.join(dummy_names)
-    formula = f'log_price ~ mileage_km + I(mileage_km**2) + age + {dummy_vars_str}'
-    
     try:
-        model = smf.ols(formula, data=df_model).fit()
-        # Store reference market in the model for later use
-        model.reference_market = reference_market
+        model = fit_hedonic(X, y, names, reference_market)
     except Exception as e:
         # Not enough data for all variables, etc.
         print(f"Could not fit hedonic model: {e}")
         return None
 
-    return model
\ No newline at end of file
+    # Модель считается вне блокировки: другие сессии не ждут чужую регрессию
+    with _hedonic_cache_lock:
+        _hedonic_cache[key] = model
+        _hedonic_cache.move_to_end(key)
+        if len(_hedonic_cache) > HEDONIC_CACHE_SIZE:
+            _hedonic_cache.popitem(last=False)
+    return model
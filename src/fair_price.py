@@ -0,0 +1,132 @@
+# fair_price.py
+# Справедливая цена каждого объявления по гедонической модели группы поиска
+# (как econometrics.run_hedonic_model: log_price ~ mileage_km + mileage_km² + age + рынок)
+# и оценка недооцененности — насколько цена ниже модельной, с учетом года и пробега.
+# Модель переобучается при загрузке только для затронутых групп, оценки хранятся
+# в таблице fair_prices с индексом — "50 самых недооцененных XC90" читается одним запросом.
+from datetime import datetime
+
+import numpy as np
+import pyarrow as pa
+
+from src.listing_ids import URLS_TABLE
+
+FAIR_PRICE_TABLE = "fair_prices"
+MIN_ROWS = 10  # меньше — модель не строится (как в run_hedonic_model)
+
+
+def ensure_fair_price_schema(con):
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {FAIR_PRICE_TABLE} (
+            search_group VARCHAR NOT NULL,
+            source_code UTINYINT NOT NULL,
+            listing_id BIGINT NOT NULL,
+            fair_price_eur DOUBLE,
+            undervaluation DOUBLE      -- ln(справедливая цена) - ln(цена); > 0 — дешевле модели
+        )
+    """)
+    con.execute(f"""
+        CREATE INDEX IF NOT EXISTS {FAIR_PRICE_TABLE}_group_idx
+        ON {FAIR_PRICE_TABLE} (search_group, undervaluation)
+    """)
+
+
+def hedonic_design(mileage_km, year, markets, current_year=None):
+    """
+    Design matrix of the hedonic model with statsmodels-style column names: intercept, mileage_km,
+    mileage_km², age and one dummy per market except the first in sorted order (the reference).
+    Returns (X, names, reference market).
+    """
+    current_year = current_year or datetime.now().year
+    mileage = np.asarray(mileage_km, dtype=np.float64)  # int32 would overflow in mileage_km**2
+    age = current_year - np.asarray(year, dtype=np.float64)
+    categories, codes = np.unique(np.asarray(markets, dtype=str), return_inverse=True)
+    dummies = codes[:, None] == np.arange(1, len(categories))[None, :]
+    X = np.column_stack([np.ones_like(mileage), mileage, mileage ** 2, age, dummies.astype(np.float64)])
+    names = ["Intercept", "mileage_km", "I(mileage_km ** 2)", "age"] + [f"market_{m}" for m in categories[1:]]
+    return X, names, categories[0]
+
+
+def fit_ols(X, y):
+    """OLS coefficients via lstsq; columns are equilibrated first (mileage_km² is ~1e10 times the intercept)."""
+    scale = np.abs(X).max(axis=0)
+    scale[scale == 0] = 1.0
+    beta, *_ = np.linalg.lstsq(X / scale, y, rcond=None)
+    return beta / scale
+
+
+def score_listings(price_eur, mileage_km, year, markets):
+    """(fair price, undervaluation) per row of one search group; None if there is too little data."""
+    X, _, _ = hedonic_design(mileage_km, year, markets)
+    if len(X) < max(MIN_ROWS, X.shape[1] + 1):
+        return None
+    log_price = np.log(np.asarray(price_eur, dtype=np.float64))
+    fitted = X @ fit_ols(X, log_price)
+    return np.exp(fitted), fitted - log_price
+
+
+def refresh_fair_prices(con, cars_table, valid_rows_sql, touched_groups_sql=None):
+    """
+    Refits the model of every search group returned by `touched_groups_sql` (all groups if None)
+    on the rows of `cars_table` and replaces their scores. Run it inside the ingest transaction.
+    """
+    ensure_fair_price_schema(con)
+    if touched_groups_sql is None:
+        touched_groups_sql = f"SELECT DISTINCT search_group FROM {cars_table}"
+    con.execute(f"CREATE OR REPLACE TEMP TABLE fair_touched AS SELECT DISTINCT search_group FROM ({touched_groups_sql})")
+    con.execute(f"DELETE FROM {FAIR_PRICE_TABLE} WHERE search_group IN (SELECT search_group FROM fair_touched)")
+    table = con.execute(f"""
+        SELECT search_group, source_code, listing_id, coalesce(source, '') AS source, price_eur, mileage_km, year
+        FROM {cars_table}
+        WHERE search_group IN (SELECT search_group FROM fair_touched) AND {valid_rows_sql} AND price_eur > 0
+        ORDER BY search_group
+    """).to_arrow_table()
+    con.execute("DROP TABLE fair_touched")
+    if not table.num_rows:
+        return
+
+    groups = table["search_group"].to_numpy(zero_copy_only=False)
+    bounds = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1], True])
+    columns = {c: table[c].to_numpy(zero_copy_only=False) for c in ("source", "price_eur", "mileage_km", "year")}
+    keep, fair, score = [], [], []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        part = {c: values[start:end] for c, values in columns.items()}
+        scored = score_listings(part["price_eur"], part["mileage_km"], part["year"], part["source"])
+        if scored is not None:
+            keep.append(np.arange(start, end))
+            fair.append(scored[0])
+            score.append(scored[1])
+    if not keep:
+        return
+    keep = np.concatenate(keep)
+    scores = pa.table({
+        "search_group": table["search_group"].take(keep),
+        "source_code": table["source_code"].take(keep),
+        "listing_id": table["listing_id"].take(keep),
+        "fair_price_eur": np.concatenate(fair),
+        "undervaluation": np.concatenate(score),
+    })
+    con.register("fair_scores", scores)
+    # Отсортированная вставка: зоны min/max по группе и оценке отсекают лишние блоки при чтении
+    con.execute(f"INSERT INTO {FAIR_PRICE_TABLE} SELECT * FROM fair_scores ORDER BY search_group, undervaluation DESC")
+    con.unregister("fair_scores")
+
+
+def most_underpriced(con, cars_table, search_group, sources, year_range=None, km_range=None, limit=50):
+    """The `limit` listings of a search group priced furthest below the model, as an Arrow table."""
+    params = [search_group] + list(sources)
+    where = ["f.search_group = ?", f"c.source IN ({', '.join('?' * len(sources))})" if sources else "false"]
+    for column, value_range in (("year", year_range), ("mileage_km", km_range)):
+        if value_range is not None:
+            where.append(f"c.{column} BETWEEN ? AND ?")
+            params += list(value_range)
+    return con.execute(f"""
+        SELECT u.url, c.title, c.price_eur, f.fair_price_eur, f.undervaluation,
+               c.mileage_km, c.year, c.num_owners, c.source, c.search_group, c.scrape_date
+        FROM {FAIR_PRICE_TABLE} f
+        JOIN {cars_table} c USING (search_group, source_code, listing_id)
+        LEFT JOIN {URLS_TABLE} u USING (source_code, listing_id)
+        WHERE {' AND '.join(where)}
+        ORDER BY f.undervaluation DESC
+        LIMIT ?
+    """, params + [limit]).to_arrow_table()
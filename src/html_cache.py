@@ -0,0 +1,123 @@
+# html_cache.py
+# Кэш сырых HTML-ответов скраперов.
+# Содержимое хранится сжатым и адресуется по sha256 (одинаковые страницы занимают место один раз),
+# индекс в SQLite связывает URL и время загрузки с хэшем содержимого.
+import gzip
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+CACHE_DIR = "data/cache/html"
+TTL_DAYS = 45                     # записи старше удаляются при evict()
+MAX_BYTES = 2 * 1024 ** 3         # предельный размер сжатых файлов на диске
+
+
+class HtmlCache:
+    """Compressed, content-addressed store of fetched pages keyed by (url, fetched_at)."""
+
+    def __init__(self, directory=CACHE_DIR, ttl_days=TTL_DAYS, max_bytes=MAX_BYTES):
+        self.directory = directory
+        self.ttl_seconds = ttl_days * 24 * 3600
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(directory, "blobs"), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(directory, "index.sqlite"), check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS fetches ("
+            " url TEXT NOT NULL, fetched_at REAL NOT NULL, sha TEXT NOT NULL, size INTEGER NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS fetches_url ON fetches (url, fetched_at)")
+        self._db.commit()
+
+    def _blob_path(self, sha):
+        return os.path.join(self.directory, "blobs", sha[:2], f"{sha}.html.gz")
+
+    def put(self, url, html, fetched_at=None):
+        data = html.encode("utf-8") if isinstance(html, str) else html
+        sha = hashlib.sha256(data).hexdigest()
+        path = self._blob_path(sha)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with gzip.open(tmp_path, "wb", compresslevel=6) as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO fetches (url, fetched_at, sha, size) VALUES (?, ?, ?, ?)",
+                (url, fetched_at or time.time(), sha, os.path.getsize(path)),
+            )
+            self._db.commit()
+        return sha
+
+    def lookup(self, url, as_of=None, since=None):
+        """
+        Latest cached (html, fetched_at) of `url` fetched within [since, as_of] (unix times,
+        None — no bound), or None.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT sha, fetched_at FROM fetches WHERE url = ? AND fetched_at >= ? AND fetched_at <= ? "
+                "ORDER BY fetched_at DESC LIMIT 1",
+                (url, since if since is not None else float("-inf"), as_of if as_of is not None else float("inf")),
+            ).fetchone()
+        if row is None or not os.path.exists(self._blob_path(row[0])):
+            return None
+        with gzip.open(self._blob_path(row[0]), "rb") as f:
+            return f.read().decode("utf-8"), row[1]
+
+    def get(self, url, as_of=None):
+        """Latest cached HTML of `url` fetched at or before `as_of` (unix time), or None."""
+        found = self.lookup(url, as_of=as_of)
+        return found[0] if found is not None else None
+
+    def fetch_times(self, url):
+        """All fetch times of `url`, oldest first — for replaying its history."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT fetched_at FROM fetches WHERE url = ? ORDER BY fetched_at", (url,)
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    def snapshots(self, url, as_of=None):
+        """
+        Replay windows (since, until) of a search, oldest first: every fetch of its first page
+        `url` starts a run, which lasts until the next one (or `as_of`). Pages of a run are
+        looked up with lookup(page_url, as_of=until, since=since).
+        """
+        starts = [t for t in self.fetch_times(url) if as_of is None or t <= as_of]
+        ends = [t - 1e-6 for t in starts[1:]] + [as_of]
+        return list(zip(starts, ends))
+
+    def evict(self):
+        """
+        Drops entries past the TTL, then the least recently fetched ones until the blobs
+        fit in max_bytes. Call it between runs, not while pages are being stored.
+        """
+        with self._lock:
+            self._db.execute("DELETE FROM fetches WHERE fetched_at < ?", (time.time() - self.ttl_seconds,))
+            sizes = self._db.execute(
+                "SELECT sha, MAX(size), MAX(fetched_at) AS last_used FROM fetches "
+                "GROUP BY sha ORDER BY last_used DESC"
+            ).fetchall()
+            keep, total = set(), 0
+            for sha, size, _ in sizes:
+                if total + size > self.max_bytes:
+                    break
+                keep.add(sha)
+                total += size
+            dropped = [sha for sha, _, _ in sizes if sha not in keep]
+            self._db.executemany("DELETE FROM fetches WHERE sha = ?", [(sha,) for sha in dropped])
+            self._db.commit()
+            referenced = keep
+
+        removed = 0
+        blobs_dir = os.path.join(self.directory, "blobs")
+        for prefix in os.listdir(blobs_dir):
+            for name in os.listdir(os.path.join(blobs_dir, prefix)):
+                if name.split(".", 1)[0] not in referenced:
+                    os.remove(os.path.join(blobs_dir, prefix, name))
+                    removed += 1
+        return removed
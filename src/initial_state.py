@@ -0,0 +1,69 @@
+# initial_state.py
+# Извлечение window.__INITIAL_STATE__ со страниц mobile.de без BeautifulSoup:
+# ищем присваивание в сыром HTML и декодируем JSON за один проход raw_decode.
+import html as html_lib
+import json
+import re
+
+_ASSIGNMENT_RE = re.compile(r"window\.__INITIAL_STATE__\s*=\s*")
+_SEARCH_RESULTS_RE = re.compile(r'"searchResults"\s*:\s*')
+_TITLE_RE = re.compile(r"<title[^>]*>(.*?)</title>", re.I | re.S)
+_decoder = json.JSONDecoder()
+
+
+def _as_text(html):
+    if isinstance(html, (bytes, bytearray)):
+        return html.decode("utf-8", errors="replace")
+    return html
+
+
+def find_initial_state(html):
+    """Returns the offset of the JSON value assigned to window.__INITIAL_STATE__, or -1."""
+    m = _ASSIGNMENT_RE.search(_as_text(html))
+    return m.end() if m else -1
+
+
+def page_title(html):
+    m = _TITLE_RE.search(_as_text(html))
+    return html_lib.unescape(m.group(1).strip()) if m else None
+
+
+def extract_initial_state(html):
+    """Decodes the whole __INITIAL_STATE__ object. Returns None if it is missing or malformed."""
+    html = _as_text(html)
+    start = find_initial_state(html)
+    if start == -1:
+        return None
+    try:
+        state, _ = _decoder.raw_decode(html, start)
+    except json.JSONDecodeError:
+        return None
+    return state
+
+
+def extract_search_results(html):
+    """
+    Returns search.srp.data.searchResults from __INITIAL_STATE__, or None.
+
+    When the state contains a single "searchResults" key only that subtree is
+    decoded; otherwise the whole state is decoded and walked.
+    """
+    html = _as_text(html)
+    start = find_initial_state(html)
+    if start == -1:
+        return None
+
+    key = _SEARCH_RESULTS_RE.search(html, start)
+    if key and not _SEARCH_RESULTS_RE.search(html, key.end()):
+        try:
+            results, _ = _decoder.raw_decode(html, key.end())
+            if isinstance(results, dict) and "items" in results:
+                return results
+        except json.JSONDecodeError:
+            pass
+
+    try:
+        state, _ = _decoder.raw_decode(html, start)
+        return state["search"]["srp"]["data"]["searchResults"]
+    except (json.JSONDecodeError, KeyError, TypeError):
+        return None
@@ -0,0 +1,62 @@
+# listing_ids.py
+# Компактные ключи объявлений: вместо URL (~250 байт, с трекинг-параметрами поиска)
+# объявление определяется кодом сайта и числовым ID объявления на сайте.
+# Полный URL хранится один раз в словаре listing_urls (см. data_loader).
+import hashlib
+import re
+from urllib.parse import urlparse, parse_qs
+
+# Код сайта (UTINYINT); 0 — URL без распознанного ID, тогда ID — 56-битный хэш URL без параметров
+SOURCE_CODES = {"polovni_automobili": 1, "mobile.de": 2}
+OTHER_SOURCE_CODE = 0
+URLS_TABLE = "listing_urls"
+ID_BITS = 56  # listing_key = code << ID_BITS | listing_id
+
+_POLOVNI_ID_RE = re.compile(r"/auto-oglasi/(\d+)")
+
+
+def parse_listing_id(url):
+    """(source code, int64 ad ID) of a listing URL; tracking params do not change it."""
+    m = _POLOVNI_ID_RE.search(url)
+    if m:
+        return SOURCE_CODES["polovni_automobili"], int(m.group(1))
+    ad_id = parse_qs(urlparse(url).query).get("id")
+    if ad_id and ad_id[0].isdigit():
+        return SOURCE_CODES["mobile.de"], int(ad_id[0])
+    digest = hashlib.md5(url.split("?", 1)[0].encode("utf-8")).hexdigest()
+    return OTHER_SOURCE_CODE, int(digest[:ID_BITS // 4], 16)
+
+
+def listing_key(url):
+    """Both parts of parse_listing_id packed into one int64, for in-memory sets and dicts."""
+    code, listing_id = parse_listing_id(url)
+    return code << ID_BITS | listing_id
+
+
+# Те же значения в SQL (для строк parquet-файлов с колонкой url)
+SOURCE_CODE_SQL = (
+    "(CASE WHEN regexp_matches(url, '/auto-oglasi/\\d+') THEN 1 "
+    "WHEN regexp_matches(url, '[?&]id=\\d+') THEN 2 ELSE 0 END)::UTINYINT"
+)
+LISTING_ID_SQL = (
+    "coalesce(TRY_CAST(nullif(regexp_extract(url, '/auto-oglasi/(\\d+)', 1), '') AS BIGINT), "
+    "TRY_CAST(nullif(regexp_extract(url, '[?&]id=(\\d+)', 1), '') AS BIGINT), "
+    f"('0x' || left(md5(split_part(url, '?', 1)), {ID_BITS // 4}))::BIGINT)"
+)
+
+
+def packed_key_sql(alias=None):
+    """SQL for listing_key of the (source_code, listing_id) columns of `alias`."""
+    prefix = f"{alias}." if alias else ""
+    return f"({prefix}source_code::BIGINT << {ID_BITS} | {prefix}listing_id)"
+
+
+def ensure_url_schema(con):
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {URLS_TABLE} (
+            source_code UTINYINT NOT NULL,
+            listing_id BIGINT NOT NULL,
+            url VARCHAR NOT NULL,
+            PRIMARY KEY (source_code, listing_id)
+        )
+    """)
@@ -0,0 +1,182 @@
+# parse_polovni.py
+# Парсинг страницы выдачи polovniautomobili.com.
+# Два бэкенда с одинаковым результатом:
+#   "lxml" — прямой обход дерева lxml (быстрый, выбирается по умолчанию);
+#   "bs4"  — исходная реализация на BeautifulSoup (эталон).
+import re
+
+from bs4 import BeautifulSoup
+
+try:
+    import lxml.html
+    from lxml import etree
+except ImportError:  # lxml не установлен — остаётся только bs4
+    lxml = None
+
+BASE = "https://www.polovniautomobili.com"
+
+PARSER_BACKEND = "auto"  # "auto" | "lxml" | "bs4"
+
+TOTAL_RE = re.compile(r"ukupno\s+(\d+)", flags=re.I)
+# Эти теги BeautifulSoup не включает в get_text()
+_SKIP_TEXT_TAGS = {"script", "style", "template"}
+_CLASS_XPATH = ".//{tag}[contains(concat(' ', normalize-space(@class), ' '), ' {cls} ')]"
+
+
+def _make_card(href, title, price_text, km_text, yr_text):
+    """Turns the raw strings of one article into a card dict (shared by all backends)."""
+    if "/auto-oglasi/pretraga" in href:
+        return None
+    if not href.startswith("http"):
+        href = BASE.rstrip("/") + href
+
+    price = None
+    if price_text:
+        pm = re.search(r"([\d\.]+)", price_text)
+        if pm:
+            price = int(re.sub(r"[^\d]", "", pm.group(1)))
+
+    km = None
+    if km_text is not None:
+        km_m = re.search(r"(\d[\d\.\s]*)\s*km", km_text, flags=re.I)
+        if km_m: km = int(re.sub(r"[^\d]", "", km_m.group(1)))
+
+    yr = None
+    if yr_text is not None:
+        yr_m = re.search(r"\b(20\d{2})", yr_text)
+        if yr_m: yr = int(yr_m.group(1))
+
+    # The old model-specific check has been removed to allow any model.
+    return {"url": href, "title": title,
+            "price_eur": price, "mileage_km": km, "year": yr}
+
+
+def parse_cards_bs4(html):
+    soup = BeautifulSoup(html, "lxml")
+    txt = soup.get_text(" ", strip=True)
+    total = None
+    m = TOTAL_RE.search(txt)
+    if m: total = int(m.group(1))
+
+    cards = []
+    for article in soup.select('article.classified'):
+        link_element = article.select_one('a[href*="/auto-oglasi/"]')
+        if not link_element:
+            continue
+
+        title_element = article.select_one('h2 a')
+        km_element = article.select_one('.setInfo:nth-of-type(2) .top')
+        yr_element = article.select_one('.setInfo:nth-of-type(1) .top')
+        card = _make_card(
+            link_element.get("href") or "",
+            title_element.get_text(strip=True) if title_element else '',
+            article.get('data-price'),
+            km_element.get_text(strip=True) if km_element else None,
+            yr_element.get_text(strip=True) if yr_element else None,
+        )
+        if card:
+            cards.append(card)
+    return cards, total
+
+
+def _strings(el):
+    """Text pieces of an lxml element in document order, as BeautifulSoup's get_text() sees them."""
+    # комментарии (tag не строка) и script/style дают только tail, который обходит родитель
+    if not isinstance(el.tag, str) or el.tag in _SKIP_TEXT_TAGS:
+        return
+    if el.text:
+        yield el.text
+    for child in el:
+        yield from _strings(child)
+        if child.tail:
+            yield child.tail
+
+
+def _get_text(el, sep=""):
+    return sep.join(s.strip() for s in _strings(el) if s.strip())
+
+
+def _find_total_lxml(root):
+    # Ищем только узлы с "ukupno", а не весь текст документа
+    nodes = root.xpath(
+        "//text()[contains(translate(., 'UKPNO', 'ukpno'), 'ukupno')]"
+    )
+    for node in nodes:
+        owner = node.getparent()
+        if node.is_tail:
+            owner = owner.getparent()
+        if owner is None or owner.tag in _SKIP_TEXT_TAGS:
+            continue
+        m = TOTAL_RE.search(_get_text(owner, " "))
+        if m:
+            return int(m.group(1))
+    # Число может стоять за пределами родителя — тогда как в bs4, по всему тексту
+    if nodes:
+        m = TOTAL_RE.search(_get_text(root, " "))
+        if m:
+            return int(m.group(1))
+    return None
+
+
+def _nth_of_type(el):
+    return 1 + sum(1 for s in el.itersiblings(preceding=True) if s.tag == el.tag)
+
+
+def _select_top(article, n):
+    """Equivalent of article.select_one('.setInfo:nth-of-type(n) .top')."""
+    set_infos = {el for el in article.xpath(_CLASS_XPATH.format(tag="*", cls="setInfo"))
+                 if _nth_of_type(el) == n}
+    if not set_infos:
+        return None
+    for top in article.xpath(_CLASS_XPATH.format(tag="*", cls="top")):
+        if any(anc in set_infos for anc in top.iterancestors()):
+            return top
+    return None
+
+
+def parse_cards_lxml(html):
+    try:
+        root = lxml.html.document_fromstring(html)
+    except ValueError:
+        # строки с XML-декларацией кодировки lxml принимает только как bytes
+        root = lxml.html.document_fromstring(html.encode("utf-8"))
+    except etree.ParserError:
+        return [], None
+
+    total = _find_total_lxml(root)
+
+    cards = []
+    for article in root.xpath("//article[contains(concat(' ', normalize-space(@class), ' '), ' classified ')]"):
+        links = article.xpath(".//a[contains(@href, '/auto-oglasi/')]")
+        if not links:
+            continue
+
+        titles = article.xpath(".//h2//a")
+        km_element = _select_top(article, 2)
+        yr_element = _select_top(article, 1)
+        card = _make_card(
+            links[0].get("href") or "",
+            _get_text(titles[0]) if titles else '',
+            article.get('data-price'),
+            _get_text(km_element) if km_element is not None else None,
+            _get_text(yr_element) if yr_element is not None else None,
+        )
+        if card:
+            cards.append(card)
+    return cards, total
+
+
+PARSERS = {"bs4": parse_cards_bs4}
+if lxml is not None:
+    PARSERS["lxml"] = parse_cards_lxml
+
+
+def parse_cards(html, backend=None):
+    """
+    Parses a search results page into (cards, total).
+    backend: "lxml", "bs4" or "auto"/None (fastest available, see PARSER_BACKEND).
+    """
+    backend = backend or PARSER_BACKEND
+    if backend == "auto":
+        backend = "lxml" if "lxml" in PARSERS else "bs4"
+    return PARSERS[backend](html)
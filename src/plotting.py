@@ -10,7 +10,7 @@ def create_price_mileage_scatter_plot(df):
         unique_comparison_groups = sorted(df['comparison_group'].unique())
         color_map = {group: color for group, color in zip(unique_comparison_groups, px.colors.qualitative.Plotly)}
         
-        for name, group_df in df.groupby('comparison_group'):
+        for name, group_df in df.groupby('comparison_group', observed=True):
             if len(group_df) < 3: continue
             group_color = color_map.get(name, 'grey')
             
@@ -0,0 +1,175 @@
+# price_history.py
+# История объявлений в стиле SCD-2: новая строка появляется только когда у объявления
+# меняется цена или пробег (valid_from / valid_to), поэтому частый (ежечасный) скрапинг
+# не раздувает базу полными снимками. Заполняется при загрузке файлов (data_loader.ingest_new_files).
+# Объявление — (source_code, listing_id), см. listing_ids; URL берется из словаря listing_urls.
+# Статус тоже версионируется: объявление, которого нет в полном обходе своей группы поиска,
+# получает версию "delisted", а когда появляется снова — новую версию "listed".
+from src.listing_ids import SOURCE_CODES, URLS_TABLE
+
+HISTORY_TABLE = "price_history"
+KEY_COLUMNS = "search_group, source_code, listing_id"
+LISTED, DELISTED = "listed", "delisted"
+
+
+def ensure_history_schema(con):
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {HISTORY_TABLE} (
+            search_group VARCHAR NOT NULL,
+            source_code UTINYINT NOT NULL,
+            listing_id BIGINT NOT NULL,
+            price_eur BIGINT,
+            mileage_km BIGINT,
+            prev_price_eur BIGINT,        -- цена предыдущей версии (NULL у первой)
+            valid_from TIMESTAMPTZ NOT NULL,
+            valid_to TIMESTAMPTZ,         -- NULL у текущей версии
+            last_seen_at TIMESTAMPTZ,     -- последнее наблюдение этой версии
+            status VARCHAR NOT NULL DEFAULT '{LISTED}'  -- {LISTED} | {DELISTED}
+        )
+    """)
+    # история из прежних версий — все версии считаются объявлениями в продаже
+    con.execute(f"ALTER TABLE {HISTORY_TABLE} ADD COLUMN IF NOT EXISTS status VARCHAR DEFAULT '{LISTED}'")
+    con.execute(f"CREATE INDEX IF NOT EXISTS {HISTORY_TABLE}_listing_idx ON {HISTORY_TABLE} (listing_id)")
+    con.execute(f"CREATE INDEX IF NOT EXISTS {HISTORY_TABLE}_valid_from_idx ON {HISTORY_TABLE} (valid_from)")
+
+
+def record_history(con, observations_sql):
+    """
+    Merges observations into the history. `observations_sql` must yield
+    search_group, source_code, listing_id, price_eur, mileage_km, seen_at, status.
+    Consecutive observations with the same price, mileage and status collapse into one version;
+    observations not newer than the last observation of a listing's current version are ignored
+    (a stale page replayed from the cache must not split history that is already known).
+    Returns the number of new versions. Runs inside the caller's transaction.
+    """
+    con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE history_versions AS
+        WITH cur AS (
+            SELECT {KEY_COLUMNS}, price_eur, mileage_km, status, valid_from,
+                   coalesce(last_seen_at, valid_from) AS seen_until
+            FROM {HISTORY_TABLE} WHERE valid_to IS NULL
+        ),
+        obs AS (
+            SELECT o.*, cur.price_eur AS cur_price, cur.mileage_km AS cur_mileage, cur.status AS cur_status,
+                   cur.valid_from AS cur_from
+            FROM ({observations_sql}) o
+            LEFT JOIN cur USING ({KEY_COLUMNS})
+            WHERE cur.valid_from IS NULL OR o.seen_at > cur.seen_until
+        ),
+        flagged AS (
+            SELECT *,
+                   coalesce(lag(price_eur) OVER w, cur_price) AS prev_price,
+                   coalesce(lag(mileage_km) OVER w, cur_mileage) AS prev_mileage,
+                   coalesce(lag(status) OVER w, cur_status) AS prev_status,
+                   (lag(seen_at) OVER w IS NULL AND cur_from IS NULL) AS is_first
+            FROM obs
+            WINDOW w AS (PARTITION BY {KEY_COLUMNS} ORDER BY seen_at)
+        ),
+        numbered AS (
+            SELECT *,
+                   sum(CASE WHEN is_first
+                              OR price_eur IS DISTINCT FROM prev_price
+                              OR mileage_km IS DISTINCT FROM prev_mileage
+                              OR status IS DISTINCT FROM prev_status THEN 1 ELSE 0 END)
+                       OVER (PARTITION BY {KEY_COLUMNS} ORDER BY seen_at
+                             ROWS UNBOUNDED PRECEDING) AS version
+            FROM flagged
+        )
+        -- version 0 продолжает текущую версию объявления, 1.. — новые версии
+        SELECT {KEY_COLUMNS}, version,
+               arg_min(price_eur, seen_at) AS price_eur,
+               arg_min(mileage_km, seen_at) AS mileage_km,
+               arg_min(status, seen_at) AS status,
+               CASE WHEN version > 0 THEN arg_min(prev_price, seen_at) END AS prev_price_eur,
+               min(seen_at) AS valid_from,
+               max(seen_at) AS last_seen_at
+        FROM numbered
+        GROUP BY {KEY_COLUMNS}, version
+    """)
+    # Текущая версия: продлеваем last_seen_at или закрываем, если пришла новая
+    con.execute(f"""
+        UPDATE {HISTORY_TABLE} AS h
+        SET last_seen_at = greatest(h.last_seen_at, coalesce(v.continued_until, h.last_seen_at)),
+            valid_to = v.next_from
+        FROM (
+            SELECT {KEY_COLUMNS},
+                   max(last_seen_at) FILTER (WHERE version = 0) AS continued_until,
+                   min(valid_from) FILTER (WHERE version > 0) AS next_from
+            FROM history_versions GROUP BY {KEY_COLUMNS}
+        ) AS v
+        WHERE h.valid_to IS NULL AND h.search_group = v.search_group
+          AND h.source_code = v.source_code AND h.listing_id = v.listing_id
+    """)
+    inserted = con.execute(f"""
+        INSERT INTO {HISTORY_TABLE} BY NAME
+        SELECT {KEY_COLUMNS}, price_eur, mileage_km, prev_price_eur, valid_from,
+               lead(valid_from) OVER (PARTITION BY {KEY_COLUMNS} ORDER BY valid_from) AS valid_to,
+               last_seen_at, status
+        FROM history_versions WHERE version > 0
+    """).fetchone()[0]
+    con.execute("DROP TABLE history_versions")
+    return inserted
+
+
+def touch_observations_sql(touches_sql):
+    """
+    Observations for record_history from listings seen unchanged by an incremental scrape.
+    `touches_sql` yields search_group, source_code, listing_id, seen_at; price and mileage
+    are those of the listing's current version (listings without history are skipped).
+    """
+    return f"""
+        SELECT t.search_group, t.source_code, t.listing_id, h.price_eur, h.mileage_km,
+               t.seen_at, '{LISTED}' AS status
+        FROM ({touches_sql}) t JOIN {HISTORY_TABLE} h USING ({KEY_COLUMNS})
+        WHERE h.valid_to IS NULL
+    """
+
+
+def absence_observations_sql(crawls_sql):
+    """
+    Observations for record_history from complete crawls: `crawls_sql` yields source,
+    search_group, started_at of crawls that read every result page of the group. A listed
+    listing of the group not seen since the crawl started gets a delisted observation at that time.
+    """
+    source_code = " ".join(f"WHEN '{name}' THEN {code}" for name, code in SOURCE_CODES.items())
+    return f"""
+        SELECT h.search_group, h.source_code, h.listing_id, h.price_eur, h.mileage_km,
+               c.started_at AS seen_at, '{DELISTED}' AS status
+        FROM {HISTORY_TABLE} h
+        JOIN ({crawls_sql}) c
+          ON h.search_group = c.search_group AND h.source_code = (CASE c.source {source_code} END)
+        WHERE h.valid_to IS NULL AND h.status = '{LISTED}'
+          AND coalesce(h.last_seen_at, h.valid_from) < c.started_at
+    """
+
+
+def price_drops(con, since, min_drop=0.05, search_groups=None):
+    """
+    Listings whose price fell by at least `min_drop` (fraction) in a version that
+    started at or after `since`. Uses the valid_from index, so it only touches recent versions.
+    """
+    params = [since, min_drop]
+    group_filter = ""
+    if search_groups:
+        group_filter = f"AND search_group IN ({', '.join('?' * len(search_groups))})"
+        params += list(search_groups)
+    return con.execute(f"""
+        SELECT h.search_group, h.source_code, h.listing_id, u.url, h.prev_price_eur, h.price_eur,
+               1 - h.price_eur / h.prev_price_eur AS drop_pct, h.mileage_km, h.valid_from, h.valid_to, h.last_seen_at
+        FROM {HISTORY_TABLE} h LEFT JOIN {URLS_TABLE} u USING (source_code, listing_id)
+        WHERE valid_from >= ? AND prev_price_eur > 0
+          AND price_eur <= prev_price_eur * (1 - ?) {group_filter}
+        ORDER BY drop_pct DESC
+    """, params).fetchdf()
+
+
+def listing_history(con, source_code, listing_id, search_group=None):
+    """All versions of one listing, oldest first."""
+    params = [source_code, listing_id]
+    group_filter = ""
+    if search_group is not None:
+        group_filter = "AND search_group = ?"
+        params.append(search_group)
+    return con.execute(f"""
+        SELECT * FROM {HISTORY_TABLE} WHERE source_code = ? AND listing_id = ? {group_filter} ORDER BY valid_from
+    """, params).fetchdf()
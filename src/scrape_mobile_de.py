@@ -1,66 +1,73 @@
 # scrape_mobile_de.py
-import json
+import math
+import os
 import re
 import time
-import random
 import pandas as pd
+from datetime import datetime, timezone
 from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
 
 from botasaurus.browser import browser
 from botasaurus_driver.driver import Driver
-from bs4 import BeautifulSoup
+from checkpoint import PageJournal
+from dataset import TOUCH_SCHEMA, TOUCHES_DIR, DatasetWriter, record_crawl, stamp_fetched_at
+from html_cache import HtmlCache
+from initial_state import extract_search_results, find_initial_state, page_title
+from listing_ids import listing_key
+from seen_index import SeenIndex
+from sharding import plan_shards, mobile_de_shard_from_url, mobile_de_shard_url
+from throttle import HostRateLimiter
 
-@browser(block_images_and_css=True, reuse_driver=True)
+MOBILE_DE_DRIVERS = 3          # сколько прогретых браузеров рендерят страницы параллельно
+INITIAL_STATE_TIMEOUT = 15     # максимум секунд ожидания window.__INITIAL_STATE__
+PAGES_PER_SECOND = 1.0         # общий темп запросов к mobile.de для всех браузеров
+rate_limiter = HostRateLimiter(rate=PAGES_PER_SECOND, capacity=1)
+
+INCREMENTAL = False                           # True: остановка на уже известных объявлениях, в датасет пишутся только новые
+NEWEST_FIRST_PARAMS = {"sb": "doc", "od": "down"}  # сортировка "Neueste Inserate zuerst"
+
+SHARDING = False      # True: делить широкий поиск по цене (p=) и году (fr=), пока шард не влезет в PAGE_CAP
+PAGE_CAP = 50         # mobile.de не отдаёт страницы дальше 50-й
+RESULTS_PER_PAGE = 20
+RESUME = True         # журнал страниц: упавший запуск продолжается с первой недокачанной страницы
+CACHE_MODE = "off"    # "off" | "write" — сохранять HTML в кэш | "replay" — парсить только из кэша, без браузера
+REPLAY_AS_OF = None   # unix time: в режиме replay проигрывать только снимки не новее этого момента
+replay_window = (None, REPLAY_AS_OF)  # (since, until) проигрываемого снимка из html_cache.snapshots, задается в __main__
+html_cache = None     # HtmlCache, создаётся в __main__ при CACHE_MODE != "off"
+
+def wait_for_initial_state(driver: Driver, timeout=INITIAL_STATE_TIMEOUT, poll=0.2):
+    """Polls the page until window.__INITIAL_STATE__ is set. Returns False on timeout."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if driver.run_js("return !!window.__INITIAL_STATE__"):
+            return True
+        time.sleep(poll)
+    return False
+
+# Called with a list of URLs, botasaurus spreads them over MOBILE_DE_DRIVERS
+# browsers and keeps each one alive between pages (reuse_driver).
+@browser(block_images_and_css=True, reuse_driver=True, parallel=MOBILE_DE_DRIVERS)
 def render_page_mobile_de(driver: Driver, url):
+    rate_limiter.wait(url)
     driver.google_get(url)
-    time.sleep(3) # Wait for any dynamic content to load
+    if not wait_for_initial_state(driver):
+        print(f"Warning: __INITIAL_STATE__ did not appear within {INITIAL_STATE_TIMEOUT}s for {url}")
     return driver.page_html
 
-def find_and_clean_json(text):
-    open_braces = 0
-    start_index = text.find('{')
-    if start_index == -1:
-        return None
-
-    for i in range(start_index, len(text)):
-        char = text[i]
-        if char == '{':
-            open_braces += 1
-        elif char == '}':
-            open_braces -= 1
-            if open_braces == 0:
-                return text[start_index:i+1]
-    return None
-
 def parse_from_initial_state(html):
-    soup = BeautifulSoup(html, "lxml")
-    print(f"Parsing page with title: \"{soup.title.string}\"")
+    print(f"Parsing page with title: \"{page_title(html)}\"")
 
-    script_tag = soup.find("script", string=re.compile(r"window\.__INITIAL_STATE__"))
-    if not script_tag:
+    if find_initial_state(html) == -1:
         print("Error: Could not find the __INITIAL_STATE__ script tag.")
         return [], 1
 
-    match = re.search(r"window\.__INITIAL_STATE__\s*=\s*(.*)", script_tag.string, re.DOTALL)
-    if not match:
-        print("Error: Could not extract content from the script tag.")
-        return [], 1
-    
-    raw_js_string = match.group(1)
-    json_str = find_and_clean_json(raw_js_string)
-
-    if not json_str:
-        print("Error: Could not find a complete JSON object by balancing braces.")
+    search_results = extract_search_results(html)
+    if not search_results or 'items' not in search_results:
+        print("Error: Could not find search results in __INITIAL_STATE__ JSON.")
         return [], 1
 
-    data = json.loads(json_str)
-
-    try:
-        results = data['search']['srp']['data']['searchResults']['items']
-        total_pages = data['search']['srp']['data']['searchResults'].get('numPages', 1)
-    except KeyError as e:
-        print(f"Error: Could not find search results in JSON. Missing key: {e}")
-        return [], 1
+    results = search_results['items']
+    total_pages = search_results.get('numPages', 1)
 
     cards = []
     for ad in results:
@@ -109,39 +116,193 @@ def parse_from_initial_state(html):
 
     return cards, total_pages
 
-def scrape_mobile_de(url):
-    print(f"Scraping initial URL: {url}")
-    html = render_page_mobile_de(url)
+def render_pages(urls):
+    """
+    Renders a batch of pages on the browser pool, going through the HTML cache if enabled.
+    Returns (html, fetched_at) per url: fetched_at is the cache time of a replayed page, None for a fresh render.
+    """
+    if html_cache is not None and CACHE_MODE == "replay":
+        since, until = replay_window
+        found = [html_cache.lookup(u, as_of=until, since=since) for u in urls]
+        return [f if f is not None else (None, None) for f in found]
+    htmls = render_page_mobile_de(urls)
+    if html_cache is not None:
+        for u, h in zip(urls, htmls):
+            # страница без __INITIAL_STATE__ — челлендж или блокировка, replay не должен ее отдавать
+            if h and find_initial_state(h) != -1:
+                html_cache.put(u, h)
+    return [(h, None) for h in htmls]
+
+def parse_page(html, fetched_at=None):
+    """parse_from_initial_state; cards of a replayed page carry its fetch time."""
     cards, total_pages = parse_from_initial_state(html)
+    if fetched_at is not None:
+        stamp_fetched_at(cards, fetched_at)
+    return cards, total_pages
+
+def set_page_param(url, key, value):
+    u = urlparse(url)
+    q = parse_qs(u.query)
+    q[key] = [str(value)]
+    return urlunparse((u.scheme, u.netloc, u.path, u.params, urlencode(q, doseq=True), u.fragment))
+
+def plan_search_shards(url):
+    """
+    Splits a search by price/year until every shard fits under PAGE_CAP. Returns {shard URL: its
+    parsed first page (cards, total_pages) from the probe, None if the probe failed} for
+    scrape_mobile_de(first_page=...). Each level of the split is probed in one batch on the browser pool.
+    """
+    first_pages = {}
+
+    def count_pages_batch(shards):
+        urls = [mobile_de_shard_url(url, s) for s in shards]
+        counts = []
+        for u, (h, fetched_at) in zip(urls, render_pages(urls)):
+            search_results = extract_search_results(h) if h else None
+            if not search_results:
+                print(f"    Error probing {u}: no search results")
+                counts.append(1)
+                continue
+            first_pages[u] = parse_page(h, fetched_at)
+            if search_results.get('numResultsTotal') is not None:
+                # numPages сам упирается в лимит, поэтому считаем по общему числу объявлений
+                counts.append(math.ceil(search_results['numResultsTotal'] / RESULTS_PER_PAGE))
+            else:
+                counts.append(search_results.get('numPages', 1))
+        return counts
+
+    shards = plan_shards(mobile_de_shard_from_url(url), count_pages_batch, PAGE_CAP)
+    return {u: first_pages.get(u) for u in (mobile_de_shard_url(url, s) for s in shards)}
+
+def scrape_mobile_de(url, seen=None, search_group=None, journal=None, sink=None, touch=None, first_page=None):
+    """
+    Scrapes every result page of a mobile.de search.
+    With a SeenIndex in `seen`, results are sorted newest-first and pagination stops
+    after a page that holds only known listings; only new listings and known ones whose
+    price or mileage changed are returned (unchanged ones are passed to touch(cards), if given).
+    With a PageJournal, each rendered batch of pages is recorded as soon as it is parsed
+    and pages already in the journal are not rendered again.
+    `first_page` is the parsed (cards, total_pages) of page 1 if the caller has already rendered
+    it (the shard planner's probe, see plan_search_shards); page 1 is then not rendered again.
+    With a `sink`, the rows of each page are passed to sink(rows) in page order and
+    (number of rows, whether every result page was read) is returned; otherwise a DataFrame is returned.
+    """
+    incremental = seen is not None
+    if incremental:
+        for key, value in NEWEST_FIRST_PARAMS.items():
+            url = set_page_param(url, key, value)
+
+    found_cards = {}  # listing_key -> card; трекинг-параметры в URL не делают объявление новым
+    rows = []
+    emitted = 0
+
+    def emit(page_cards):
+        nonlocal emitted
+        page_rows, touched = [], []
+        for c in page_cards:
+            key = listing_key(c["url"])
+            if key in found_cards:
+                continue
+            found_cards[key] = c
+            # известные объявления с прежними ценой и пробегом только обновляют last_seen
+            if incremental and not seen.changed(search_group, c):
+                touched.append(c)
+                continue
+            if c["price_eur"] is None or c["mileage_km"] is None or c["year"] is None:
+                continue
+            page_rows.append(c)
+        emitted += len(page_rows)
+        if touch is not None and touched:
+            touch(touched)
+        if sink is not None:
+            sink(page_rows)
+        else:
+            rows.extend(page_rows)
+
+    print(f"Scraping initial URL: {url}")
+    if journal is not None and journal.done(1):
+        cards, total_pages = journal.pages[1], journal.total_pages
+    elif first_page is not None:
+        cards, total_pages = first_page
+        if journal is not None and total_pages is not None:
+            journal.record(1, cards, total_pages=total_pages)
+    else:
+        html, fetched_at = render_pages([url])[0]
+        if not html:
+            print(f"Error: Could not get the first page of {url}.")
+            return (0, False) if sink is not None else pd.DataFrame()
+        cards, total_pages = parse_page(html, fetched_at)
+        # без числа страниц первая страница не записывается: при продолжении она скачается заново
+        if journal is not None and total_pages is not None:
+            journal.record(1, cards, total_pages=total_pages)
     
     print(f"Found {len(cards)} results on the first page. Total pages: {total_pages}.")
+    # полный обход (см. dataset.record_crawl): numPages упирается в PAGE_CAP, пустая первая страница — ошибка разбора
+    complete = bool(cards) and total_pages < PAGE_CAP
+
+    page_urls = [set_page_param(url, 'pageNumber', p) for p in range(2, total_pages + 1)]
+    # Окнами по числу браузеров: успеваем остановиться в инкрементальном режиме,
+    # сохраняем прогресс в журнал и отдаём строки в sink после каждого окна
+    windowed = incremental or journal is not None or sink is not None
+    window = MOBILE_DE_DRIVERS if windowed else max(1, len(page_urls))
+    stop = incremental and seen.all_known(search_group, cards)
+    emit(cards)
+    for i in range(0, len(page_urls), window):
+        if stop:
+            print("  - Reached already known listings. Stopping.")
+            complete = False
+            break
+        batch = page_urls[i:i + window]
+        pages = range(i + 2, i + 2 + len(batch))
+        pending = [(p, u) for p, u in zip(pages, batch) if journal is None or not journal.done(p)]
+        if pending:
+            print(f"  - Rendering pages {pending[0][0]}..{pending[-1][0]} of {total_pages} with {MOBILE_DE_DRIVERS} browsers...")
+            htmls = render_pages([u for _, u in pending])
+        else:
+            htmls = []
+
+        parsed = {}
+        for (p, page_url), (h, fetched_at) in zip(pending, htmls):
+            if not h:
+                # botasaurus returns None for a page whose render failed
+                print(f"    Error scraping page {page_url}: render failed")
+                complete = False
+                continue
+            try:
+                parsed[p], _ = parse_page(h, fetched_at)
+            except Exception as e:
+                print(f"    Error scraping page {page_url}: {e}")
+                complete = False
+                continue
+            if journal is not None:
+                journal.record(p, parsed[p])
+        del htmls
 
-    def set_page_param(url, page_num):
-        u = urlparse(url)
-        q = parse_qs(u.query)
-        q['pageNumber'] = [str(page_num)]
-        return urlunparse((u.scheme, u.netloc, u.path, u.params, urlencode(q, doseq=True), u.fragment))
-
-    for p in range(2, total_pages + 1):
-        page_url = set_page_param(url, p)
-        print(f"  - Scraping page {p}/{total_pages}...")
-        try:
-            h = render_page_mobile_de(page_url)
-            c, _ = parse_from_initial_state(h)
+        for p in pages:
+            if p in parsed:
+                c = parsed[p]
+            elif journal is not None and journal.done(p):
+                c = journal.pages[p]
+            else:
+                continue
             if not c:
                 print(f"    No more results found on page {p}. Stopping.")
+                stop = True
+                complete = False  # по numPages страница должна быть — выдача неполная
                 break
-            cards += c
-            time.sleep(random.uniform(0.5, 1.5))
-        except Exception as e:
-            print(f"    Error scraping page {page_url}: {e}")
-            continue
-            
-    df = pd.DataFrame(cards)
+            stop = stop or (incremental and seen.all_known(search_group, c))
+            emit(c)
+
+    if incremental:
+        print(f"  - {emitted} new or changed of {len(found_cards)} listings seen.")
+        seen.mark(search_group, found_cards.values())
+
+    if sink is not None:
+        return emitted, complete
+    df = pd.DataFrame(rows)
     if df.empty:
         return df
         
-    df = df.dropna(subset=['price_eur', 'mileage_km', 'year'])
     df = df.astype({
         "price_eur": int,
         "mileage_km": int,
@@ -161,25 +322,81 @@ if __name__ == "__main__":
 
     print("Starting mobile.de scraper with final JSON logic...")
     
-    all_dfs = []
+    seen = SeenIndex('mobile_de') if INCREMENTAL else None
+    if CACHE_MODE != "off":
+        html_cache = HtmlCache()
+    # Строки каждой страницы сразу пишутся в data/dataset/source=.../search_group=.../scrape_date=...
+    writer = DatasetWriter('mobile.de')
+    touch_writer = DatasetWriter('mobile.de', directory=TOUCHES_DIR, schema=TOUCH_SCHEMA)
+
+    journals = []
+    crawls = []  # (группа, начало) полных обходов: записываются после данных
     for query_name, url in SEARCH_QUERIES.items():
         print(f"Scraping query: '{query_name}'...")
-        df = scrape_mobile_de(url)
-        
-        if not df.empty:
-            df['search_group'] = query_name # Присваиваем имя группы из ключа словаря
-            all_dfs.append(df)
-            print(f"Found {len(df)} results for '{query_name}'.")
-        else:
-            print(f"No data scraped for '{query_name}'.")
-
-    if all_dfs:
-        final_df = pd.concat(all_dfs, ignore_index=True)
-        output_path = 'data/raw/mobile_de.parquet'
-        print(f"\nTotal results from mobile.de: {len(final_df)}")
-        print(final_df.head())
-        final_df.to_parquet(output_path, index=False)
-        print(f"\nData saved to {output_path}")
+        # шарды планируются уже с сортировкой scrape_mobile_de(): первые страницы из пробы подходят ему без повтора
+        plan_url = url
+        if INCREMENTAL:
+            for key, value in NEWEST_FIRST_PARAMS.items():
+                plan_url = set_page_param(plan_url, key, value)
+        windows = [replay_window]
+        if CACHE_MODE == "replay":
+            # Каждый сохраненный запуск проигрывается отдельно, от старых к новым, со своим временем
+            # первая страница запуска: корневой шард при SHARDING, иначе страница 1 из scrape_mobile_de()
+            first_url = mobile_de_shard_url(plan_url, mobile_de_shard_from_url(plan_url)) if SHARDING else plan_url
+            windows = html_cache.snapshots(first_url, as_of=REPLAY_AS_OF)
+            print(f"  - Replaying {len(windows)} cached snapshots.")
+        for replay_window in windows:
+            # при проигрывании снимок начинается с загрузки его первой страницы
+            started_at = (datetime.fromtimestamp(replay_window[0], timezone.utc) if CACHE_MODE == "replay"
+                          else datetime.now(timezone.utc))
+            complete = True
+            query_keys = set()  # шарды могут пересекаться на границах — дубли отсеиваем здесь
+
+            def sink(rows):
+                fresh = []
+                for r in rows:
+                    key = listing_key(r["url"])
+                    if key not in query_keys:
+                        query_keys.add(key)
+                        fresh.append(r)
+                writer.write(query_name, fresh)
+
+            # Шарды идут друг за другом: параллельность даёт пул браузеров внутри каждого шарда
+            first_pages = plan_search_shards(plan_url) if SHARDING else {url: None}
+            for shard_url, first_page in first_pages.items():
+                # журнал продолжает прерванный запуск в браузере; при проигрывании кэша он не нужен
+                journal = PageJournal('mobile_de', shard_url) if RESUME and CACHE_MODE != "replay" else None
+                _, shard_complete = scrape_mobile_de(shard_url, seen=seen, search_group=query_name, journal=journal,
+                                                     sink=sink, touch=lambda cards: touch_writer.write(query_name, cards),
+                                                     first_page=first_page)
+                complete = complete and shard_complete
+                journals.append(journal)
+            if complete:
+                crawls.append((query_name, started_at))
+
+            if query_keys:
+                print(f"Found {len(query_keys)} results for '{query_name}'.")
+            else:
+                print(f"No data scraped for '{query_name}'.")
+
+    total = writer.close()
+    touch_writer.close()
+    # отметки полных обходов — только после данных: иначе загрузка сочла бы объявления снятыми
+    for query_name, started_at in crawls:
+        record_crawl('mobile.de', query_name, started_at)
+    if total:
+        print(f"\nTotal results from mobile.de: {total}")
+        print(f"Data saved to {writer.directory}")
     else:
         print("No data was scraped from mobile.de.")
 
+    # Индекс и журналы закрываем только после записи данных на диск
+    if seen is not None:
+        seen.save()
+    for journal in journals:
+        if journal is not None:
+            journal.finish()
+
+    if CACHE_MODE == "write":
+        html_cache.evict()
+
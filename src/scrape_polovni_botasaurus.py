@@ -2,61 +2,55 @@
 # pip install botasaurus botasaurus-requests bs4 lxml pandas numpy
 from botasaurus.browser import browser
 from botasaurus_driver.driver import Driver
-from botasaurus_requests import request as hrequest
-from bs4 import BeautifulSoup
-import re, time, random, math
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
+import os, re, time, math, threading
+from datetime import datetime, timezone
 import pandas as pd
 import numpy as np
 
-BASE = "https://www.polovniautomobili.com"
-
-def parse_cards(html):
-    soup = BeautifulSoup(html, "lxml")
-    txt = soup.get_text(" ", strip=True)
-    total = None
-    m = re.search(r"ukupno\s+(\d+)", txt, flags=re.I)
-    if m: total = int(m.group(1))
-
-    cards = []
-    for article in soup.select('article.classified'):
-        link_element = article.select_one('a[href*="/auto-oglasi/"]')
-        if not link_element:
-            continue
-
-        href = link_element.get("href") or ""
-        if "/auto-oglasi/pretraga" in href:
-            continue
-        if not href.startswith("http"):
-            href = BASE.rstrip("/") + href
-        
-        title_element = article.select_one('h2 a')
-        title = title_element.get_text(strip=True) if title_element else ''
-
-        price_text = article.get('data-price')
-        price = None
-        if price_text:
-            pm = re.search(r"([\d\.]+)", price_text)
-            if pm:
-                price = int(re.sub(r"[^\d]", "", pm.group(1)))
-        
-        km = None
-        km_element = article.select_one('.setInfo:nth-of-type(2) .top')
-        if km_element:
-            km_text = km_element.get_text(strip=True)
-            km_m = re.search(r"(\d[\d\.\s]*)\s*km", km_text, flags=re.I)
-            if km_m: km = int(re.sub(r"[^\d]", "", km_m.group(1)))
-
-        yr = None
-        yr_element = article.select_one('.setInfo:nth-of-type(1) .top')
-        if yr_element:
-            yr_text = yr_element.get_text(strip=True)
-            yr_m = re.search(r"\b(20\d{2})", yr_text)
-            if yr_m: yr = int(yr_m.group(1))
-
-        # The old model-specific check has been removed to allow any model.
-        cards.append({"url": href, "title": title,
-                      "price_eur": price, "mileage_km": km, "year": yr})
-    return cards, total
+from checkpoint import PageJournal
+from dataset import TOUCH_SCHEMA, TOUCHES_DIR, DatasetWriter, record_crawl, stamp_fetched_at
+from html_cache import HtmlCache
+from listing_ids import listing_key
+from parse_polovni import parse_cards
+from seen_index import SeenIndex
+from sharding import plan_shards, polovni_shard_from_url, polovni_shard_url
+from throttle import CircuitBreaker, HostRateLimiter
+from transport import Transport
+
+MAX_WORKERS = 4                 # сколько страниц качаем одновременно
+REQUESTS_PER_SECOND = 1 / 1.5   # тот же темп, что давал sleep(1..2) между страницами
+rate_limiter = HostRateLimiter(rate=REQUESTS_PER_SECOND, capacity=1)
+# одна сессия botasaurus_requests на хост, общая для всех страниц и запросов; пишет метрики загрузок
+transport = Transport(headers={"Referer": "https://www.google.com/"})
+PROBE_TRANSFER = True  # один потоковый запрос httpx на запуск: фазы соединения и реальные байты на проводе
+
+INCREMENTAL = False               # True: остановка на уже известных объявлениях, в датасет пишутся только новые
+NEWEST_FIRST_SORT = "renewDate_desc"  # сортировка "najnovije" — нужна для инкрементального режима
+CARD_COLUMNS = ["url", "title", "price_eur", "mileage_km", "year"]
+# у страниц из кэша строки несут время загрузки страницы (scraped_at), а не время разбора
+
+SHARDING = False      # True: делить широкий поиск по цене/году, пока шард не влезет в PAGE_CAP
+PAGE_CAP = 100        # дальше этой страницы сайт выдачу не отдаёт
+SHARD_WORKERS = 2     # сколько шардов качаем одновременно (общий rate_limiter сохраняется)
+RESUME = True         # журнал страниц: упавший запуск продолжается с первой недокачанной страницы
+CACHE_MODE = "off"    # "off" | "write" — сохранять HTML в кэш | "replay" — парсить только из кэша, без сети
+REPLAY_AS_OF = None   # unix time: в режиме replay проигрывать только снимки не новее этого момента
+replay_window = (None, REPLAY_AS_OF)  # (since, until) проигрываемого снимка из html_cache.snapshots, задается в __main__
+html_cache = None     # HtmlCache, создаётся в __main__ при CACHE_MODE != "off"
+
+# render="auto": страница идёт дешёвым HTTP-запросом и уходит в браузер (~10x дороже)
+# только при блокировке/челлендже или если на ней не нашлось объявлений.
+BLOCK_STATUSES = {403, 429, 503}
+BLOCK_MARKERS = ("cf-challenge", "challenge-platform", "cf_chl_", "Just a moment...",
+                 "Attention Required! | Cloudflare", "captcha-delivery")
+http_breaker = CircuitBreaker(threshold=3, cooldown=300)  # после 3 блоков подряд 5 минут сразу браузер
+_render_lock = threading.Lock()  # браузер один (reuse_driver) — рендерим по одной странице
+
+class BlockedError(Exception):
+    pass
 
 @browser(block_images_and_css=True, reuse_driver=True)
 def render_page(driver: Driver, url):
@@ -66,42 +60,226 @@ def render_page(driver: Driver, url):
     time.sleep(0.8)
     return driver.page_html()
 
+def replay_cards(url):
+    """Cards of the cached version of `url` from the snapshot being replayed, stamped with its fetch time."""
+    since, until = replay_window
+    found = html_cache.lookup(url, as_of=until, since=since)
+    if found is None:
+        raise LookupError(f"No cached HTML for {url}")
+    cards, total = parse_cards(found[0])
+    return stamp_fetched_at(cards, found[1]), total
+
 def get_page_html(url, render=False):
+    rate_limiter.wait(url)
     if not render:
-        r = hrequest.get(url, headers={"Referer": "https://www.google.com/"}, timeout=30)
+        r = transport.get(url)
+        if r.status_code in BLOCK_STATUSES:
+            raise BlockedError(f"HTTP {r.status_code}")
         r.raise_for_status()
-        return r.text
+        html = r.text
     else:
-        return render_page(url)
+        with _render_lock:
+            html = render_page(url)
+    # В кэш — только прошедшие проверку на блокировку: replay не должен отдавать челленджи
+    if html_cache is not None and not looks_blocked(html):
+        html_cache.put(url, html)
+    return html
+
+def set_q(url, k, v):
+    u = urlparse(url); q = parse_qs(u.query); q[k] = [str(v)]
+    return urlunparse((u.scheme,u.netloc,u.path,u.params,urlencode(q, doseq=True),u.fragment))
+
+def looks_blocked(html):
+    return any(marker in html for marker in BLOCK_MARKERS)
+
+def fetch_cards(url, render="auto"):
+    """
+    Fetches and parses one page. render=False/True forces HTTP/browser; with "auto"
+    the page goes over HTTP and is re-fetched in the browser after an exponential
+    backoff if it is blocked or yields nothing. While the host's circuit is open
+    pages go straight to the browser.
+    """
+    if CACHE_MODE == "replay":
+        return replay_cards(url)
+    if render != "auto":
+        return parse_cards(get_page_html(url, render=render is True))
+
+    host = urlparse(url).netloc
+    if not http_breaker.allow(host):
+        return parse_cards(get_page_html(url, render=True))
+    try:
+        html = get_page_html(url, render=False)
+        cards, total = parse_cards(html)
+        if looks_blocked(html):
+            reason = "challenge page"
+        elif not cards and total is None:
+            reason = "no listings parsed"
+        else:
+            http_breaker.record_success(host)
+            return cards, total
+    except BlockedError as e:
+        reason = str(e)
+    delay = http_breaker.record_failure(host)
+    print(f"    {reason} on {url}; retrying in the browser after {delay:.1f}s")
+    time.sleep(delay)
+    return parse_cards(get_page_html(url, render=True))
+
+def fetch_pages(page_urls, render="auto", workers=MAX_WORKERS):
+    """
+    Fetches and parses pages with a bounded thread pool.
+    Yields (page_url, cards) in the order of page_urls; failed pages are reported and skipped.
+    """
+    def task(page_url):
+        return fetch_cards(page_url, render=render)[0]
+
+    # Браузер один (reuse_driver), поэтому при render=True страницы идут по одной
+    workers = 1 if render is True else max(1, workers)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = deque((page_url, pool.submit(task, page_url)) for page_url in page_urls)
+        while futures:
+            # Отданные страницы не держим в памяти
+            page_url, future = futures.popleft()
+            try:
+                yield page_url, future.result()
+            except Exception as e:
+                print(f"    Error scraping page {page_url}: {e}")
+
+def probe_first_page(url, render="auto"):
+    """(cards, total) of the first page of a search, None if it could not be fetched."""
+    try:
+        return fetch_cards(url, render=render)
+    except Exception as e:
+        print(f"    Error probing {url}: {e}")
+        return None
+
+def count_pages(first_page):
+    """Number of result pages of a search (0 if it is empty), from its first page (cards, total)."""
+    total = first_page[1] if first_page is not None else None
+    return 1 if total is None else math.ceil(total / 25)
+
+def plan_search_shards(url, render="auto", workers=MAX_WORKERS):
+    """
+    Splits a search by price/year until every shard fits under PAGE_CAP. Returns {shard URL: its
+    first page (cards, total) from the probe, None if the probe failed} for scrape(first_page=...).
+    """
+    first_pages = {}
+
+    def count_pages_batch(shards):
+        urls = [polovni_shard_url(url, s) for s in shards]
+        with ThreadPoolExecutor(max_workers=1 if render is True else max(1, workers)) as pool:
+            pages = list(pool.map(lambda u: probe_first_page(u, render=render), urls))
+        first_pages.update(zip(urls, pages))
+        return [count_pages(p) for p in pages]
+
+    shards = plan_shards(polovni_shard_from_url(url), count_pages_batch, PAGE_CAP)
+    return {u: first_pages.get(u) for u in (polovni_shard_url(url, s) for s in shards)}
+
+def scrape(url, render="auto", workers=MAX_WORKERS, seen=None, search_group=None, journal=None, sink=None,
+           touch=None, first_page=None):
+    """
+    Scrapes every result page of a search (see fetch_cards for `render`).
+    With a SeenIndex in `seen`, results are requested newest-first and pagination stops
+    after a page that holds only known listings; known listings with the same price and
+    mileage just get their last_seen refreshed (and are passed to touch(cards), if given),
+    new and changed ones are returned.
+    With a PageJournal, every parsed page is recorded as soon as it arrives and pages
+    already in the journal are taken from it instead of being fetched again.
+    `first_page` is the (cards, total) of page 1 if the caller has already fetched it (the
+    shard planner's probe, see plan_search_shards); page 1 is then not requested again.
+    With a `sink`, the rows of each page are passed to sink(rows) in page order as soon
+    as the page is parsed and (number of rows, whether every result page was read) is returned;
+    otherwise a DataFrame is returned.
+    """
+    incremental = seen is not None
+    if incremental:
+        url = set_q(url, "sort", NEWEST_FIRST_SORT)
+
+    found_cards = {}  # listing_key -> card; трекинг-параметры в URL не делают объявление новым
+    rows = []
+    emitted = 0
+    complete = True  # полный обход: прочитаны все страницы выдачи (см. dataset.record_crawl)
 
-def scrape(url, render=False):
-    html = get_page_html(url, render=render)
-    cards, total = parse_cards(html)
+    def emit(page_cards):
+        nonlocal emitted
+        page_rows, touched = [], []
+        for c in page_cards:
+            key = listing_key(c["url"])
+            if key in found_cards:
+                continue
+            found_cards[key] = c
+            # известные объявления с прежними ценой и пробегом только обновляют last_seen
+            if incremental and not seen.changed(search_group, c):
+                touched.append(c)
+                continue
+            if c["price_eur"] is None or c["mileage_km"] is None or c["year"] is None:
+                continue
+            page_rows.append({k: c[k] for k in CARD_COLUMNS + ["scraped_at"] if k in c})
+        emitted += len(page_rows)
+        if touch is not None and touched:
+            touch(touched)
+        if sink is not None:
+            sink(page_rows)
+        else:
+            rows.extend(page_rows)
+
+    if journal is not None and journal.done(1):
+        cards, total = journal.pages[1], journal.total_pages
+    else:
+        cards, total = first_page if first_page is not None else fetch_cards(url, render=render)
+        # без числа страниц первая страница не записывается: при продолжении она скачается заново
+        if journal is not None and total is not None:
+            journal.record(1, cards, total_pages=total)
     if total is None:
         print(f"Warning: Could not determine total number of pages for {url}. Scraping only first page.")
         pages = 1
+        complete = False
     else:
         pages = math.ceil(total / 25)
-    
-    from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
-    def set_q(url, k, v):
-        u = urlparse(url); q = parse_qs(u.query); q[k] = [str(v)]
-        return urlunparse((u.scheme,u.netloc,u.path,u.params,urlencode(q, doseq=True),u.fragment))
-
-    for p in range(2, pages + 1):
-        page_url = set_q(url, "page", p)
-        print(f"  - Scraping page {p}/{pages}...")
-        try:
-            h = get_page_html(page_url, render=render)
-            c, _ = parse_cards(h)
-            cards += c
-            time.sleep(random.uniform(1.0, 2.0))
-        except Exception as e:
-            print(f"    Error scraping page {page_url}: {e}")
-            continue
-            
-    df = pd.DataFrame(cards).drop_duplicates(subset=["url"])
-    df = df.dropna(subset=["price_eur","mileage_km","year"])
+        # пустая первая страница — скорее блокировка, чем пустой поиск; дальше PAGE_CAP сайт не отдает
+        complete = bool(cards) and pages <= PAGE_CAP
+
+    page_numbers = {set_q(url, "page", p): p for p in range(2, pages + 1)}
+    page_urls = list(page_numbers)
+
+    def pages_in_order(batch):
+        """Yields the cards of each page of `batch` in page order: from the journal or freshly fetched."""
+        nonlocal complete
+        pending = [u for u in batch if journal is None or not journal.done(page_numbers[u])]
+        results = fetch_pages(pending, render=render, workers=workers)
+        nxt = next(results, None)
+        for page_url in batch:
+            p = page_numbers[page_url]
+            if page_url not in pending:
+                yield journal.pages[p]
+            elif nxt is not None and nxt[0] == page_url:
+                print(f"  - Scraped page {p}/{pages} ({len(nxt[1])} cards)")
+                if journal is not None:
+                    journal.record(p, nxt[1])
+                yield nxt[1]
+                nxt = next(results, None)
+            else:
+                complete = False  # страница упала — уже сообщено в fetch_pages
+
+    # В инкрементальном режиме качаем окнами, чтобы вовремя остановиться
+    window = max(1, workers) if incremental else max(1, len(page_urls))
+    stop = incremental and seen.all_known(search_group, cards)
+    emit(cards)
+    for i in range(0, len(page_urls), window):
+        if stop:
+            print("  - Reached already known listings. Stopping.")
+            complete = False
+            break
+        for c in pages_in_order(page_urls[i:i + window]):
+            stop = stop or (incremental and seen.all_known(search_group, c))
+            emit(c)
+
+    if incremental:
+        print(f"  - {emitted} new or changed of {len(found_cards)} listings seen.")
+        seen.mark(search_group, found_cards.values())
+
+    if sink is not None:
+        return emitted, complete
+    df = pd.DataFrame(rows, columns=CARD_COLUMNS)
     df['source'] = 'polovni_automobili' # Add source identifier
     return df
 
@@ -112,19 +290,87 @@ if __name__ == "__main__":
         "Volvo XC90": ("https://www.polovniautomobili.com/auto-oglasi/pretraga?brand=volvo&model%5B%5D=xc90&brand2=&price_from=&price_to=&year_from=2018&year_to=&flywheel=&atest=&door_num=&submit_1=&without_price=1&date_limit=&showOldNew=all&modeltxt=&engine_volume_from=&engine_volume_to=&power_from=&power_to=&mileage_from=&mileage_to=&emission_class=&seat_num=&wheel_side=&registration=&country=&country_origin=&city=&registration_price=&page=&sort=")
     }
 
-    all_dfs = []
+    seen = SeenIndex('polovni_automobili') if INCREMENTAL else None
+    if CACHE_MODE != "off":
+        html_cache = HtmlCache()
+    # Строки каждой страницы сразу пишутся в data/dataset/source=.../search_group=.../scrape_date=...
+    writer = DatasetWriter('polovni_automobili')
+    touch_writer = DatasetWriter('polovni_automobili', directory=TOUCHES_DIR, schema=TOUCH_SCHEMA)
+
+    if PROBE_TRANSFER and CACHE_MODE != "replay":
+        probe_url = next(iter(SEARCH_QUERIES.values()))
+        rate_limiter.wait(probe_url)
+        try:
+            transport.probe(probe_url)
+        except Exception as e:
+            print(f"Transfer probe failed: {e}")
+
+    journals = []
+    crawls = []  # (группа, начало) полных обходов: записываются после данных
     for query_name, url in SEARCH_QUERIES.items():
         print(f"Scraping query: '{query_name}'...")
-        df = scrape(url, render=False)  # если начнутся блоки → True
-        df['search_group'] = query_name # Add a column to identify the source query
-        all_dfs.append(df)
-        print(f"Found {len(df)} results for '{query_name}'.")
-
-    if all_dfs:
-        final_df = pd.concat(all_dfs, ignore_index=True)
-        print(f"\nTotal results from all queries: {len(final_df)}")
-        print(final_df.head())
-        final_df.to_parquet('data/raw/polovni_automobili.parquet', index=False)
-        print("\nData saved to data/raw/polovni_automobili.parquet")
+        # шарды планируются уже с сортировкой scrape(): первые страницы из пробы подходят ему без повтора
+        plan_url = set_q(url, "sort", NEWEST_FIRST_SORT) if INCREMENTAL else url
+        windows = [replay_window]
+        if CACHE_MODE == "replay":
+            # Каждый сохраненный запуск проигрывается отдельно, от старых к новым, со своим временем
+            # первая страница запуска: корневой шард при SHARDING, иначе страница 1 из scrape()
+            first_url = polovni_shard_url(plan_url, polovni_shard_from_url(plan_url)) if SHARDING else plan_url
+            windows = html_cache.snapshots(first_url, as_of=REPLAY_AS_OF)
+            print(f"  - Replaying {len(windows)} cached snapshots.")
+        for replay_window in windows:
+            # при проигрывании снимок начинается с загрузки его первой страницы
+            started_at = (datetime.fromtimestamp(replay_window[0], timezone.utc) if CACHE_MODE == "replay"
+                          else datetime.now(timezone.utc))
+            first_pages = plan_search_shards(plan_url) if SHARDING else {url: None}
+            # журнал продолжает прерванный сетевой запуск; при проигрывании кэша он не нужен
+            query_journals = {u: PageJournal('polovni_automobili', u) if RESUME and CACHE_MODE != "replay" else None
+                              for u in first_pages}
+            query_keys = set()  # шарды могут пересекаться на границах — дубли отсеиваем здесь
+            query_lock = threading.Lock()
+
+            def sink(rows):
+                fresh = []
+                with query_lock:
+                    for r in rows:
+                        key = listing_key(r["url"])
+                        if key not in query_keys:
+                            query_keys.add(key)
+                            fresh.append(r)
+                writer.write(query_name, fresh)
+
+            def scrape_shard(shard_url):
+                return scrape(shard_url, render="auto", seen=seen, search_group=query_name,
+                              journal=query_journals[shard_url], sink=sink,
+                              touch=lambda cards: touch_writer.write(query_name, cards),
+                              first_page=first_pages[shard_url])
+
+            with ThreadPoolExecutor(max_workers=SHARD_WORKERS) as pool:
+                results = list(pool.map(scrape_shard, first_pages))
+            journals += query_journals.values()
+            if all(complete for _, complete in results):
+                crawls.append((query_name, started_at))
+            print(f"Found {len(query_keys)} results for '{query_name}'.")
+
+    total = writer.close()
+    touch_writer.close()
+    # отметки полных обходов — только после данных: иначе загрузка сочла бы объявления снятыми
+    for query_name, started_at in crawls:
+        record_crawl('polovni_automobili', query_name, started_at)
+    if total:
+        print(f"\nTotal results from all queries: {total}")
+        print(f"Data saved to {writer.directory}")
     else:
         print("No data was scraped.")
+
+    # Индекс и журналы закрываем только после записи данных на диск
+    if seen is not None:
+        seen.save()
+    for journal in journals:
+        if journal is not None:
+            journal.finish()
+
+    if CACHE_MODE == "write":
+        html_cache.evict()
+    transport.print_summary()
+    transport.close()
@@ -0,0 +1,63 @@
+# seen_index.py
+# Постоянный индекс уже собранных объявлений для инкрементального режима скраперов.
+# Файл: {search_group: {listing_key: [first_seen, last_seen, price_eur, mileage_km]}}, в памяти ключи — int64 (listing_ids).
+# Цена и пробег — последние увиденные: изменившееся объявление снова попадает в датасет.
+import json
+import os
+from datetime import datetime, timezone
+
+from listing_ids import ID_BITS, SOURCE_CODES, listing_key
+
+SEEN_DIR = "data/state"
+_OLD_PREFIXES = {"pa": SOURCE_CODES["polovni_automobili"], "mde": SOURCE_CODES["mobile.de"]}
+
+
+def _load_key(key):
+    """Integer key from the file; older files used "pa:<id>" / "mde:<id>" / URL keys."""
+    if key.isdigit():
+        return int(key)
+    prefix, _, ad_id = key.partition(":")
+    if prefix in _OLD_PREFIXES and ad_id.isdigit():
+        return _OLD_PREFIXES[prefix] << ID_BITS | int(ad_id)
+    return listing_key(key)
+
+
+class SeenIndex:
+    """Listings already scraped, per search group, with first/last seen timestamps and the last price and mileage."""
+
+    def __init__(self, source, directory=SEEN_DIR):
+        self.path = os.path.join(directory, f"seen_{source}.json")
+        self.groups = {}
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                self.groups = {group: {_load_key(k): v for k, v in keys.items()}
+                               for group, keys in json.load(f).items()}
+
+    def contains(self, search_group, url):
+        return listing_key(url) in self.groups.get(search_group, {})
+
+    def changed(self, search_group, card):
+        """True if the listing is new or its price or mileage differs from the last seen values."""
+        entry = self.groups.get(search_group, {}).get(listing_key(card["url"]))
+        # записи старого формата без цены и пробега считаются изменившимися (один раз)
+        return entry is None or entry[2:] != [card["price_eur"], card["mileage_km"]]
+
+    def all_known(self, search_group, cards):
+        """True if the page has cards and every one of them is already indexed."""
+        return bool(cards) and all(self.contains(search_group, c["url"]) for c in cards)
+
+    def mark(self, search_group, cards, when=None):
+        """Adds new listings and refreshes last_seen, price and mileage of known ones."""
+        when = when or datetime.now(timezone.utc).isoformat(timespec="seconds")
+        group = self.groups.setdefault(search_group, {})
+        for card in cards:
+            key = listing_key(card["url"])
+            first_seen = group[key][0] if key in group else when
+            group[key] = [first_seen, when, card["price_eur"], card["mileage_km"]]
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.groups, f)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,127 @@
+# sharding.py
+# Разбиение широкого поиска на шарды по цене и году, чтобы каждый шард
+# помещался в лимит страниц сайта и шарды можно было качать параллельно.
+from dataclasses import dataclass, replace
+from datetime import datetime
+from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
+
+PRICE_CEILING = 300000   # верхняя граница для деления открытого диапазона цен
+MIN_PRICE_STEP = 500     # уже этого диапазон цен не делим — переходим к годам
+MIN_YEAR = 1990
+MAX_DEPTH = 12
+
+
+@dataclass(frozen=True)
+class Shard:
+    """Inclusive price/year ranges of one slice of a search; None means an open bound."""
+    price_from: int = None
+    price_to: int = None
+    year_from: int = None
+    year_to: int = None
+
+    def split(self):
+        """Halves the price range, or the year range once prices are narrow. None if neither can be split."""
+        lo = self.price_from or 0
+        hi = self.price_to if self.price_to is not None else max(PRICE_CEILING, lo)
+        if hi - lo >= 2 * MIN_PRICE_STEP:
+            mid = (lo + hi) // 2
+            return [replace(self, price_to=mid), replace(self, price_from=mid + 1)]
+
+        lo = self.year_from or MIN_YEAR
+        hi = self.year_to or datetime.now().year
+        if hi > lo:
+            mid = (lo + hi) // 2
+            return [replace(self, year_to=mid), replace(self, year_from=mid + 1)]
+        return None
+
+    def __str__(self):
+        def rng(a, b):
+            return f"{'' if a is None else a}..{'' if b is None else b}"
+        return f"price {rng(self.price_from, self.price_to)}, year {rng(self.year_from, self.year_to)}"
+
+
+def plan_shards(root, count_pages_batch, page_cap, max_depth=MAX_DEPTH):
+    """
+    Splits `root` until every shard has at most `page_cap` result pages.
+    count_pages_batch(shards) returns the page count of each shard; it is called once
+    per level of the split tree, so a site adapter can probe a whole level in parallel.
+    Empty shards are dropped.
+    """
+    final, pending = [], [(root, None)]
+    for depth in range(max_depth + 1):
+        if not pending:
+            break
+        counts = count_pages_batch([shard for shard, _ in pending])
+        next_level = []
+        for i, ((shard, parent_pages), pages) in enumerate(zip(pending, counts)):
+            if not pages:
+                continue
+            if pages <= page_cap:
+                final.append(shard)
+                continue
+            # Обе половины не меньше родителя — сайт игнорирует фильтр, дальше делить бессмысленно
+            sibling = counts[i ^ 1] if parent_pages is not None else None
+            ignored = parent_pages is not None and pages >= parent_pages and sibling >= parent_pages
+            children = shard.split() if depth < max_depth and not ignored else None
+            if not children:
+                print(f"    Warning: shard [{shard}] still has {pages} pages (cap {page_cap}), results will be truncated.")
+                final.append(shard)
+                continue
+            next_level += [(child, pages) for child in children]
+        pending = next_level
+    print(f"  - Planned {len(final)} shards.")
+    return final
+
+
+def _set_params(url, params):
+    u = urlparse(url)
+    q = parse_qs(u.query, keep_blank_values=True)
+    for key, value in params.items():
+        q[key] = [value]
+    return urlunparse((u.scheme, u.netloc, u.path, u.params, urlencode(q, doseq=True), u.fragment))
+
+
+def _int_or_none(value):
+    return int(value) if value and value.isdigit() else None
+
+
+def _fmt(value):
+    return "" if value is None else str(value)
+
+
+# --- polovniautomobili.com: price_from / price_to / year_from / year_to ---
+
+def polovni_shard_from_url(url):
+    q = parse_qs(urlparse(url).query)
+    get = lambda k: _int_or_none(q.get(k, [""])[0])
+    return Shard(get("price_from"), get("price_to"), get("year_from"), get("year_to"))
+
+
+def polovni_shard_url(url, shard):
+    return _set_params(url, {
+        "price_from": _fmt(shard.price_from), "price_to": _fmt(shard.price_to),
+        "year_from": _fmt(shard.year_from), "year_to": _fmt(shard.year_to),
+    })
+
+
+# --- mobile.de: p=<from>:<to>, fr=<from>:<to> ---
+
+def _range_param(q, key):
+    lo, _, hi = q.get(key, [":"])[0].partition(":")
+    return _int_or_none(lo), _int_or_none(hi)
+
+
+def mobile_de_shard_from_url(url):
+    q = parse_qs(urlparse(url).query)
+    price_from, price_to = _range_param(q, "p")
+    year_from, year_to = _range_param(q, "fr")
+    return Shard(price_from, price_to, year_from, year_to)
+
+
+def mobile_de_shard_url(url, shard):
+    params = {}
+    if shard.price_from is not None or shard.price_to is not None:
+        params["p"] = f"{_fmt(shard.price_from)}:{_fmt(shard.price_to)}"
+    if shard.year_from is not None or shard.year_to is not None:
+        params["fr"] = f"{_fmt(shard.year_from)}:{_fmt(shard.year_to)}"
+    return _set_params(url, params)
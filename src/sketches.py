@@ -0,0 +1,135 @@
+# sketches.py
+# Сливаемые скетчи распределения цен (t-digest) по партициям (source, search_group, scrape_date).
+# Квантили для любого набора источников / групп / дат получаются слиянием нескольких
+# десятков центроидов на партицию, без чтения строк. Скетчи строятся одним SQL-проходом
+# при загрузке (вместе с aggregates), слияние и квантили — numpy.
+import numpy as np
+
+SKETCH_TABLE = "price_sketches"
+COMPRESSION = 100  # δ: не больше ~δ/2 центроидов на скетч; точнее всего на хвостах (10% / 90%)
+
+
+def _k_scale(q, compression):
+    """t-digest k1 scale: centroids are narrow near q=0 and q=1 and wide around the median."""
+    return np.floor(compression / (2 * np.pi) * np.arcsin(2 * np.clip(q, 0, 1) - 1))
+
+
+class TDigest:
+    """A merging t-digest: sorted centroid means and weights plus the exact min and max."""
+
+    def __init__(self, means=(), weights=(), vmin=np.inf, vmax=-np.inf, compression=COMPRESSION):
+        self.means = np.asarray(means, dtype=np.float64)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.min, self.max = float(vmin), float(vmax)
+        self.compression = compression
+        self._compress()
+
+    @classmethod
+    def from_values(cls, values, compression=COMPRESSION):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return cls(compression=compression)
+        return cls(values, np.ones(len(values)), values.min(), values.max(), compression)
+
+    @property
+    def count(self):
+        return float(self.weights.sum())
+
+    def _compress(self):
+        if not len(self.means):
+            return
+        order = np.argsort(self.means, kind="stable")
+        means, weights = self.means[order], self.weights[order]
+        cum = np.cumsum(weights)
+        cluster = _k_scale((cum - weights / 2) / cum[-1], self.compression)
+        starts = np.flatnonzero(np.r_[True, cluster[1:] != cluster[:-1]])
+        self.weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means * weights, starts) / self.weights
+
+    def update(self, values):
+        """Adds raw values in place (e.g. the rows of a freshly scraped page)."""
+        other = TDigest.from_values(values, self.compression)
+        self.means = np.r_[self.means, other.means]
+        self.weights = np.r_[self.weights, other.weights]
+        self.min, self.max = min(self.min, other.min), max(self.max, other.max)
+        self._compress()
+
+    def merge(self, *others):
+        parts = (self,) + others
+        return TDigest(np.concatenate([p.means for p in parts]), np.concatenate([p.weights for p in parts]),
+                       min(p.min for p in parts), max(p.max for p in parts), self.compression)
+
+    def quantile(self, qs):
+        """Quantiles by interpolating between centroid midpoints; NaN if the digest is empty."""
+        qs = np.asarray(qs, dtype=np.float64)
+        if not len(self.means):
+            return np.full(qs.shape, np.nan)
+        cum = np.cumsum(self.weights)
+        mids = cum - self.weights / 2
+        return np.interp(qs * cum[-1], np.r_[0, mids, cum[-1]], np.r_[self.min, self.means, self.max])
+
+
+def ensure_sketch_schema(con):
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {SKETCH_TABLE} (
+            source VARCHAR, search_group VARCHAR, scrape_date DATE,
+            n BIGINT, price_min DOUBLE, price_max DOUBLE,
+            means DOUBLE[], weights DOUBLE[]
+        )
+    """)
+
+
+def refresh_sketches(con, rows_sql, compression=COMPRESSION):
+    """
+    Rebuilds the sketches of every partition present in `rows_sql` (source, search_group,
+    scrape_date, price_eur) in one SQL pass: prices ranked within the partition are grouped
+    into centroids with the same k-scale as TDigest. The caller deletes the stale partitions first.
+    """
+    ensure_sketch_schema(con)
+    con.execute(f"""
+        INSERT INTO {SKETCH_TABLE}
+        WITH ranked AS (
+            SELECT source, search_group, scrape_date, price_eur::DOUBLE AS price,
+                   floor({compression} / (2 * pi()) * asin(
+                       2 * (row_number() OVER p - 0.5) / count(*) OVER (PARTITION BY source, search_group, scrape_date) - 1
+                   )) AS cluster
+            FROM ({rows_sql})
+            WHERE price_eur IS NOT NULL
+            WINDOW p AS (PARTITION BY source, search_group, scrape_date ORDER BY price_eur)
+        ),
+        centroids AS (
+            SELECT source, search_group, scrape_date, avg(price) AS mean, count(*)::DOUBLE AS weight,
+                   min(price) AS lo, max(price) AS hi
+            FROM ranked GROUP BY source, search_group, scrape_date, cluster
+        )
+        SELECT source, search_group, scrape_date, sum(weight)::BIGINT, min(lo), max(hi),
+               list(mean ORDER BY mean), list(weight ORDER BY mean)
+        FROM centroids GROUP BY source, search_group, scrape_date
+    """)
+
+
+def merged_sketch(con, sources=None, search_groups=None, since=None, until=None):
+    """One TDigest for the selected partitions (None means no filter on that key)."""
+    where, params = ["true"], []
+    for column, values in (("source", sources), ("search_group", search_groups)):
+        if values is not None:
+            values = list(values)
+            where.append(f"{column} IN ({', '.join('?' * len(values))})" if values else "false")
+            params += values
+    if since is not None:
+        where.append("scrape_date >= ?")
+        params.append(since)
+    if until is not None:
+        where.append("scrape_date <= ?")
+        params.append(until)
+    filter_sql = " AND ".join(where)
+    vmin, vmax = con.execute(
+        f"SELECT min(price_min), max(price_max) FROM {SKETCH_TABLE} WHERE {filter_sql}", params
+    ).fetchone()
+    if vmin is None:
+        return TDigest()
+    table = con.execute(
+        f"SELECT unnest(means) AS mean, unnest(weights) AS weight FROM {SKETCH_TABLE} WHERE {filter_sql}", params
+    ).to_arrow_table()
+    return TDigest(table["mean"].to_numpy(), table["weight"].to_numpy(), vmin, vmax)
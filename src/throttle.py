@@ -0,0 +1,96 @@
+# throttle.py
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: `rate` tokens per second, at most `capacity` stored.
+    acquire() blocks until a token is available.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class HostRateLimiter:
+    """Keeps one TokenBucket per host, so every worker shares the same budget for a site."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(self.rate, self.capacity)
+            return self._buckets[host]
+
+    def wait(self, url):
+        self.bucket(url).acquire()
+
+
+class CircuitBreaker:
+    """
+    Per-host circuit breaker for the cheap fetch path.
+    After `threshold` consecutive failures the host is open for `cooldown` seconds
+    (callers go straight to the fallback); then one trial request is let through.
+    record_failure() returns an exponential backoff delay for the caller to wait.
+    """
+
+    def __init__(self, threshold=3, cooldown=300, base_delay=2.0, max_delay=60.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._failures = {}
+        self._opened_at = {}
+        self._lock = threading.Lock()
+
+    def allow(self, host):
+        with self._lock:
+            opened_at = self._opened_at.get(host)
+            if opened_at is None:
+                return True
+            if time.monotonic() - opened_at >= self.cooldown:
+                # half-open: пропускаем одну пробную попытку
+                self._opened_at[host] = time.monotonic()
+                return True
+            return False
+
+    def record_success(self, host):
+        with self._lock:
+            self._failures.pop(host, None)
+            self._opened_at.pop(host, None)
+
+    def record_failure(self, host):
+        with self._lock:
+            failures = self._failures.get(host, 0) + 1
+            self._failures[host] = failures
+            if failures >= self.threshold:
+                if host not in self._opened_at:
+                    print(f"    Circuit for {host} opened after {failures} failures.")
+                self._opened_at[host] = time.monotonic()
+        delay = min(self.max_delay, self.base_delay * 2 ** (failures - 1))
+        return delay * random.uniform(0.5, 1.0)
@@ -0,0 +1,158 @@
+# transport.py
+# HTTP-транспорт скраперов: одна сессия botasaurus_requests на хост (общая для всех страниц
+# и запросов) — браузерный TLS-отпечаток и заголовки Chrome, keep-alive соединения,
+# сжатие gzip/brotli — и метрики каждой загрузки: где на самом деле уходит время.
+# botasaurus_requests — Go-клиент за локальным HTTP-мостом: ответ приходит целиком и уже
+# распакованным, без фаз соединения. Фазы и реальные байты на проводе дает probe():
+# потоковый запрос httpx (зависимость botasaurus_requests) с trace-хуками.
+import threading
+import time
+from urllib.parse import urlparse
+
+import httpx
+from botasaurus_requests import Session
+
+
+def _ms(start, end):
+    return round((end - start) * 1000, 1)
+
+
+def _phase_ms(events, name):
+    """Duration of a traced httpcore phase (e.g. "connect_tcp"), None if it did not happen (reused connection)."""
+    start = next((t for e, t in events.items() if e.endswith(f".{name}.started")), None)
+    end = next((t for e, t in events.items() if e.endswith(f".{name}.complete")), None)
+    return _ms(start, end) if start is not None and end is not None else None
+
+
+class Transport:
+    """
+    Per-host botasaurus_requests sessions (browser-like TLS fingerprint and headers, connections
+    kept alive between requests) that record, for every request: total time in ms, whether it was
+    the first request of the session (it pays for DNS, connect and TLS), the Content-Length the
+    server declared and the decoded body size. The TLS client returns the whole decoded body at
+    once and exposes no phases, so for these requests only the total is measured; probe() fetches
+    a page with streamed httpx to time the phases and count the bytes actually received.
+    """
+
+    def __init__(self, headers=None, timeout=30, browser="chrome"):
+        self.headers = dict(headers or {})  # добавляются к заголовкам браузера, а не заменяют их
+        self.timeout = timeout
+        self.browser = browser
+        self.records = []
+        self.probes = []
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def session(self, url):
+        """The session of the url's host and whether it is new (its first request opens the connection)."""
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._sessions:
+                self._sessions[host] = Session(browser=self.browser, timeout=self.timeout)
+                return self._sessions[host], True
+            return self._sessions[host], False
+
+    def get(self, url, headers=None):
+        session, first = self.session(url)
+        start = time.perf_counter()
+        response = session.get(url, headers={**self.headers, **(headers or {})})
+        end = time.perf_counter()
+
+        content_length = response.headers.get("content-length")
+        self.records.append({
+            "url": url,
+            "host": urlparse(url).netloc,
+            "status": response.status_code,
+            "first_request": first,
+            "total_ms": _ms(start, end),
+            # объявленный сервером размер; сколько байт реально пришло, Go-клиент не сообщает
+            "declared_bytes": int(content_length) if content_length and content_length.isdigit() else None,
+            "body_bytes": len(response.content),
+            "content_encoding": response.headers.get("content-encoding", ""),
+        })
+        return response
+
+    def probe(self, url, headers=None):
+        """
+        Fetches `url` once with a new streamed httpx connection and records its phases: TCP connect
+        (DNS lookup included, httpcore resolves inside it), TLS handshake, time to the response
+        headers (first byte) and body download, plus the bytes received before and after decoding.
+        It sends the session's browser headers but has Python's TLS stack, so a site that checks
+        the fingerprint may answer it differently: call it once per host, not for every page.
+        """
+        session, _ = self.session(url)
+        events = {}
+
+        def trace(name, info):
+            events.setdefault(name, time.perf_counter())
+
+        with httpx.Client(timeout=self.timeout, follow_redirects=True) as client:
+            start = time.perf_counter()
+            with client.stream("GET", url, headers={**session.headers, **self.headers, **(headers or {})},
+                               extensions={"trace": trace}) as response:
+                first_byte = time.perf_counter()
+                body_bytes = sum(len(chunk) for chunk in response.iter_bytes())
+                end = time.perf_counter()
+                wire_bytes = response.num_bytes_downloaded
+
+        record = {
+            "url": url,
+            "host": urlparse(url).netloc,
+            "status": response.status_code,
+            "connect_ms": _phase_ms(events, "connect_tcp"),
+            "tls_ms": _phase_ms(events, "start_tls"),
+            "ttfb_ms": _ms(start, first_byte),
+            "download_ms": _ms(first_byte, end),
+            "total_ms": _ms(start, end),
+            "wire_bytes": wire_bytes,
+            "body_bytes": body_bytes,
+            "content_encoding": response.headers.get("content-encoding", ""),
+        }
+        self.probes.append(record)
+        return record
+
+    def summary(self):
+        """Totals and mean request times (first vs reused connection) per host, with the probes of the host."""
+        by_host = {}
+        for r in self.records:
+            by_host.setdefault(r["host"], []).append(r)
+
+        def mean(rows):
+            values = [r["total_ms"] for r in rows]
+            return round(sum(values) / len(values), 1) if values else None
+
+        summary = {}
+        for host, rows in by_host.items():
+            declared = [r for r in rows if r["declared_bytes"] is not None]
+            summary[host] = {
+                "requests": len(rows),
+                "sessions": sum(r["first_request"] for r in rows),
+                "declared_bytes": sum(r["declared_bytes"] for r in declared),
+                "body_bytes_declared": sum(r["body_bytes"] for r in declared),  # тела с объявленным размером
+                "body_bytes": sum(r["body_bytes"] for r in rows),
+                "mean_first_ms": mean([r for r in rows if r["first_request"]]),
+                "mean_reused_ms": mean([r for r in rows if not r["first_request"]]),
+                "mean_total_ms": mean(rows),
+                "probes": [p for p in self.probes if p["host"] == host],
+            }
+        return summary
+
+    def print_summary(self):
+        for host, stats in self.summary().items():
+            line = (f"\nTransfer stats for {host}: {stats['requests']} requests over {stats['sessions']} sessions, "
+                    f"{stats['body_bytes'] / 1024:,.0f} KiB decoded")
+            if stats["body_bytes_declared"]:
+                saved = 1 - stats["declared_bytes"] / stats["body_bytes_declared"]
+                line += f" ({saved:.0%} saved by compression per the declared Content-Length)"
+            print(line)
+            print("  mean ms — " + ", ".join(f"{k[5:-3]}: {v}" for k, v in stats.items() if k.startswith("mean_")))
+            for p in stats["probes"]:
+                print(f"  probe (httpx, HTTP {p['status']}): connect incl. DNS {p['connect_ms']} ms, "
+                      f"TLS {p['tls_ms']} ms, first byte {p['ttfb_ms']} ms, download {p['download_ms']} ms; "
+                      f"{p['wire_bytes']:,} bytes on the wire -> {p['body_bytes']:,} decoded ({p['content_encoding'] or 'identity'})")
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
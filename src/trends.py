@@ -0,0 +1,197 @@
+# trends.py
+# Сглаженные тренды цены от пробега для больших выборок. Точный LOWESS statsmodels
+# решает локальную регрессию в каждой точке (O(n²) при frac=0.5) — на десятках тысяч
+# объявлений это секунды. Здесь тренд считается на сетке из grid_size точек:
+#   binned — LOWESS по достаточным статистикам корзин пробега (O(n + сетка × корзины)),
+#   delta  — statsmodels с интерполяцией между точками на расстоянии delta,
+#   exact  — statsmodels как есть (эталон),
+#   pspline — штрафованный B-сплайн (P-spline), один разреженный МНК со штрафом по GCV.
+#             Это другой сглаживатель, а не приближение LOWESS: в середине диапазона пробега
+#             он идет в пределах ~2-4% медианной цены от LOWESS, на редких краях — до ~9%.
+import time
+
+import numpy as np
+import statsmodels.api as sm
+from scipy import sparse
+from scipy.interpolate import BSpline
+
+TREND_GRID_SIZE = 200  # точек сетки, в которых считается тренд (линия на графике)
+LOWESS_BINS = 512      # корзин пробега для binned LOWESS; ширина ~0.2% диапазона
+EXACT_MAX_POINTS = 1000  # до стольких точек binned считается точным LOWESS: ≤ ~0.1 с, а корзины
+                         # на малых выборках отходят от него на проценты (3-6% медианы при 30-60 точках)
+TREND_METHODS = ("binned", "delta", "exact", "pspline")
+PSPLINE_PENALTIES = tuple(10.0 ** np.arange(-3, 4.5, 0.5))  # кандидаты для выбора штрафа P-spline по GCV
+
+
+def trend_grid(x, grid_size=TREND_GRID_SIZE):
+    return np.linspace(np.min(x), np.max(x), grid_size)
+
+
+def _tricube(u):
+    return np.clip(1 - np.abs(u) ** 3, 0, None) ** 3
+
+
+def _local_linear(grid, centers, counts, stats, k):
+    """
+    Local linear fits at `grid` from per-bin weighted sums stats = (Sw, Swx, Swy, Swxx, Swxy):
+    each bin gets the tricube weight of its center, the bandwidth reaches the k nearest points.
+    """
+    dist = np.abs(centers[None, :] - grid[:, None])
+    order = np.argsort(dist, axis=1)
+    cum = np.cumsum(counts[order], axis=1)
+    nearest = np.minimum((cum < k).sum(axis=1), dist.shape[1] - 1)
+    h = np.take_along_axis(dist, order, axis=1)[np.arange(len(grid)), nearest]
+    h = np.maximum(h, 1e-12) * 1.001  # k-я точка на краю окна не должна получить нулевой вес
+    kernel = _tricube(dist / h[:, None])
+    s0, s1, t0, s2, t1 = (kernel @ s for s in stats)
+    denom = s0 * s2 - s1 ** 2
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = t0 / s0
+        slope = np.where(np.abs(denom) > 1e-12 * s0 ** 2, (s0 * t1 - s1 * t0) / denom, 0.0)
+        return mean + slope * (grid - s1 / s0)
+
+
+def binned_lowess(x, y, frac=0.5, it=3, grid=None, bins=LOWESS_BINS):
+    """
+    LOWESS evaluated on `grid` (trend_grid(x) by default) from bin sums instead of single points.
+    With `it` robustness iterations as in statsmodels: residuals of every point against the
+    interpolated trend give bisquare weights that enter the bin sums. Returns (grid, fitted).
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    grid = trend_grid(x) if grid is None else np.asarray(grid, dtype=np.float64)
+    lo, span = x.min(), max(np.ptp(x), 1e-12)
+    # x в [0, 1]: суммы x² не теряют точность на пробегах в сотни тысяч км
+    xs, gs = (x - lo) / span, (grid - lo) / span
+    idx = np.minimum((xs * bins).astype(np.int64), bins - 1)
+    counts = np.bincount(idx, minlength=bins).astype(np.float64)
+    occupied = counts > 0
+    centers = np.bincount(idx, weights=xs, minlength=bins)[occupied] / counts[occupied]
+    k = max(int(frac * len(x) + 1e-10), 2)
+
+    weights = np.ones_like(y)
+    for step in range(it + 1):
+        stats = [np.bincount(idx, weights=weights * v, minlength=bins)[occupied]
+                 for v in (np.ones_like(xs), xs, y, xs * xs, xs * y)]
+        fitted = _local_linear(gs, centers, counts[occupied], stats, k)
+        if step == it:
+            break
+        residuals = y - np.interp(xs, gs, fitted)
+        scale = np.median(np.abs(residuals))
+        if scale == 0:
+            break
+        weights = np.clip(1 - (residuals / (6 * scale)) ** 2, 0, None) ** 2
+    return grid, fitted
+
+
+def statsmodels_lowess(x, y, frac=0.5, it=3, grid=None, delta=0.0):
+    """statsmodels LOWESS interpolated onto `grid`; delta > 0 skips local fits closer than delta."""
+    x = np.asarray(x, dtype=np.float64)
+    grid = trend_grid(x) if grid is None else np.asarray(grid, dtype=np.float64)
+    fitted = sm.nonparametric.lowess(y, x, frac=frac, it=it, delta=delta, return_sorted=True)
+    return grid, np.interp(grid, fitted[:, 0], fitted[:, 1])
+
+
+def gcv_penalty(btb, bty, yty, dtd, n, candidates=PSPLINE_PENALTIES):
+    """
+    Relative penalty from `candidates` with the lowest generalized cross-validation score
+    n·RSS / (n − tr H)², from the normal equations of the (weighted) fit.
+    """
+    scale = np.trace(btb) / np.trace(dtd)
+    best, best_score = candidates[0], np.inf
+    for penalty in candidates:
+        inverse = np.linalg.inv(btb + penalty * scale * dtd)
+        coef = inverse @ bty
+        rss = max(yty - 2 * coef @ bty + coef @ btb @ coef, 0.0)
+        score = n * rss / max(n - np.trace(inverse @ btb), 1.0) ** 2
+        if score < best_score:
+            best, best_score = penalty, score
+    return best
+
+
+def pspline_trend(x, y, grid=None, segments=20, degree=3, penalty="gcv", it=3):
+    """
+    P-spline: cubic B-splines on `segments` equal intervals with a second-difference penalty,
+    fitted by penalized least squares. `penalty` is relative to the data term (scale-free);
+    "gcv" picks it from PSPLINE_PENALTIES by generalized cross-validation on the first fit.
+    `it` bisquare reweighting steps make it robust to outliers like LOWESS. This is a smoother
+    of its own, not an approximation of LOWESS: no penalty brings it within a few percent of it.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    grid = trend_grid(x) if grid is None else np.asarray(grid, dtype=np.float64)
+    lo, hi = x.min(), x.max()
+    width = max(hi - lo, 1e-12) / segments
+    knots = lo + width * np.arange(-degree, segments + degree + 1)
+    # из-за округления последний внутренний узел может оказаться чуть меньше max(x)
+    inner = (knots[degree], knots[-degree - 1])
+    basis = BSpline.design_matrix(np.clip(x, *inner), knots, degree).tocsr()
+    diff = np.diff(np.eye(basis.shape[1]), 2, axis=0)
+    dtd = diff.T @ diff
+
+    weights = np.ones_like(y)
+    for step in range(it + 1):
+        weighted = basis.T @ sparse.diags(weights)
+        btb = (weighted @ basis).toarray()
+        if step == 0 and penalty == "gcv":
+            penalty = gcv_penalty(btb, weighted @ y, y @ y, dtd, len(y))
+        lam = penalty * np.trace(btb) / np.trace(dtd)
+        coef = np.linalg.solve(btb + lam * dtd, weighted @ y)
+        if step == it:
+            break
+        residuals = y - basis @ coef
+        scale = np.median(np.abs(residuals))
+        if scale == 0:
+            break
+        weights = np.clip(1 - (residuals / (6 * scale)) ** 2, 0, None) ** 2
+    return grid, BSpline(knots, coef, degree)(np.clip(grid, *inner))
+
+
+def price_trend(x, y, method="binned", frac=0.5, grid=None, grid_size=TREND_GRID_SIZE):
+    """
+    Trend of y over x on a grid_size grid with one of TREND_METHODS. Returns (grid, fitted).
+    "binned" falls back to exact LOWESS for samples of up to EXACT_MAX_POINTS points.
+    """
+    if grid is None:
+        grid = trend_grid(x, grid_size)
+    if method == "binned" and len(x) <= EXACT_MAX_POINTS:
+        method = "exact"
+    if method == "binned":
+        return binned_lowess(x, y, frac=frac, grid=grid)
+    if method == "delta":
+        return statsmodels_lowess(x, y, frac=frac, grid=grid, delta=0.01 * np.ptp(x))
+    if method == "exact":
+        return statsmodels_lowess(x, y, frac=frac, grid=grid)
+    if method == "pspline":
+        return pspline_trend(x, y, grid=grid)
+    raise ValueError(f"unknown trend method {method!r}, expected one of {TREND_METHODS}")
+
+
+if __name__ == "__main__":
+    # Бенчмарк: время и максимальное отклонение от точного LOWESS (в % от медианной цены),
+    # по всей сетке и между 5-м и 95-м процентилями пробега (без редких краев).
+    # Точный statsmodels на больших выборках слишком медленный — там эталон delta.
+    # P-spline — другой сглаживатель (без линейного смещения LOWESS на краях), его отклонение
+    # показывает разницу методов, а не ошибку приближения.
+    rng = np.random.default_rng(0)
+    for n in (1_000, 2_000, 10_000, 50_000, 100_000, 500_000):
+        mileage = rng.gamma(2.0, 60_000, n).clip(0, 450_000)
+        price = 55_000 * np.exp(-mileage / 160_000) * rng.lognormal(0, 0.25, n)
+        price[rng.random(n) < 0.01] *= 4  # выбросы: проверка робастных итераций
+        grid = trend_grid(mileage)
+        reference_method = "exact" if n <= 50_000 else "delta"
+        timings, fits = {}, {}
+        for method in TREND_METHODS:
+            if method == "exact" and reference_method != "exact":
+                continue
+            t0 = time.perf_counter()
+            fits[method] = price_trend(mileage, price, method=method, grid=grid)[1]
+            timings[method] = time.perf_counter() - t0
+        reference = fits[reference_method]
+        scale = np.median(price) / 100
+        inner = (grid >= np.quantile(mileage, 0.05)) & (grid <= np.quantile(mileage, 0.95))
+        print(f"{n:>9,} points (reference: {reference_method})")
+        for method, seconds in timings.items():
+            deviation = np.abs(fits[method] - reference) / scale
+            print(f"    {method:<8} {seconds:8.3f} s   max deviation {deviation.max():6.2f}%"
+                  f"   P5-P95 {deviation[inner].max():6.2f}%")